@@ -0,0 +1,145 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Downloads of the output of all the steps of a job.
+The archives are generated while they are being sent, one piece of
+output at a time, so the whole output is never in memory.
+"""
+from __future__ import unicode_literals, absolute_import
+from django.utils.text import get_valid_filename
+from ci import models, OutputHTML
+import tarfile, tempfile, time, zipfile
+
+CHUNK_SIZE = 64*1024
+
+# format -> (extension, content type)
+FORMATS = {"tar.gz": ("tar.gz", "application/x-gzip"),
+        "zip": ("zip", "application/zip"),
+        "txt": ("txt", "text/plain; charset=utf-8"),
+        }
+
+class StreamBuffer(object):
+    """
+    Write only file object that the archive modules write to.
+    What has been written is taken out with pop() and sent.
+    """
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.data)
+        self.data = []
+        return data
+
+def plain_output_chunks(result, chunk_size=CHUNK_SIZE):
+    """
+    The output of a step result without color codes, as in StepResult.plain_output()
+    Input:
+      result[models.StepResult]: The step result
+      chunk_size[int]: Maximum size in bytes of each piece of output that is read
+    Return:
+      generator of bytes: The UTF-8 encoded output
+    """
+    pending = ""
+    for text in result.iter_output(chunk_size):
+        text = pending + text
+        # Don't strip half of a color code
+        incomplete = OutputHTML.INCOMPLETE_RE.search(text)
+        if incomplete:
+            pending = text[incomplete.start():]
+            text = text[:incomplete.start()]
+        else:
+            pending = ""
+        yield clean_text(text)
+    if pending:
+        yield clean_text(pending)
+
+def clean_text(text):
+    text = models.strip_color_codes(text)
+    return text.replace('\u2018', "'").replace("\u2019", "'").encode("utf-8", "replace")
+
+def base_name(job):
+    """
+    Name of the download, without the extension
+    """
+    return 'results_{}_{}'.format(job.pk, get_valid_filename(job.recipe.name))
+
+def member_name(job, result):
+    """
+    Name of the file of a step result in the download
+    """
+    return '{}/{:02}_{}'.format(base_name(job), result.position, get_valid_filename(result.name))
+
+def tar_chunks(job, step_results):
+    buf = StreamBuffer()
+    tar = tarfile.open(fileobj=buf, mode='w|gz')
+    for result in step_results:
+        # The size has to be in the header so the output is
+        # collected first. It only stays in memory if it is small.
+        with tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE) as f:
+            for data in plain_output_chunks(result):
+                f.write(data)
+            info = tarfile.TarInfo(name=member_name(job, result))
+            info.size = f.tell()
+            info.mtime = time.time()
+            f.seek(0)
+            tar.addfile(tarinfo=info, fileobj=f)
+        yield buf.pop()
+    tar.close()
+    yield buf.pop()
+
+def zip_chunks(job, step_results):
+    buf = StreamBuffer()
+    with zipfile.ZipFile(buf, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for result in step_results:
+            info = zipfile.ZipInfo(member_name(job, result), date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            # The plain output isn't bigger than the output
+            force_zip64 = result.output_length() > zipfile.ZIP64_LIMIT
+            with archive.open(info, mode='w', force_zip64=force_zip64) as f:
+                for data in plain_output_chunks(result):
+                    f.write(data)
+                    yield buf.pop()
+            yield buf.pop()
+    yield buf.pop()
+
+def txt_chunks(job, step_results):
+    for result in step_results:
+        yield "==> {} <==\n".format(member_name(job, result)).encode("utf-8", "replace")
+        for data in plain_output_chunks(result):
+            yield data
+        yield b"\n"
+
+def archive_chunks(job, step_results, fmt):
+    """
+    Generates a download of the output of the step results of a job.
+    Input:
+      job[models.Job]: The job
+      step_results[iterable of models.StepResult]: The step results to include
+      fmt[str]: One of FORMATS
+    Return:
+      generator of bytes: The contents of the download
+    """
+    generators = {"tar.gz": tar_chunks, "zip": zip_chunks, "txt": txt_chunks}
+    for data in generators[fmt](job, step_results):
+        if data:
+            yield data
@@ -0,0 +1,118 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Storage of step output in files under settings.STEP_OUTPUT_DIR.
+The files hold the UTF-8 encoded output so byte ranges can be
+read with mmap without reading the whole file.
+"""
+from __future__ import unicode_literals, absolute_import
+import os, mmap, shutil, tempfile
+import logging
+logger = logging.getLogger('ci')
+
+def output_path(base_dir, job_pk, step_result_pk):
+    """
+    Where the output of a step result is stored.
+    Input:
+      base_dir[str]: settings.STEP_OUTPUT_DIR
+      job_pk[int]: The job of the step result
+      step_result_pk[int]: The step result
+    Return:
+      str: Absolute path of the file
+    """
+    return os.path.join(os.path.abspath(base_dir), str(job_pk), "%s.log" % step_result_pk)
+
+def append(path, data):
+    """
+    Appends to a file, creating it if necessary.
+    Input:
+      path[str]: From output_path()
+      data[bytes]: What to append
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as f:
+        f.write(data)
+
+def write(path, data):
+    """
+    Replaces the contents of a file. A temporary file is renamed into
+    place so that readers never see a partially written file.
+    Input:
+      path[str]: From output_path()
+      data[bytes]: The new contents
+    """
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+def size(path):
+    """
+    Size of a file in bytes, 0 if it doesn't exist
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def read_range(path, start=0, end=None):
+    """
+    Reads a byte range of a file without reading the rest of it.
+    Input:
+      path[str]: From output_path()
+      start[int]: Offset of the first byte
+      end[int]: Offset after the last byte, None for the end of the file
+    Return:
+      bytes: The data, empty if the file doesn't exist
+    """
+    try:
+        with open(path, "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
+            if end is None or end > file_size:
+                end = file_size
+            if start >= end:
+                return b''
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return m[start:end]
+    except FileNotFoundError:
+        return b''
+
+def delete(path):
+    """
+    Removes a file, and its directory if it is now empty.
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass # not empty
+
+def delete_job(base_dir, job_pk):
+    """
+    Removes the directory with the output of all the step results of a job.
+    Input:
+      base_dir[str]: settings.STEP_OUTPUT_DIR
+      job_pk[int]: The job
+    """
+    shutil.rmtree(os.path.dirname(output_path(base_dir, job_pk, 0)), ignore_errors=True)
@@ -0,0 +1,231 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rendering of step output as HTML.
+
+Converting the terminal color codes is slow for large outputs so the
+rendered HTML of each step result is cached. While a step is running its
+output is only ever appended to, so only the new output gets converted and
+added to the cached HTML. The color codes still in effect at the end of
+the cached HTML are put in front of the new output so that it starts with
+the same colors.
+"""
+from __future__ import unicode_literals, absolute_import
+from django.conf import settings
+from django.core.cache import cache
+import ansi2html
+import re
+
+# Only the end of outputs larger than this is shown
+MAX_SIZE = 1024*1024*2
+# How many of the offsets that the cached HTML was extended at are remembered
+MAX_MARKS = 100
+# How far back to look for the color codes in effect when rendering part of the output
+MAX_CARRY_SEARCH = 1024*64
+
+SGR_RE = re.compile("\33\\[([\\d;]*)m")
+# An escape sequence that was split at the end of the output
+INCOMPLETE_RE = re.compile("\33(\\[[\\d;]*)?$")
+
+def html_key(step_result_pk):
+    """
+    Key in the cache for the rendered output of a step result
+    """
+    return 'step_output_html:{}'.format(step_result_pk)
+
+def tail_key(step_result_pk):
+    """
+    Key in the cache for the rendered end of an output larger than MAX_SIZE
+    """
+    return 'step_output_html_tail:{}'.format(step_result_pk)
+
+def clear(step_result_pk):
+    """
+    Removes the cached HTML of a step result. Needs to be called
+    whenever the output is replaced instead of appended to.
+    """
+    clear_many([step_result_pk])
+
+def clear_many(step_result_pks):
+    """
+    Removes the cached HTML of several step results
+    """
+    cache.delete_many([key for pk in step_result_pks for key in (html_key(pk), tail_key(pk))])
+
+def terminalize_output(output):
+    # Replace "<,&,>" signs
+    output = output.replace("&", "&amp;")
+    output = output.replace("<", "&lt;")
+    output = output.replace(">", "&gt;")
+    output = output.replace("\n", "<br/>")
+    '''
+       Substitute terminal color codes for CSS tags.
+       The bold tag can be a modifier on another tag
+       and thus sometimes doesn't have its own
+       closing tag. Just ignore it in that case.
+    '''
+    conv = ansi2html.Ansi2HTMLConverter(escaped=False, scheme="xterm")
+    return conv.convert(output, full=False)
+
+def carry_codes(carry, output):
+    """
+    The color codes still in effect at the end of the output.
+    Input:
+      carry[str]: The codes in effect at the start of the output
+      output[str]: The output
+    Return:
+      str: The codes since the last reset
+    """
+    codes = [carry]
+    for match in SGR_RE.finditer(output):
+        if match.group(1) in ("", "0"):
+            codes = []
+        else:
+            codes.append(match.group(0))
+    return "".join(codes)
+
+def new_entry():
+    return {'offset': 0, 'html': '', 'carry': '', 'marks': []}
+
+def update(step_result, length):
+    """
+    Renders any output that isn't in the cached HTML yet.
+    Input:
+      step_result[models.StepResult]: The step result
+      length[int]: Current size in bytes of the output
+    Return:
+      dict: With keys:
+        offset: Byte offset of the end of the rendered output
+        html: The rendered output
+        carry: The color codes in effect at offset
+        marks: List of (offset, position in html) where the html was extended
+    """
+    key = html_key(step_result.pk)
+    entry = None
+    if step_result.pk is not None:
+        entry = cache.get(key)
+    if entry is None or entry['offset'] > length:
+        entry = new_entry()
+    if entry['offset'] == length:
+        return entry
+
+    output = step_result.read_output(entry['offset'], length)
+    end = length
+    # Leave a split escape sequence for when the rest of it is there
+    incomplete = INCOMPLETE_RE.search(output)
+    if incomplete:
+        output = output[:incomplete.start()]
+        end -= len(incomplete.group(0))
+    if not output:
+        return entry
+
+    marks = entry['marks'] + [(entry['offset'], len(entry['html']))]
+    entry = {'offset': end,
+            'html': entry['html'] + terminalize_output(entry['carry'] + output),
+            'carry': carry_codes(entry['carry'], output),
+            'marks': marks[-MAX_MARKS:],
+            }
+    if step_result.pk is not None:
+        cache.set(key, entry, timeout=settings.STEP_OUTPUT_HTML_CACHE_TIMEOUT)
+    return entry
+
+def render_tail(step_result, length):
+    """
+    Renders the end of an output larger than MAX_SIZE.
+    This is only cached until the output changes.
+    """
+    key = tail_key(step_result.pk)
+    entry = cache.get(key)
+    if entry and entry['length'] == length:
+        return entry['html']
+
+    tail = step_result.read_output(length - MAX_SIZE, length)
+    # Start on a full line
+    tail = tail[tail.find("\n")+1:]
+    msg = "Output too large. You will need to download the results to see all of it. Showing the end:\n"
+    html = terminalize_output(msg + tail)
+    if step_result.pk is not None:
+        cache.set(key, {'length': length, 'html': html}, timeout=settings.STEP_OUTPUT_HTML_CACHE_TIMEOUT)
+    return html
+
+def render(step_result):
+    """
+    The output of a step result as HTML.
+    If the output is over MAX_SIZE then just the end of it.
+    Input:
+      step_result[models.StepResult]: The step result
+    Return:
+      str: The HTML
+    """
+    return render_with_offset(step_result)[0]
+
+def render_with_offset(step_result):
+    """
+    Same as render() but also gives how much of the output was rendered.
+    This can be less than the length of the output, see update().
+    Input:
+      step_result[models.StepResult]: The step result
+    Return:
+      (str, int): The HTML and the byte offset of the end of it
+    """
+    length = step_result.output_length()
+    if length > MAX_SIZE:
+        return render_tail(step_result, length), length
+    entry = update(step_result, length)
+    return entry['html'], entry['offset']
+
+def render_range(step_result, start, end):
+    """
+    Renders part of the output without the cache, starting with the color
+    codes in effect at start. Only the MAX_CARRY_SEARCH bytes before start
+    are looked at for those.
+    Input:
+      step_result[models.StepResult]: The step result
+      start[int]: Byte offset of the start of the part
+      end[int]: Byte offset of the end of the part
+    Return:
+      (str, int): The HTML and the byte offset of the end of what was rendered.
+        This is before any escape sequence split at the end.
+    """
+    output = step_result.read_output(start, end)
+    incomplete = INCOMPLETE_RE.search(output)
+    if incomplete:
+        output = output[:incomplete.start()]
+        end -= len(incomplete.group(0))
+    if not output:
+        return "", start
+    carry = carry_codes("", step_result.read_output(max(0, start - MAX_CARRY_SEARCH), start)) if start else ""
+    return terminalize_output(carry + output), end
+
+def render_since(step_result, offset):
+    """
+    The HTML of the output after an offset returned by a previous call.
+    Input:
+      step_result[models.StepResult]: The step result
+      offset[int]: Byte offset of the output already rendered
+    Return:
+      (str, int): The HTML and the byte offset of the end of it.
+        None if the cached HTML doesn't start a part at that offset.
+    """
+    length = step_result.output_length()
+    if length > MAX_SIZE:
+        return None
+    entry = update(step_result, length)
+    if offset == entry['offset']:
+        return "", offset
+    for mark_offset, position in entry['marks']:
+        if mark_offset == offset:
+            return entry['html'][position:], entry['offset']
+    return None
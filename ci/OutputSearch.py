@@ -0,0 +1,354 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Full text search of step output.
+
+The output of each step is added, line by line, to a SQLite FTS5 index
+in settings.OUTPUT_SEARCH_INDEX when the step completes. The index is a
+separate database so it works whatever database the server uses and
+the big index tables don't slow down the main database. It uses the
+trigram tokenizer so any part of a line can be searched for, like grep.
+
+Completed steps are indexed by a background thread in each server process
+so that the client's request doesn't wait on the index. StepResult.output_indexed
+is set once the output is in the index, so anything that was still queued
+when a process stopped, or that failed to be indexed, is picked up by the
+index_step_output command. Deleted step results are removed from the index
+by the same thread.
+"""
+from __future__ import unicode_literals, absolute_import
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils.html import escape
+from ci import models, Permissions
+import queue, sqlite3, threading, time
+import logging
+logger = logging.getLogger('ci')
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS step_results (
+        step_result_id INTEGER PRIMARY KEY,
+        job_id INTEGER NOT NULL,
+        repository_id INTEGER NOT NULL,
+        recipe_name TEXT NOT NULL,
+        status INTEGER NOT NULL,
+        completed REAL NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS step_results_job ON step_results (job_id)",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS output_lines USING fts5(
+        content, step_result_id UNINDEXED, line UNINDEXED, tokenize='trigram')""",
+    ]
+
+# The trigram tokenizer can't match anything shorter
+MIN_SEARCH_LENGTH = 3
+INSERT_BATCH_SIZE = 1000
+# Marks the matches in the highlighted lines before they are escaped
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+_local = threading.local()
+# (function, argument) for the background thread to call
+_index_queue = None
+_index_queue_lock = threading.Lock()
+
+def enabled():
+    return bool(settings.OUTPUT_SEARCH_INDEX)
+
+def get_connection():
+    """
+    The connection to the index for this thread, creating the index if needed.
+    """
+    path = settings.OUTPUT_SEARCH_INDEX
+    connections = _local.__dict__.setdefault('connections', {})
+    conn = connections.get(path)
+    if conn is None:
+        # Autocommit, transactions are started explicitly
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        for sql in SCHEMA:
+            conn.execute(sql)
+        connections[path] = conn
+    return conn
+
+def close():
+    """
+    Closes the connections of this thread
+    """
+    for conn in _local.__dict__.pop('connections', {}).values():
+        conn.close()
+
+def output_lines(step_result):
+    """
+    The lines of the output to index, without color codes.
+    Return:
+      generator of (int, str): Line number starting at 1 and the line
+    """
+    number = 0
+    partial = ""
+    for text in step_result.iter_output():
+        lines = (partial + text).split("\n")
+        partial = lines.pop()
+        for line in lines:
+            number += 1
+            yield number, line
+    if partial:
+        yield number + 1, partial
+
+def index_step_result(step_result):
+    """
+    Adds the output of a completed step result to the index, replacing
+    anything already there for it, and sets its output_indexed.
+    Input:
+      step_result[models.StepResult]: The step result
+    """
+    if not enabled():
+        return
+    job = step_result.job
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        remove_rows(conn, step_result.pk)
+        conn.execute("INSERT INTO step_results VALUES (?, ?, ?, ?, ?, ?)",
+                (step_result.pk, job.pk, job.recipe.repository_id, job.recipe.name, step_result.status, time.time()))
+        batch = []
+        for number, line in output_lines(step_result):
+            line = models.strip_color_codes(line).strip()
+            if line:
+                batch.append((line[:settings.OUTPUT_SEARCH_MAX_LINE], step_result.pk, number))
+            if len(batch) >= INSERT_BATCH_SIZE:
+                conn.executemany("INSERT INTO output_lines (content, step_result_id, line) VALUES (?, ?, ?)", batch)
+                batch = []
+        conn.executemany("INSERT INTO output_lines (content, step_result_id, line) VALUES (?, ?, ?)", batch)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    # update() so that last_modified doesn't change
+    models.StepResult.objects.filter(pk=step_result.pk).update(output_indexed=True)
+
+def index_pending(step_result_pk):
+    """
+    Indexes a step result if it is complete and its output isn't in the index yet.
+    Input:
+      step_result_pk[int]: ID of the step result
+    """
+    step_result = (models.StepResult.objects
+            .filter(pk=step_result_pk, complete=True, output_indexed=False)
+            .select_related('job__recipe')
+            .first())
+    if step_result is not None:
+        index_step_result(step_result)
+
+def index_worker(index_queue):
+    """
+    Background thread target that calls the (function, argument) put in the queue.
+    """
+    while True:
+        func, arg = index_queue.get()
+        try:
+            func(arg)
+        except Exception as e:
+            # If this was indexing, the output is saved and output_indexed isn't
+            # set, so the index_step_output command will add it. Rows of deleted
+            # step results are left but aren't shown by find_jobs().
+            logger.warning("Failed to update the output search index for {}: {}".format(arg, e))
+        finally:
+            connections.close_all()
+            index_queue.task_done()
+
+def get_index_queue():
+    """
+    The queue of the background thread, starting the thread if needed.
+    """
+    global _index_queue
+    with _index_queue_lock:
+        if _index_queue is None:
+            _index_queue = queue.Queue()
+            threading.Thread(target=index_worker, args=(_index_queue,), daemon=True).start()
+        return _index_queue
+
+def index_later(step_result):
+    """
+    Indexes a completed step result in the background once the current
+    transaction commits.
+    Input:
+      step_result[models.StepResult]: The step result
+    """
+    if not enabled():
+        return
+    pk = step_result.pk
+    transaction.on_commit(lambda: get_index_queue().put((index_pending, pk)))
+
+def remove_later(step_result_pks):
+    """
+    Removes step results from the index in the background.
+    Input:
+      step_result_pks[list of int]: IDs of the step results
+    """
+    if enabled() and step_result_pks:
+        get_index_queue().put((remove, step_result_pks))
+
+def remove_job_later(job_pk):
+    """
+    Removes all the step results of a job from the index in the background.
+    Input:
+      job_pk[int]: ID of the job
+    """
+    if enabled():
+        get_index_queue().put((remove_job, job_pk))
+
+def wait_for_index():
+    """
+    Waits until the background thread has done everything queued so far.
+    """
+    if _index_queue is not None:
+        _index_queue.join()
+
+def remove_rows(conn, step_result_pk):
+    conn.execute("DELETE FROM output_lines WHERE step_result_id = ?", (step_result_pk,))
+    conn.execute("DELETE FROM step_results WHERE step_result_id = ?", (step_result_pk,))
+
+def remove(step_result_pks):
+    """
+    Removes step results from the index
+    Input:
+      step_result_pks[list of int]: IDs of the step results
+    """
+    if not enabled():
+        return
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for pk in step_result_pks:
+            remove_rows(conn, pk)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def remove_job(job_pk):
+    """
+    Removes all the step results of a job from the index
+    Input:
+      job_pk[int]: ID of the job
+    """
+    if not enabled():
+        return
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("""DELETE FROM output_lines WHERE step_result_id IN
+            (SELECT step_result_id FROM step_results WHERE job_id = ?)""", (job_pk,))
+        conn.execute("DELETE FROM step_results WHERE job_id = ?", (job_pk,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def highlight(line):
+    """
+    Escapes a line from search() and puts <mark> around the matches
+    """
+    return escape(line).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>")
+
+def search(text, repository_ids=None, recipe_name=None, status=None, since=None, until=None, limit=100):
+    """
+    Searches the index for lines containing text, case insensitive.
+    Input:
+      text[str]: What to search for. At least MIN_SEARCH_LENGTH characters.
+      repository_ids[list of int]: Only step results in these repositories
+      recipe_name[str]: Only step results of recipes with this name
+      status[int]: Only step results with this models.JobStatus
+      since[float]: Only step results completed at or after this timestamp
+      until[float]: Only step results completed before this timestamp
+      limit[int]: Maximum number of lines to return
+    Return:
+      list of dict: Newest first, with keys step_result_id, job_id, line (the line number)
+        and snippet (the HTML escaped line with the matches highlighted)
+    """
+    if len(text) < MIN_SEARCH_LENGTH:
+        return []
+    where = ["output_lines MATCH ?"]
+    # Search for the whole text, not separate words
+    params = ['"%s"' % text.replace('"', '""')]
+    if repository_ids is not None:
+        if not repository_ids:
+            return []
+        where.append("step_results.repository_id IN (%s)" % ",".join(["?"] * len(repository_ids)))
+        params.extend(repository_ids)
+    if recipe_name:
+        where.append("step_results.recipe_name = ?")
+        params.append(recipe_name)
+    if status is not None:
+        where.append("step_results.status = ?")
+        params.append(status)
+    if since is not None:
+        where.append("step_results.completed >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("step_results.completed < ?")
+        params.append(until)
+    params.append(limit)
+
+    # Rows are added when the steps complete so a descending rowid is newest first,
+    # which FTS5 can do without sorting all the matches.
+    sql = """SELECT output_lines.step_result_id, step_results.job_id, output_lines.line,
+                highlight(output_lines, 0, '{}', '{}')
+             FROM output_lines JOIN step_results ON step_results.step_result_id = output_lines.step_result_id
+             WHERE {}
+             ORDER BY output_lines.rowid DESC LIMIT ?""".format(MATCH_START, MATCH_END, " AND ".join(where))
+    rows = get_connection().execute(sql, params).fetchall()
+    return [{'step_result_id': row[0], 'job_id': row[1], 'line': row[2], 'snippet': highlight(row[3])} for row in rows]
+
+def find_jobs(session, text, repository=None, recipe_name=None, status=None, since=None, until=None, limit=100):
+    """
+    Searches the output of the jobs the user can see.
+    Input:
+      session[django.contrib.sessions.backends.db.SessionStore]: The session of the user
+      repository[models.Repository]: Only jobs on this repository
+      Others are as in search()
+    Return:
+      list of (models.Job, list of dict): Newest first. The matches of each job are
+        the dicts from search() with the added key step_result (models.StepResult)
+    """
+    repository_ids = Permissions.viewable_repos(session)
+    if repository is not None:
+        repository_ids = [pk for pk in repository_ids if pk == repository.pk]
+    matches = search(text, repository_ids, recipe_name, status, since, until, limit)
+
+    results = models.StepResult.objects.filter(pk__in=set([m['step_result_id'] for m in matches]))
+    results = results.select_related('job__recipe__repository__user__server',
+            'job__recipe__build_user__server',
+            'job__event__base__branch__repository__user',
+            'job__config')
+    results = {result.pk: result for result in results}
+    jobs = []
+    job_matches = {}
+    can_see = {}
+    for match in matches:
+        result = results.get(match['step_result_id'])
+        if result is None:
+            # Removed since it was indexed
+            continue
+        recipe = result.job.recipe
+        if recipe.pk not in can_see:
+            can_see[recipe.pk] = Permissions.can_see_results(session, recipe)
+        if not can_see[recipe.pk]:
+            continue
+        match['step_result'] = result
+        if result.job_id not in job_matches:
+            job_matches[result.job_id] = []
+            jobs.append(result.job)
+        job_matches[result.job_id].append(match)
+    return [(job, job_matches[job.pk]) for job in jobs]
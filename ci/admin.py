@@ -94,7 +94,7 @@ class PullRequestAdmin(admin.ModelAdmin):
 
 class StepResultInline(admin.TabularInline):
     model = models.StepResult
-    exclude = ['output', 'position']
+    exclude = ['output', 'compressed_length', 'position']
     readonly_fields = ['name', 'filename', 'abort_on_failure', 'allowed_to_fail', 'seconds', 'exit_status']
     can_delete = False
     max_num = 0
@@ -142,7 +142,11 @@ class StepEnvironmentAdmin(admin.ModelAdmin):
 class StepResultAdmin(admin.ModelAdmin):
     search_fields = ['filename', 'name']
     list_display = ['result_display']
-    readonly_fields = ['output']
+    exclude = ['output', 'compressed_length']
+    readonly_fields = ['full_output']
+
+    def full_output(self, obj):
+        return obj.get_output()
 
     def result_display(self, obj):
         return "%s: %s : %s" % (obj.job.recipe.filename, obj.job.pk, obj.name)
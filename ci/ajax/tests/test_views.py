@@ -15,12 +15,13 @@
 # limitations under the License.
 
 from __future__ import unicode_literals, absolute_import
+import json, os, shutil, tempfile
 from django.urls import reverse
 from django.utils.html import escape
 from ci.tests import utils
 from mock import patch
 from ci.github import api
-from ci import models, Permissions
+from ci import models, Permissions, OutputSearch, OutputHTML
 from ci.tests import DBTester
 from django.test import override_settings
 
@@ -253,6 +254,140 @@ class Tests(DBTester.DBTester):
             response = self.client.get(url, data)
             self.assertEqual(response.status_code, 403)
 
+    @patch.object(Permissions, 'is_allowed_to_see_clients')
+    @override_settings(PERMISSION_CACHE_TIMEOUT=0)
+    def test_job_results_offsets(self, mock_allowed):
+        mock_allowed.return_value = True
+        url = reverse('ci:ajax:job_results')
+        step_result = utils.create_step_result()
+        step_result.job.recipe.private = False
+        step_result.job.recipe.save()
+        repo = step_result.job.recipe.repository
+        repo.active = True
+        repo.save()
+        step_result.append_output('\33[30mfoo\33[0m\n')
+        step_result.save()
+        step_result.job.save()
+        data = {'last_request': 10, 'job_id': step_result.job.pk, 'offsets': 'foo'}
+
+        response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 400)
+
+        # No offset, all the output
+        data['offsets'] = '{}'
+        response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        result = response.json()['results'][0]
+        self.assertFalse(result['output_append'])
+        self.assertEqual(result['output'], '<span class="ansi30">foo</span><br/>')
+        self.assertEqual(result['output_offset'], 13)
+
+        # Only the new output
+        step_result.append_output('<bar>\n')
+        data['offsets'] = json.dumps({step_result.pk: result['output_offset']})
+        response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        result = response.json()['results'][0]
+        self.assertTrue(result['output_append'])
+        self.assertEqual(result['output'], '&lt;bar&gt;<br/>')
+        self.assertEqual(result['output_offset'], 19)
+
+        # Nothing new
+        data['offsets'] = json.dumps({step_result.pk: result['output_offset']})
+        response = self.client.get(url, data)
+        result = response.json()['results'][0]
+        self.assertTrue(result['output_append'])
+        self.assertEqual(result['output'], '')
+
+        # Offset past the end, like after the job was invalidated
+        data['offsets'] = json.dumps({step_result.pk: 100})
+        response = self.client.get(url, data)
+        result = response.json()['results'][0]
+        self.assertFalse(result['output_append'])
+        self.assertIn('&lt;bar&gt;', result['output'])
+
+        # Positions are in all the output sent, even once some of it was removed
+        step_result.append_output('0123456789', (5, 15))
+        step_result.refresh_from_db()
+        self.assertEqual(step_result.elided_length, 9)
+        data['offsets'] = json.dumps({step_result.pk: 19})
+        response = self.client.get(url, data)
+        result = response.json()['results'][0]
+        self.assertTrue(result['output_append'])
+        # The reset after "foo" was removed so the color is still in effect
+        self.assertEqual(result['output'], '<span class="ansi30">0123456789</span>')
+        self.assertEqual(result['output_offset'], 29)
+        # The page has output that was removed
+        data['offsets'] = json.dumps({step_result.pk: 10})
+        response = self.client.get(url, data)
+        result = response.json()['results'][0]
+        self.assertFalse(result['output_append'])
+        self.assertIn('Output removed here', result['output'])
+        self.assertEqual(result['output_offset'], 29)
+
+        # Not where the cached HTML was extended, the colors before it still apply
+        step_result.append_output('\33[0m\33[31mred more')
+        data['offsets'] = json.dumps({step_result.pk: 42})
+        response = self.client.get(url, data)
+        result = response.json()['results'][0]
+        self.assertTrue(result['output_append'])
+        self.assertEqual(result['output'], '<span class="ansi31">more</span>')
+        self.assertEqual(result['output_offset'], 46)
+        # Too far behind, so the page gets what a full render shows
+        with patch.object(OutputHTML, 'MAX_SIZE', 3):
+            response = self.client.get(url, data)
+        result = response.json()['results'][0]
+        self.assertFalse(result['output_append'])
+        self.assertIn('Output too large', result['output'])
+        self.assertEqual(result['output_offset'], 46)
+
+        # Complete output replaces what was there
+        step_result.complete = True
+        step_result.set_output('all')
+        data['offsets'] = json.dumps({step_result.pk: 19})
+        response = self.client.get(url, data)
+        result = response.json()['results'][0]
+        self.assertFalse(result['output_append'])
+        self.assertEqual(result['output'], 'all')
+        self.assertEqual(result['output_offset'], 3)
+
+    @patch.object(Permissions, 'viewable_repos')
+    def test_output_search(self, mock_repos):
+        url = reverse('ci:ajax:output_search')
+        response = self.client.get(url, {'text': 'error'})
+        self.assertEqual(response.status_code, 400)
+
+        index_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(OUTPUT_SEARCH_INDEX=os.path.join(index_dir, 'index.sqlite3')):
+                response = self.client.get(url, {'text': 'er'})
+                self.assertEqual(response.status_code, 400)
+
+                result = utils.create_step_result()
+                result.set_output('ok\nsome <error>\n')
+                OutputSearch.index_step_result(result)
+                models.Recipe.objects.update(private=False)
+                mock_repos.return_value = [result.job.recipe.repository.pk]
+
+                response = self.client.get(url, {'text': 'error', 'status': models.JobStatus.NOT_STARTED})
+                self.assertEqual(response.status_code, 200)
+                jobs = response.json()['jobs']
+                self.assertEqual(len(jobs), 1)
+                self.assertEqual(jobs[0]['id'], result.job.pk)
+                self.assertEqual(jobs[0]['url'], reverse('ci:view_job', args=[result.job.pk]))
+                self.assertEqual(jobs[0]['matches'], [{'step_result_id': result.pk,
+                    'step': result.name,
+                    'line': 2,
+                    'snippet': 'some &lt;<mark>error</mark>&gt;',
+                    }])
+
+                response = self.client.get(url, {'text': 'error', 'status': models.JobStatus.FAILED})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json()['jobs'], [])
+                OutputSearch.close()
+        finally:
+            shutil.rmtree(index_dir)
+
     @override_settings(PERMISSION_CACHE_TIMEOUT=0)
     def test_repo_update(self):
         url = reverse('ci:ajax:repo_update')
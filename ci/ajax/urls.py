@@ -29,6 +29,7 @@ urlpatterns = [
   re_path(r'^job_results_html/', views.job_results_html, name='job_results_html'),
   re_path(r'^repo_update/', views.repo_update, name='repo_update'),
   re_path(r'^clients/', views.clients_update, name='clients'),
+  re_path(r'^output_search/', views.output_search, name='output_search'),
   re_path(r'^(?P<owner>[A-Za-z0-9]+)/(?P<repo>[A-Za-z0-9-_]+)/branches_status',
       views.repo_branches_status, name='repo_branches_status'),
   re_path(r'^(?P<owner>[A-Za-z0-9]+)/(?P<repo>[A-Za-z0-9-_]+)/prs_status', views.repo_prs_status, name='repo_prs_status'),
@@ -18,9 +18,9 @@ from django.utils import timezone
 from django.http import JsonResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
-from ci import models, views
-import datetime
-from ci import Permissions, TimeUtils, EventsStatus, RepositoryStatus
+from ci import models, views, forms
+import datetime, json
+from ci import Permissions, TimeUtils, EventsStatus, RepositoryStatus, OutputHTML, OutputSearch
 import logging
 logger = logging.getLogger('ci')
 
@@ -137,6 +137,47 @@ def repo_update(request):
         'limit': limit,
         })
 
+def get_output_offsets(request):
+    """
+    Parses the optional "offsets" GET parameter of job_results.
+    Return:
+      dict: StepResult.pk -> byte offset, or None if it is invalid
+    """
+    try:
+        offsets = json.loads(request.GET.get('offsets', '{}'))
+        return {int(pk): int(offset) for pk, offset in offsets.items()}
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+def result_output_info(result, position):
+    """
+    The output of a step result for job_results.
+    Input:
+      result[models.StepResult]: The step result
+      position[int]: Position in the output of what the page already has, or None.
+        This is in all the output sent, see StepResult.output_position().
+    Return:
+      dict: With keys:
+        output: The rendered output
+        output_append: Whether the output should be appended to what the page has
+        output_offset: The position to send with the next request
+    """
+    length = result.output_length()
+    # The complete output replaces what was streamed so always send it all then.
+    # It is only sent once since the result doesn't change after it is complete.
+    if position is not None and not result.complete:
+        # None if the page has output that has since been removed
+        offset = result.output_offset(position)
+        if offset is not None and 0 < offset <= length:
+            since = OutputHTML.render_since(result, offset)
+            # Too far behind, the page just gets what a full render shows
+            if since is None and length - offset <= OutputHTML.MAX_SIZE:
+                since = OutputHTML.render_range(result, offset, length)
+            if since is not None:
+                return {'output': since[0], 'output_append': True, 'output_offset': result.output_position(since[1])}
+    html, position = result.clean_output_position()
+    return {'output': html, 'output_append': False, 'output_offset': position}
+
 def job_results(request):
     """
     Returns the job results and job info in JSON.
@@ -144,9 +185,14 @@ def job_results(request):
       job_id: The pk of the job
       last_request: A timestamp of when client last requested this information. If the job
         hasn't been updated since that time we don't have to send as much information.
+      offsets: Optional JSON dict of step result id -> "output_offset" from the last request.
+        Only the output after the offset is sent for running steps.
     """
     if 'last_request' not in request.GET or 'job_id' not in request.GET:
         return HttpResponseBadRequest('Missing parameters')
+    offsets = get_output_offsets(request)
+    if offsets is None:
+        return HttpResponseBadRequest('Bad offsets')
 
     this_request = TimeUtils.get_local_timestamp()
     job_id = int(request.GET['job_id'])
@@ -197,12 +243,12 @@ def job_results(request):
             'name': result.name,
             'runtime': str(result.seconds),
             'exit_status': exit_status,
-            'output': result.clean_output(),
             'status': result.status_slug(),
             'running': result.status != models.JobStatus.NOT_STARTED,
             'complete': result.complete,
             'output_size': result.output_size(),
             }
+        info.update(result_output_info(result, offsets.get(result.id)))
         result_info.append(info)
 
     return JsonResponse({'job_info': job_info, 'results': result_info, 'last_request': this_request})
@@ -225,6 +271,33 @@ def clients_update(request):
     clients = views.clients_info()
     return JsonResponse({ 'clients': clients })
 
+def output_search(request):
+    """
+    Searches the output of completed steps. Returns the matching jobs
+    in JSON, newest first.
+    GET parameters are the fields of forms.OutputSearchForm
+    """
+    if not OutputSearch.enabled():
+        return HttpResponseBadRequest('Output search is not enabled')
+    form = forms.OutputSearchForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest('Bad parameters')
+
+    jobs = []
+    for job, matches in views.get_output_search_results(request, form):
+        jobs.append({'id': job.pk,
+            'url': reverse('ci:view_job', args=[job.pk]),
+            'description': str(job),
+            'status': job.status_slug(),
+            'created': TimeUtils.display_time_str(job.created),
+            'matches': [{'step_result_id': m['step_result_id'],
+                'step': m['step_result'].name,
+                'line': m['line'],
+                'snippet': m['snippet'],
+                } for m in matches],
+            })
+    return JsonResponse({'jobs': jobs})
+
 def repo_branches_status(request, owner, repo):
     """
     Returns JSON of the status of the branches on a repo.
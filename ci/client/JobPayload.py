@@ -0,0 +1,154 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cache of the parts of the job information sent to clients that only
+depend on the recipe.
+
+Recipes are never changed in place; loading a changed recipe creates a
+new record. So the scripts, steps and environment of a recipe only
+change if the files in the recipe repository change, which is why the
+cached payloads are keyed by (recipe pk, recipe repo SHA).
+
+The SHA is checked by each server process every RECIPE_REPO_SHA_UPDATE_INTERVAL
+milliseconds and the payloads expire after the same interval, so a changed
+script is picked up within that interval even if the cache isn't shared
+between processes or the SHA can't be determined.
+A payload is always built against a SHA read at the time it is built, so a
+payload is never stored under, or reported with, a SHA older than its scripts.
+"""
+from __future__ import unicode_literals, absolute_import
+from django.conf import settings
+from django.core.cache import cache
+from ci.recipe import file_utils
+import logging
+logger = logging.getLogger('ci')
+
+def repo_sha_key(base_dir):
+    """
+    Key in the cache for the current SHA of the recipe repository
+    """
+    return 'recipe_repo_sha:{}'.format(base_dir)
+
+def payload_key(recipe_pk, repo_sha):
+    """
+    Key in the cache for the payload of a recipe
+    """
+    return 'recipe_payload:{}:{}'.format(recipe_pk, repo_sha)
+
+def recipe_repo_sha():
+    """
+    Gets the current SHA of the recipe repository.
+    Getting the SHA needs a git subprocess so it is only done
+    every RECIPE_REPO_SHA_UPDATE_INTERVAL milliseconds.
+    Return:
+      str: The SHA, or "" if RECIPE_BASE_DIR isn't a valid repo
+    """
+    sha = cache.get(repo_sha_key(settings.RECIPE_BASE_DIR))
+    if sha is None:
+        sha = update_repo_sha()
+    return sha
+
+def update_repo_sha():
+    """
+    Reads the SHA of the recipe repository now and caches it for recipe_repo_sha().
+    Return:
+      str: The SHA, or "" if RECIPE_BASE_DIR isn't a valid repo
+    """
+    base_dir = settings.RECIPE_BASE_DIR
+    sha = file_utils.get_repo_sha(base_dir)
+    cache.set(repo_sha_key(base_dir), sha, timeout=settings.RECIPE_REPO_SHA_UPDATE_INTERVAL / 1000)
+    return sha
+
+def build_payload(recipe):
+    """
+    Reads the steps, scripts and environment of a recipe.
+    Input:
+      recipe[models.Recipe]: The recipe
+    Return:
+      dict: The payload, as described in recipe_payload()
+    """
+    base_file_dir = settings.RECIPE_BASE_DIR
+    environment = {}
+    for env in recipe.environment_vars.all():
+        environment[env.name] = env.value
+
+    prestep_sources = []
+    for prestep in recipe.prestepsources.all():
+        if prestep.filename:
+            contents = file_utils.get_contents(base_file_dir, prestep.filename)
+            if contents:
+                prestep_sources.append(contents)
+
+    steps = []
+    for step in recipe.steps.order_by('position').prefetch_related('step_environment'):
+        step_dict = {
+            'step_num': step.position,
+            'step_position': step.position,
+            'step_name': step.name,
+            'abort_on_failure': step.abort_on_failure,
+            'allowed_to_fail': step.allowed_to_fail,
+            'filename': step.filename,
+            }
+
+        step_env = {
+            'CIVET_STEP_NUM': step.position,
+            'CIVET_STEP_POSITION': step.position,
+            'CIVET_STEP_NAME': step.name,
+            'CIVET_STEP_ABORT_ON_FAILURE': step.abort_on_failure,
+            'CIVET_STEP_ALLOWED_TO_FAIL': step.allowed_to_fail,
+            }
+        for env in step.step_environment.all():
+            step_env[env.name] = env.value
+        step_dict['environment'] = step_env
+
+        if step.filename:
+            contents = file_utils.get_contents(base_file_dir, step.filename)
+            step_dict['script'] = str(contents) # in case of empty file, use str
+
+        steps.append(step_dict)
+
+    return {'environment': environment,
+            'prestep_sources': prestep_sources,
+            'steps': steps,
+            }
+
+def recipe_payload(recipe):
+    """
+    Gets the parts of the job information that only depend on the recipe,
+    building it if it isn't cached.
+    Input:
+      recipe[models.Recipe]: The recipe
+    Return:
+      (dict, str): The payload and the SHA of the recipe repository. The payload has keys:
+        environment[dict]: The environment variables set on the recipe
+        prestep_sources[list]: The contents of the prestep sources
+        steps[list]: A dict for each step, in order. The "filename" key
+          is for the step result and doesn't get sent to the client.
+    """
+    repo_sha = recipe_repo_sha()
+    payload = cache.get(payload_key(recipe.pk, repo_sha))
+    if payload is None:
+        # The cached SHA can be up to RECIPE_REPO_SHA_UPDATE_INTERVAL old while
+        # the files read below are current, so get the SHA they are at.
+        cached_sha = repo_sha
+        repo_sha = update_repo_sha()
+        key = payload_key(recipe.pk, repo_sha)
+        if repo_sha != cached_sha:
+            payload = cache.get(key)
+        if payload is None:
+            logger.info('Building job payload for recipe {}: {} at {}'.format(recipe.pk, recipe, repo_sha[:8]))
+            payload = build_payload(recipe)
+            cache.set(key, payload, timeout=settings.RECIPE_REPO_SHA_UPDATE_INTERVAL / 1000)
+    return payload, repo_sha
@@ -0,0 +1,469 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Index of the jobs that are ready to be claimed by clients.
+
+The ready jobs are stored in the cache as a separate queue for each
+(build config, build key) pair so that clients polling for different
+configs never read or write the same cache entry. The cache is only
+used to find candidate jobs; the claim itself is done atomically in
+the database so a stale queue entry can never be claimed twice.
+
+The queues are kept up to date by calling update_job() or remove_job()
+wherever a job changes state. The queue changes are only made once the
+current transaction commits so that a queue never points at uncommitted
+state. Since those updates aren't locked, the queues are also fully
+rebuilt from the database every GET_JOB_UPDATE_INTERVAL milliseconds to
+reconcile anything that was missed.
+
+The incremental updates are only seen by other server processes if the
+cache is shared between them, so the queues are only used when
+GET_JOB_QUEUE_CACHE is on (see settings.py). Otherwise the candidate jobs
+are read straight from the database for the build configs and build keys
+of the polling client.
+"""
+from __future__ import unicode_literals, absolute_import
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Max
+from datetime import datetime
+from ci import models, TimeUtils
+from ci.client import ReadyJobs, Scheduler
+import bisect
+import time
+import logging
+logger = logging.getLogger('ci')
+
+# Key in the cache that holds the names of all the queues and when they expire
+QUEUES_KEY = 'ready_job_queues'
+
+def queue_key(config_name, build_key):
+    """
+    Key in the cache for the queue of jobs with the given build config and build key.
+    """
+    return 'ready_jobs:{}:{}'.format(config_name, build_key)
+
+def version_key(config_name):
+    """
+    Key in the cache for the counter that is incremented whenever jobs
+    are added to a queue for the build config.
+    """
+    return 'ready_jobs_version:{}'.format(config_name)
+
+def bump_version(config_name):
+    """
+    Lets any clients waiting on the build config know that there might be a new job.
+    """
+    key = version_key(config_name)
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted in between, the waiters will still see the change
+        pass
+
+def queue_versions(build_configs):
+    """
+    Gets the current versions of the queues for the build configs.
+    They change whenever jobs are added to the queues.
+    Without GET_JOB_QUEUE_CACHE this is the number of ready jobs with
+    the build configs and when the last one of them changed.
+    Return:
+      dict: config name -> version
+    """
+    if not settings.GET_JOB_QUEUE_CACHE:
+        ready = (ReadyJobs.ready_jobs_query()
+                .filter(config__name__in=build_configs)
+                .order_by()
+                .aggregate(count=Count('pk'), last_modified=Max('last_modified')))
+        return {'ready': (ready['count'], ready['last_modified'])}
+    keys = [version_key(config_name) for config_name in build_configs]
+    return cache.get_many(keys)
+
+def sort_key(job, current_push=False):
+    """
+    The order in which jobs are handed out within a build config.
+    Normally this is by (-priority, created). Jobs on the current push
+    event of a branch with "auto_cancel_push_events_except_current"
+    come after the rest and are ordered by (created, -priority).
+    """
+    created = job.created.timestamp()
+    if current_push:
+        return (1, created, -job.recipe.priority, job.pk)
+    return (0, -job.recipe.priority, created, job.pk)
+
+def job_entry(job, current_push=False):
+    """
+    The information about a ready job that is stored in a queue.
+    """
+    client_user = job.recipe.client_runner_user
+    build_key = None
+    client_build_key = None
+    if client_user is None:
+        build_key = job.recipe.build_user.build_key
+    else:
+        client_build_key = client_user.build_key
+
+    return {'pk': job.pk,
+            'build_key': build_key,
+            'client_build_key': client_build_key,
+            'client': job.client.name if job.client else None,
+            'sort_key': sort_key(job, current_push),
+            # Used by the Scheduler policies
+            'priority': job.recipe.priority,
+            'created': job.created.timestamp(),
+            'repository_id': job.recipe.repository_id,
+            'repository': str(job.recipe.repository),
+            'build_user_id': job.recipe.build_user_id,
+            'build_user': job.recipe.build_user.name,
+            }
+
+def entry_build_key(entry):
+    """
+    The build key that a client needs to have to run the job in the entry.
+    """
+    if entry['client_build_key'] is not None:
+        return entry['client_build_key']
+    return entry['build_key']
+
+def job_queue_key(job):
+    """
+    Key in the cache for the queue that the job belongs in.
+    """
+    client_user = job.recipe.client_runner_user
+    if client_user is None:
+        return queue_key(job.config.name, job.recipe.build_user.build_key)
+    return queue_key(job.config.name, client_user.build_key)
+
+def is_claimable(job):
+    """
+    Whether the job belongs in a queue. This matches ReadyJobs.ready_jobs_query()
+    """
+    return (not job.complete
+            and job.active
+            and job.ready
+            and job.status == models.JobStatus.NOT_STARTED
+            and job.recipe.client_runner_user is None)
+
+def rebuild_queues():
+    """
+    Rebuilds all the queues from the ready jobs in the database.
+    Return:
+      int: The number of ready jobs
+    """
+    logger.info('Rebuilding ready job queues')
+    queues = {}
+    queue_configs = {}
+    branch_settings = {}
+    ready_jobs = 0
+    for job in ReadyJobs.ready_jobs_query().select_related('event__base', 'recipe__repository__user'):
+        current_push = ReadyJobs.is_current_push_job(job, branch_settings)
+        entry = job_entry(job, current_push)
+        key = queue_key(job.config.name, entry_build_key(entry))
+        queues.setdefault(key, []).append(entry)
+        queue_configs[key] = job.config.name
+        ready_jobs += 1
+
+    for queue in queues.values():
+        queue.sort(key=lambda entry: entry['sort_key'])
+
+    old_state = cache.get(QUEUES_KEY)
+    old_queues = {}
+    if old_state is not None:
+        old_queues = cache.get_many(old_state['queues'])
+        empty_queues = [key for key in old_state['queues'] if key not in queues]
+        cache.delete_many(empty_queues)
+    cache.set_many(queues, timeout=None)
+
+    # Only wake up waiting clients if there are jobs that weren't already queued
+    configs = set()
+    for key, queue in queues.items():
+        old_pks = set([entry['pk'] for entry in old_queues.get(key, [])])
+        if any(entry['pk'] not in old_pks for entry in queue):
+            configs.add(queue_configs[key])
+
+    expires = datetime.now().timestamp() + settings.GET_JOB_UPDATE_INTERVAL / 1000
+    cache.set(QUEUES_KEY, {'expires': expires, 'queues': sorted(queues.keys())}, timeout=None)
+    for config_name in configs:
+        bump_version(config_name)
+
+    logger.info(f'Ready job queues rebuilt with {ready_jobs} ready job(s) in {len(queues)} queue(s)')
+    return ready_jobs
+
+def check_queues():
+    """
+    Rebuilds the queues if they haven't been built yet or if it is time
+    to reconcile them with the database.
+    """
+    state = cache.get(QUEUES_KEY)
+    if state is None:
+        logger.info('Rebuilding ready job queues as they are not yet built')
+        rebuild_queues()
+    elif state['expires'] <= datetime.now().timestamp():
+        logger.info('Rebuilding ready job queues to reconcile with the database')
+        rebuild_queues()
+
+def get_queue(config_name, build_key):
+    """
+    Gets the entries in a single queue.
+    """
+    return cache.get(queue_key(config_name, build_key), [])
+
+def queued_entries(config_name, build_keys):
+    """
+    Gets the queued jobs for a build config across all of the build keys.
+    Return:
+      list[(str, dict)]: (queue key, entry) in the order they should be handed out
+    """
+    keys = [queue_key(config_name, build_key) for build_key in build_keys]
+    entries = []
+    for key, queue in cache.get_many(keys).items():
+        entries.extend([(key, entry) for entry in queue])
+    entries.sort(key=lambda key_entry: key_entry[1]['sort_key'])
+    return entries
+
+def ready_entries(config_name, build_keys):
+    """
+    Gets the ready jobs for a build config across all of the build keys
+    from the database, for when the queues aren't kept in the cache.
+    Return:
+      list[(None, dict)]: Like queued_entries(), without a queue key
+    """
+    jobs = (ReadyJobs.ready_jobs_query()
+            .filter(config__name=config_name, recipe__build_user__build_key__in=build_keys)
+            .select_related('event__base', 'recipe__repository__user'))
+    branch_settings = {}
+    entries = [(None, job_entry(job, ReadyJobs.is_current_push_job(job, branch_settings))) for job in jobs]
+    entries.sort(key=lambda key_entry: key_entry[1]['sort_key'])
+    return entries
+
+def candidate_entries(config_name, build_keys):
+    """
+    Gets the jobs for a build config that a client with the build keys could claim,
+    from the queues if GET_JOB_QUEUE_CACHE is on and from the database otherwise.
+    Return:
+      list[(str, dict)]: (queue key, entry) in the order they should be handed out.
+        The queue key is None when read from the database.
+    """
+    if settings.GET_JOB_QUEUE_CACHE:
+        return queued_entries(config_name, build_keys)
+    return ready_entries(config_name, build_keys)
+
+def remove_from_queue(key, job_pk):
+    """
+    Removes a job from a single queue.
+    There is no lock here; if a concurrent write loses this removal the
+    claim in the database will still refuse the job and it will get
+    removed again.
+    """
+    if key is None:
+        # Not from a queue
+        return
+    queue = cache.get(key)
+    if queue is None:
+        return
+    new_queue = [entry for entry in queue if entry['pk'] != job_pk]
+    if len(new_queue) != len(queue):
+        cache.set(key, new_queue, timeout=None)
+
+def add_to_queue(key, entry):
+    """
+    Adds an entry to a single queue in its sorted position, replacing
+    any existing entry for the same job.
+    Like remove_from_queue(), there is no lock here.
+    """
+    queue = [e for e in cache.get(key, []) if e['pk'] != entry['pk']]
+    sort_keys = [e['sort_key'] for e in queue]
+    queue.insert(bisect.bisect(sort_keys, entry['sort_key']), entry)
+    cache.set(key, queue, timeout=None)
+
+    state = cache.get(QUEUES_KEY)
+    if state is not None and key not in state['queues']:
+        state['queues'] = sorted(state['queues'] + [key])
+        cache.set(QUEUES_KEY, state, timeout=None)
+
+def update_job(job):
+    """
+    Updates the queues after a job has changed state.
+    If the job can be claimed then its entry is added, or moved to
+    its new position. Otherwise it is removed.
+    The update is done once the current transaction commits.
+    Does nothing if GET_JOB_QUEUE_CACHE is off.
+    Input:
+      job[models.Job]: The job that changed
+    """
+    if settings.GET_JOB_QUEUE_CACHE:
+        transaction.on_commit(lambda: _update_job(job))
+
+def _update_job(job):
+    if cache.get(QUEUES_KEY) is None:
+        # The queues will be built with the job on the next poll
+        return
+
+    if not is_claimable(job):
+        remove_from_queue(job_queue_key(job), job.pk)
+        return
+
+    entry = job_entry(job, ReadyJobs.is_current_push_job(job))
+    add_to_queue(job_queue_key(job), entry)
+    bump_version(job.config.name)
+    logger.info(f'Job {job.pk}: {job} added to ready job queue')
+
+def remove_job(job):
+    """
+    Removes a job from the queues.
+    This should be called before changing anything that the queue
+    key depends on, like the recipe. The key is calculated right away
+    but the removal is done once the current transaction commits.
+    Does nothing if GET_JOB_QUEUE_CACHE is off.
+    Input:
+      job[models.Job]: The job to remove
+    """
+    if not settings.GET_JOB_QUEUE_CACHE:
+        return
+    key = job_queue_key(job)
+    job_pk = job.pk
+    transaction.on_commit(lambda: remove_from_queue(key, job_pk))
+
+def entry_matches(job, entry, config_name):
+    """
+    Checks that the queued entry still represents the job in the database.
+    """
+    if (job.status != models.JobStatus.NOT_STARTED
+            or job.complete
+            or not job.active
+            or not job.ready
+            or job.config.name != config_name):
+        return False
+    current = job_entry(job)
+    for key in ['build_key', 'client_build_key', 'client']:
+        if current[key] != entry[key]:
+            return False
+    return True
+
+def take_job(job, client, reserved_until=None):
+    """
+    Atomically takes ownership of a job for a client.
+    On databases that support it, the job row is locked with
+    SELECT ... FOR UPDATE SKIP LOCKED so that clients racing for the
+    same job don't wait on each other. The status change is then done
+    as a conditional update, which is also what makes this safe on
+    databases without row locking (SQLite).
+    Must be called inside a transaction.
+    Input:
+      job[models.Job]: The job to take. Will be updated with the new client and status.
+      client[models.Client]: The client taking the job
+      reserved_until[datetime]: Optional time until which the job is reserved for the client
+    Return:
+      bool: Whether the client now owns the job
+    """
+    available = models.Job.objects.filter(pk=job.pk,
+            complete=False,
+            active=True,
+            ready=True,
+            status=models.JobStatus.NOT_STARTED)
+    if connection.features.has_select_for_update_skip_locked:
+        locked = available.select_for_update(skip_locked=True).values_list('pk', flat=True)
+        if not list(locked):
+            return False
+
+    # Everything that claiming changes on the job is written here
+    now = TimeUtils.get_local_time()
+    if available.update(client=client,
+            status=models.JobStatus.RUNNING,
+            reserved_until=reserved_until,
+            last_modified=now) != 1:
+        return False
+
+    job.client = client
+    job.status = models.JobStatus.RUNNING
+    job.reserved_until = reserved_until
+    job.last_modified = now
+    return True
+
+def claim_job(client, build_keys, build_configs, reserved_until=None):
+    """
+    Finds a ready job for the client and takes ownership of it.
+    The build configs are in order of preference of the client. That is,
+    if any jobs exist with the first config, they take priority. Then the
+    second, and so on. Within a build config the order comes from the
+    policy in settings.JOB_SCHEDULER.
+    Must be called inside a transaction.
+    Input:
+      client[models.Client]: The client looking for a job
+      build_keys[list]: The build keys of the client
+      build_configs[list]: The build configs of the client
+      reserved_until[datetime]: See take_job()
+    Return:
+      (models.Job, int): The claimed job and the build key it was claimed with.
+        (None, None) if no job was claimed.
+    """
+    if settings.GET_JOB_QUEUE_CACHE:
+        check_queues()
+
+    for build_config in build_configs:
+        entries = Scheduler.order_entries(build_config, candidate_entries(build_config, build_keys))
+        for key, entry in entries:
+            # Job has a client set and it's not this one
+            if entry['client'] is not None and entry['client'] != client.name:
+                continue
+
+            job = (models.Job.objects
+                .select_related('config',
+                                'client',
+                                'event',
+                                'recipe__build_user',
+                                'recipe__client_runner_user')
+                .filter(pk=entry['pk'])
+                .first())
+
+            if job is None or not entry_matches(job, entry, build_config):
+                logger.warning(f'Job {entry["pk"]} is in different state than its queue')
+                remove_from_queue(key, entry['pk'])
+                continue
+
+            if not take_job(job, client, reserved_until):
+                # Another client got to it first; it will remove it from the queue
+                logger.info(f'Job {job.pk} was taken by another client')
+                continue
+
+            remove_from_queue(key, job.pk)
+            return job, entry_build_key(entry)
+
+    return None, None
+
+def wait_for_jobs(build_configs, versions, timeout):
+    """
+    Waits for jobs to be added to any of the queues for the build configs.
+    This only checks the versions of the queues, see queue_versions(),
+    so it is cheap to call while holding a long poll request from a client.
+    It never rebuilds the queues; if they need it, that is left to
+    claim_job() on the next request.
+    Input:
+      build_configs[list]: The build configs of the client
+      versions[dict]: The versions of the queues from queue_versions() when the client last looked
+      timeout[float]: Maximum number of seconds to wait
+    Return:
+      bool: True if the queues changed, False if it timed out
+    """
+    end = time.monotonic() + timeout
+    while True:
+        if queue_versions(build_configs) != versions:
+            return True
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(settings.GET_JOB_WAIT_INTERVAL / 1000, remaining))
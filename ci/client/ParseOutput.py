@@ -98,9 +98,10 @@ def set_job_stats(job):
     passed = 0
     failed = 0
     skipped = 0
-    for s in job.step_results.all():
-        output = "\n".join(s.clean_output().split("<br/>"))
-        matches = re.findall(r'>(?P<passed>\d+) passed<.*, .*>(?P<skipped>\d+) skipped<.*, .*>(?P<failed>\d+) failed',
+    for s in job.step_results.prefetch_related("output_chunks"):
+        # The plain output, since rendering the HTML is slow and would get cached for every step
+        output = s.plain_output()
+        matches = re.findall(r'\b(?P<passed>\d+) passed\b.*, .*\b(?P<skipped>\d+) skipped\b.*, .*\b(?P<failed>\d+) failed\b',
                 output, flags=re.IGNORECASE)
         for match in matches:
             passed += int(match[0])
@@ -118,7 +119,7 @@ def set_job_info(job):
     """
     step_result = job.step_results.first()
     if step_result:
-        output = step_result.output
+        output = step_result.get_output()
     else:
         output = ""
 
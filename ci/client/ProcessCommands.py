@@ -30,7 +30,7 @@ def get_output_by_position(job, position):
     """
     Utility function to get the output of a job step result by position
     """
-    return job.step_results.get(position=position).output
+    return job.step_results.get(position=position).get_output()
 
 def get_name_by_position(job, position):
     """
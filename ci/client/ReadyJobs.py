@@ -16,8 +16,11 @@ from __future__ import unicode_literals, absolute_import
 from ci import models
 from django.db.models import Q
 
-def get_ready_jobs():
-    jobs = (models.Job.objects
+def ready_jobs_query():
+    """
+    The query for all the jobs that are available to be claimed by a client.
+    """
+    return (models.Job.objects
           .filter(complete=False,
                   active=True,
                   ready=True,
@@ -29,6 +32,27 @@ def get_ready_jobs():
                           'recipe__build_user')
           .order_by('-recipe__priority', 'created'))
 
+def is_current_push_job(job, branch_settings=None):
+    """
+    Whether the job is on a push event for a branch that has
+    "auto_cancel_push_events_except_current" set. Those jobs
+    are ordered by event creation instead of priority.
+    Input:
+      job[models.Job]: The job to check
+      branch_settings[dict]: If given, used to cache the setting by branch id
+    """
+    if job.event.cause != models.Event.PUSH:
+        return False
+    if branch_settings is None:
+        return job.event.auto_cancel_event_except_current()
+    branch_id = job.event.base.branch_id
+    if branch_id not in branch_settings:
+        branch_settings[branch_id] = job.event.auto_cancel_event_except_current()
+    return branch_settings[branch_id]
+
+def get_ready_jobs():
+    jobs = ready_jobs_query()
+
     ready_jobs = []
     current_push_event_branches = set()
     for job in jobs.all():
@@ -0,0 +1,132 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Policies for the order in which ready jobs are handed out to clients.
+
+The policy is selected with settings.JOB_SCHEDULER, which has the keys:
+  policy: "priority" to order by recipe priority and then creation time
+    or "fair_share" to also share the clients of a build config between
+    repositories (or build users) in proportion to their weights.
+  share_by: "repository" or "build_user", what fair_share shares between
+  weights: dict of repository ("owner/repo") or build user name -> weight.
+    Anything not in here has a weight of 1. A weight of 0 or less means
+    the lowest priority: those jobs only go out when no one else has any.
+  aging: Number of seconds a job has to wait to gain a priority point.
+    0 disables aging.
+
+Jobs on the current push event of a branch with
+"auto_cancel_push_events_except_current" are always handed out after
+the rest, in the order they were created.
+"""
+from __future__ import unicode_literals, absolute_import
+from django.conf import settings
+from django.db.models import Count
+from datetime import datetime
+from ci import models
+
+def scheduler_setting(key, default):
+    return settings.JOB_SCHEDULER.get(key, default)
+
+def aged_sort_key(entry, now):
+    """
+    The sort key of a queued entry with the priority increased by how long it has waited.
+    Input:
+      entry[dict]: The entry from JobQueue
+      now[float]: Current timestamp
+    """
+    sort_key = entry['sort_key']
+    aging = scheduler_setting('aging', 0)
+    if not aging or sort_key[0] != 0:
+        return sort_key
+    waited = max(now - entry['created'], 0)
+    priority = entry['priority'] + waited / aging
+    return (0, -priority) + tuple(sort_key[2:])
+
+def order_by_priority(build_config, entries, now):
+    """
+    Orders by the (aged) priority, then creation time
+    """
+    return sorted(entries, key=lambda key_entry: aged_sort_key(key_entry[1], now))
+
+def running_counts(build_config, share_by):
+    """
+    The number of jobs currently running on the build config.
+    Return:
+      dict: repository or build user id -> number of running jobs
+    """
+    field = 'recipe__repository' if share_by == 'repository' else 'recipe__build_user'
+    counts = (models.Job.objects
+        .filter(config__name=build_config, status=models.JobStatus.RUNNING, complete=False)
+        .values(field)
+        .annotate(count=Count('pk')))
+    return {row[field]: row['count'] for row in counts}
+
+def order_by_fair_share(build_config, entries, now):
+    """
+    Weighted fair share. The next job comes from the repository (or build user)
+    that has the fewest running jobs on the build config relative to its weight.
+    Within a repository the jobs are ordered by order_by_priority().
+    """
+    share_by = scheduler_setting('share_by', 'repository')
+    weights = scheduler_setting('weights', {})
+    ordered = order_by_priority(build_config, entries, now)
+    # Jobs on a current push event still go last
+    current_push = [key_entry for key_entry in ordered if key_entry[1]['sort_key'][0] != 0]
+    ordered = [key_entry for key_entry in ordered if key_entry[1]['sort_key'][0] == 0]
+    counts = running_counts(build_config, share_by)
+
+    groups = {}
+    for position, key_entry in enumerate(ordered):
+        share_id = key_entry[1]['%s_id' % share_by]
+        groups.setdefault(share_id, []).append((position, key_entry))
+
+    def usage(share_id):
+        # Ties go to the group with the best job at the head
+        position, key_entry = groups[share_id][0]
+        weight = weights.get(key_entry[1][share_by], 1)
+        if weight <= 0:
+            # Lowest priority, shared between themselves by the running jobs
+            return (1, counts.get(share_id, 0), position)
+        return (0, counts.get(share_id, 0) / weight, position)
+
+    result = []
+    while groups:
+        share_id = min(groups, key=usage)
+        position, key_entry = groups[share_id].pop(0)
+        result.append(key_entry)
+        counts[share_id] = counts.get(share_id, 0) + 1
+        if not groups[share_id]:
+            del groups[share_id]
+    return result + current_push
+
+POLICIES = {'priority': order_by_priority,
+            'fair_share': order_by_fair_share,
+            }
+
+def order_entries(build_config, entries):
+    """
+    Orders the queued entries of a build config with the policy in settings.JOB_SCHEDULER.
+    Input:
+      build_config[str]: The name of the build config
+      entries[list]: (queue key, entry) as returned by JobQueue.queued_entries()
+    Return:
+      list: The entries in the order that they should be handed out
+    """
+    policy = scheduler_setting('policy', 'priority')
+    if policy not in POLICIES:
+        raise ValueError('Unknown JOB_SCHEDULER policy: {}'.format(policy))
+    if not entries:
+        return entries
+    return POLICIES[policy](build_config, entries, datetime.now().timestamp())
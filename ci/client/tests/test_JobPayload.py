@@ -0,0 +1,130 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import unicode_literals, absolute_import
+from django.conf import settings
+from django.core.cache import cache
+from django.test import override_settings
+from mock import patch
+import time
+from ci.client import JobPayload, views
+from ci.recipe import file_utils
+from ci.tests import utils
+from ci.client.tests import ClientTester
+
+@override_settings(INSTALLED_GITSERVERS=[utils.github_config()])
+class Tests(ClientTester.ClientTester):
+    def create_job(self):
+        user = utils.get_test_user()
+        job = utils.create_job(user=user)
+        utils.create_prestepsource(recipe=job.recipe)
+        step = utils.create_step(recipe=job.recipe)
+        utils.create_step_environment(step=step)
+        utils.create_recipe_environment(recipe=job.recipe)
+        return job
+
+    @patch.object(file_utils, 'get_repo_sha')
+    @patch.object(file_utils, 'get_contents')
+    def test_recipe_payload(self, contents_mock, sha_mock):
+        contents_mock.return_value = 'contents'
+        sha_mock.return_value = '1'*40
+        job = self.create_job()
+
+        payload, sha = JobPayload.recipe_payload(job.recipe)
+        self.assertEqual(sha, '1'*40)
+        self.assertEqual(payload['prestep_sources'], ['contents'])
+        self.assertEqual(len(payload['steps']), 1)
+        self.assertEqual(payload['steps'][0]['script'], 'contents')
+        self.assertEqual(contents_mock.call_count, 2)
+        # Once when nothing is cached and again when building the payload
+        self.assertEqual(sha_mock.call_count, 2)
+
+        # Cached, so no file reads and no git
+        with self.assertNumQueries(0):
+            payload2, sha = JobPayload.recipe_payload(job.recipe)
+        self.assertEqual(payload, payload2)
+        self.assertEqual(contents_mock.call_count, 2)
+        self.assertEqual(sha_mock.call_count, 2)
+
+        # The recipe repo changed and the SHA gets checked again
+        sha_mock.return_value = '2'*40
+        cache.delete(JobPayload.repo_sha_key(settings.RECIPE_BASE_DIR))
+        payload, sha = JobPayload.recipe_payload(job.recipe)
+        self.assertEqual(sha, '2'*40)
+        self.assertEqual(contents_mock.call_count, 4)
+        self.assertEqual(sha_mock.call_count, 4)
+
+    @patch.object(file_utils, 'get_repo_sha')
+    @patch.object(file_utils, 'get_contents')
+    def test_recipe_payload_stale_sha(self, contents_mock, sha_mock):
+        contents_mock.return_value = 'contents'
+        sha_mock.return_value = '1'*40
+        job = self.create_job()
+        JobPayload.recipe_payload(job.recipe)
+
+        # The payload is gone but the old SHA is still cached when the repo changes.
+        # The new scripts have to go with the new SHA.
+        cache.delete(JobPayload.payload_key(job.recipe.pk, '1'*40))
+        sha_mock.return_value = '2'*40
+        contents_mock.return_value = 'new contents'
+        payload, sha = JobPayload.recipe_payload(job.recipe)
+        self.assertEqual(sha, '2'*40)
+        self.assertEqual(payload['prestep_sources'], ['new contents'])
+        self.assertIsNone(cache.get(JobPayload.payload_key(job.recipe.pk, '1'*40)))
+        self.assertEqual(cache.get(JobPayload.payload_key(job.recipe.pk, '2'*40)), payload)
+        self.assertEqual(JobPayload.recipe_repo_sha(), '2'*40)
+
+        # Another process already built the payload for the new SHA
+        cache.set(JobPayload.repo_sha_key(settings.RECIPE_BASE_DIR), '1'*40)
+        contents_mock.reset_mock()
+        payload2, sha = JobPayload.recipe_payload(job.recipe)
+        self.assertEqual(sha, '2'*40)
+        self.assertEqual(payload2, payload)
+        self.assertEqual(contents_mock.call_count, 0)
+
+    @patch.object(file_utils, 'get_repo_sha')
+    @patch.object(file_utils, 'get_contents')
+    def test_recipe_payload_expires(self, contents_mock, sha_mock):
+        contents_mock.return_value = 'contents'
+        # Not a valid repo, so the SHA never changes
+        sha_mock.return_value = ''
+        job = self.create_job()
+        with self.settings(RECIPE_REPO_SHA_UPDATE_INTERVAL=1):
+            JobPayload.recipe_payload(job.recipe)
+            self.assertEqual(contents_mock.call_count, 2)
+            time.sleep(0.01)
+            JobPayload.recipe_payload(job.recipe)
+            self.assertEqual(contents_mock.call_count, 4)
+
+    @patch.object(file_utils, 'get_repo_sha')
+    @patch.object(file_utils, 'get_contents')
+    def test_get_job_info(self, contents_mock, sha_mock):
+        contents_mock.return_value = 'contents'
+        sha_mock.return_value = '1'*40
+        job = self.create_job()
+        data = views.get_job_info(job)
+        job.refresh_from_db()
+        self.assertEqual(job.recipe_repo_sha, '1'*40)
+        self.assertEqual(contents_mock.call_count, 2)
+        self.assertNotIn('filename', data['steps'][0])
+
+        other_job = utils.create_job(recipe=job.recipe, event=utils.create_event(commit1='2345'))
+        other_data = views.get_job_info(other_job)
+        self.assertEqual(contents_mock.call_count, 2)
+        self.assertEqual(sha_mock.call_count, 2)
+        self.assertEqual(other_data['job_id'], other_job.pk)
+        self.assertEqual(other_data['environment']['CIVET_JOB_ID'], other_job.pk)
+        self.assertEqual(other_data['prestep_sources'], data['prestep_sources'])
+        self.assertNotEqual(other_data['steps'][0]['stepresult_id'], data['steps'][0]['stepresult_id'])
+        self.assertEqual(other_data['steps'][0]['environment'], data['steps'][0]['environment'])
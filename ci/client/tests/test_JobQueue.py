@@ -0,0 +1,364 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import unicode_literals, absolute_import
+from django.test import override_settings
+from django.core.cache import cache
+from django.db import connection
+from mock import patch
+from ci import models, views, event
+from ci.client import JobQueue
+from ci.tests import utils
+from ci.client.tests import ClientTester
+
+@override_settings(INSTALLED_GITSERVERS=[utils.github_config()])
+@override_settings(GET_JOB_QUEUE_CACHE=True)
+class Tests(ClientTester.ClientTester):
+    def setUp(self):
+        super(Tests, self).setUp()
+        cache.clear()
+        self.user = utils.get_test_user()
+        self.client_obj = utils.create_client()
+
+    def create_ready_job(self, name, user=None, priority=0, config=None, event=None):
+        if user is None:
+            user = self.user
+        recipe = utils.create_recipe(name=name, user=user)
+        recipe.priority = priority
+        recipe.save()
+        job = utils.create_job(recipe=recipe, user=user, config=config, event=event)
+        utils.update_job(job, ready=True, active=True, status=models.JobStatus.NOT_STARTED)
+        return job
+
+    def update_job(self, job):
+        # The queues are only updated once the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            JobQueue.update_job(job)
+
+    def remove_job(self, job):
+        with self.captureOnCommitCallbacks(execute=True):
+            JobQueue.remove_job(job)
+
+    def test_rebuild_queues(self):
+        other_user = utils.create_user_with_token(name='otherUser')
+        other_config = utils.create_build_config('otherConfig')
+        j0 = self.create_ready_job('recipe0', priority=1)
+        j1 = self.create_ready_job('recipe1', priority=10)
+        j2 = self.create_ready_job('recipe2', user=other_user)
+        j3 = self.create_ready_job('recipe3', config=other_config)
+        self.assertEqual(JobQueue.rebuild_queues(), 4)
+
+        config_name = j0.config.name
+        state = cache.get(JobQueue.QUEUES_KEY)
+        self.assertEqual(len(state['queues']), 3)
+        queue = JobQueue.get_queue(config_name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [j1.pk, j0.pk])
+        queue = JobQueue.get_queue(config_name, other_user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [j2.pk])
+        queue = JobQueue.get_queue(other_config.name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [j3.pk])
+
+        # Entries across build keys are merged in order
+        entries = JobQueue.queued_entries(config_name, [other_user.build_key, self.user.build_key])
+        self.assertEqual([entry['pk'] for key, entry in entries], [j1.pk, j0.pk, j2.pk])
+
+        # Queues that become empty get cleared out
+        utils.update_job(j3, status=models.JobStatus.RUNNING)
+        self.assertEqual(JobQueue.rebuild_queues(), 3)
+        state = cache.get(JobQueue.QUEUES_KEY)
+        self.assertEqual(len(state['queues']), 2)
+        self.assertEqual(JobQueue.get_queue(other_config.name, self.user.build_key), [])
+
+    def test_current_push_order(self):
+        e0 = utils.create_event(user=self.user, cause=models.Event.PUSH)
+        e1 = utils.create_event(user=self.user, cause=models.Event.PUSH, commit1='12345')
+        j0 = self.create_ready_job('recipe0', priority=1, event=e0)
+        j1 = self.create_ready_job('recipe1', priority=10, event=e1)
+        pr_event = utils.create_event(user=self.user, commit1='23456')
+        pr_job = self.create_ready_job('recipe2', priority=5, event=pr_event)
+
+        JobQueue.rebuild_queues()
+        queue = JobQueue.get_queue(j0.config.name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [j1.pk, pr_job.pk, j0.pk])
+
+        repo_name = "%s/%s" % (e0.base.branch.repository.user.name, e0.base.branch.repository.name)
+        branch_name = e0.base.branch.name
+        repo_settings = {repo_name: {"branch_settings":
+            {branch_name: {"auto_cancel_push_events_except_current": True}}}}
+        with self.settings(INSTALLED_GITSERVERS=[utils.github_config(repo_settings=repo_settings)]):
+            JobQueue.rebuild_queues()
+            queue = JobQueue.get_queue(j0.config.name, self.user.build_key)
+            self.assertEqual([entry['pk'] for entry in queue], [pr_job.pk, j0.pk, j1.pk])
+
+            # Updating a single job keeps it in the same place
+            self.update_job(j1)
+            queue = JobQueue.get_queue(j0.config.name, self.user.build_key)
+            self.assertEqual([entry['pk'] for entry in queue], [pr_job.pk, j0.pk, j1.pk])
+
+    def test_take_job(self):
+        job = self.create_ready_job('recipe0')
+        other_client = utils.create_client(name='otherClient')
+        self.assertTrue(JobQueue.take_job(job, self.client_obj))
+        self.assertEqual(job.status, models.JobStatus.RUNNING)
+        self.assertEqual(job.client, self.client_obj)
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.JobStatus.RUNNING)
+        self.assertEqual(job.client, self.client_obj)
+
+        # Only one client can take it
+        job.status = models.JobStatus.NOT_STARTED
+        self.assertFalse(JobQueue.take_job(job, other_client))
+        job.refresh_from_db()
+        self.assertEqual(job.client, self.client_obj)
+
+    def test_take_job_skip_locked(self):
+        job = self.create_ready_job('recipe0')
+        with patch.object(connection.features, 'has_select_for_update_skip_locked', True):
+            self.assertTrue(JobQueue.take_job(job, self.client_obj))
+            self.assertFalse(JobQueue.take_job(job, self.client_obj))
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.JobStatus.RUNNING)
+
+    def test_claim_job(self):
+        j0 = self.create_ready_job('recipe0', priority=1)
+        j1 = self.create_ready_job('recipe1', priority=10)
+        config_name = j0.config.name
+        build_keys = [self.user.build_key]
+
+        job, build_key = JobQueue.claim_job(self.client_obj, build_keys, ['otherConfig'])
+        self.assertIsNone(job)
+        self.assertIsNone(build_key)
+
+        job, build_key = JobQueue.claim_job(self.client_obj, build_keys, [config_name])
+        self.assertEqual(job, j1)
+        self.assertEqual(build_key, self.user.build_key)
+        queue = JobQueue.get_queue(config_name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [j0.pk])
+
+        # Another client took the job but the queue still has it
+        other_client = utils.create_client(name='otherClient')
+        utils.update_job(j0, status=models.JobStatus.RUNNING, client=other_client)
+        job, build_key = JobQueue.claim_job(self.client_obj, build_keys, [config_name])
+        self.assertIsNone(job)
+        self.assertEqual(JobQueue.get_queue(config_name, self.user.build_key), [])
+
+    def test_claim_job_lost_race(self):
+        j0 = self.create_ready_job('recipe0', priority=1)
+        j1 = self.create_ready_job('recipe1', priority=10)
+        JobQueue.rebuild_queues()
+        with patch.object(JobQueue, 'take_job') as mock_take:
+            mock_take.side_effect = [False, True]
+            job, build_key = JobQueue.claim_job(self.client_obj, [self.user.build_key], [j0.config.name])
+            self.assertEqual(job, j0)
+        # The job we lost is left for the client that won to remove
+        queue = JobQueue.get_queue(j0.config.name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [j1.pk])
+
+    def test_client_set(self):
+        job = self.create_ready_job('recipe0')
+        other_client = utils.create_client(name='otherClient')
+        utils.update_job(job, client=other_client)
+        build_keys = [self.user.build_key]
+        build_configs = [job.config.name]
+
+        claimed, build_key = JobQueue.claim_job(self.client_obj, build_keys, build_configs)
+        self.assertIsNone(claimed)
+
+        claimed, build_key = JobQueue.claim_job(other_client, build_keys, build_configs)
+        self.assertEqual(claimed, job)
+        self.assertEqual(claimed.client, other_client)
+
+    def test_update_job(self):
+        j0 = self.create_ready_job('recipe0', priority=1)
+        # Nothing happens until the queues are built
+        self.update_job(j0)
+        self.assertIsNone(cache.get(JobQueue.QUEUES_KEY))
+
+        # Nor before the transaction commits
+        JobQueue.rebuild_queues()
+        config_name = j0.config.name
+        j1 = self.create_ready_job('recipe1', priority=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            JobQueue.update_job(j1)
+            queue = JobQueue.get_queue(config_name, self.user.build_key)
+            self.assertEqual([entry['pk'] for entry in queue], [j0.pk])
+        queue = JobQueue.get_queue(config_name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [j1.pk, j0.pk])
+
+        j2 = self.create_ready_job('recipe2', priority=5)
+        self.update_job(j2)
+        self.update_job(j1)
+        queue = JobQueue.get_queue(config_name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [j1.pk, j2.pk, j0.pk])
+
+        # Updating again doesn't duplicate it
+        self.update_job(j1)
+        queue = JobQueue.get_queue(config_name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [j1.pk, j2.pk, j0.pk])
+
+        # New queues get registered so that they get cleared on rebuild
+        other_config = utils.create_build_config('otherConfig')
+        j3 = self.create_ready_job('recipe3', config=other_config)
+        self.update_job(j3)
+        key = JobQueue.queue_key(other_config.name, self.user.build_key)
+        self.assertIn(key, cache.get(JobQueue.QUEUES_KEY)['queues'])
+        self.assertEqual([entry['pk'] for entry in cache.get(key)], [j3.pk])
+
+        # Jobs that can't be claimed are removed
+        utils.update_job(j2, active=False)
+        self.update_job(j2)
+        queue = JobQueue.get_queue(config_name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [j1.pk, j0.pk])
+
+        self.remove_job(j1)
+        queue = JobQueue.get_queue(config_name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [j0.pk])
+
+        # Jobs for a client runner user don't go in any queue
+        runner_user = utils.create_user_with_token(name='runnerUser')
+        j4 = self.create_ready_job('recipe4')
+        j4.recipe.client_runner_user = runner_user
+        j4.recipe.save()
+        self.update_job(j4)
+        queue = JobQueue.get_queue(config_name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [j0.pk])
+        self.assertIsNone(cache.get(JobQueue.queue_key(config_name, runner_user.build_key)))
+
+    @override_settings(GET_JOB_UPDATE_INTERVAL=60000)
+    def test_state_changes(self):
+        job = self.create_ready_job('recipe0')
+        job.ready = False
+        job.save()
+        JobQueue.rebuild_queues()
+        config_name = job.config.name
+        self.assertEqual(JobQueue.get_queue(config_name, self.user.build_key), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            job.event.make_jobs_ready()
+        queue = JobQueue.get_queue(config_name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [job.pk])
+
+        job.refresh_from_db()
+        with self.captureOnCommitCallbacks(execute=True):
+            job.set_invalidated('Invalidated')
+        self.assertEqual(JobQueue.get_queue(config_name, self.user.build_key), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            job.event.make_jobs_ready()
+        queue = JobQueue.get_queue(config_name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [job.pk])
+
+        job.refresh_from_db()
+        with self.captureOnCommitCallbacks(execute=True):
+            views.set_job_canceled(job, 'Canceled')
+        self.assertEqual(JobQueue.get_queue(config_name, self.user.build_key), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            job.set_invalidated('Invalidated', check_ready=True)
+        queue = JobQueue.get_queue(config_name, self.user.build_key)
+        self.assertEqual([entry['pk'] for entry in queue], [job.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            event.cancel_event(job.event, 'Canceled')
+        self.assertEqual(JobQueue.get_queue(config_name, self.user.build_key), [])
+
+        # A poll doesn't rebuild the queues until the reconcile interval
+        job.refresh_from_db()
+        utils.update_job(job, complete=False, status=models.JobStatus.NOT_STARTED)
+        claimed, build_key = JobQueue.claim_job(self.client_obj, [self.user.build_key], [config_name])
+        self.assertIsNone(claimed)
+        with self.settings(GET_JOB_UPDATE_INTERVAL=0):
+            JobQueue.rebuild_queues()
+            claimed, build_key = JobQueue.claim_job(self.client_obj, [self.user.build_key], [config_name])
+            self.assertEqual(claimed, job)
+
+    def test_wait_for_jobs(self):
+        job = self.create_ready_job('recipe0')
+        JobQueue.rebuild_queues()
+        build_configs = [job.config.name]
+        versions = JobQueue.queue_versions(build_configs)
+        with self.settings(GET_JOB_WAIT_INTERVAL=10):
+            self.assertFalse(JobQueue.wait_for_jobs(build_configs, versions, 0.05))
+
+            other = self.create_ready_job('recipe1')
+            self.update_job(other)
+            self.assertTrue(JobQueue.wait_for_jobs(build_configs, versions, 0.05))
+
+            # Other configs don't wake it up
+            versions = JobQueue.queue_versions(build_configs)
+            other_config = utils.create_build_config('otherConfig')
+            self.update_job(self.create_ready_job('recipe2', config=other_config))
+            self.assertFalse(JobQueue.wait_for_jobs(build_configs, versions, 0.05))
+
+            # The queues need to be rebuilt but waiting doesn't do it
+            versions = JobQueue.queue_versions(build_configs)
+            cache.delete(JobQueue.QUEUES_KEY)
+            with patch.object(JobQueue, 'rebuild_queues') as mock_rebuild:
+                self.assertFalse(JobQueue.wait_for_jobs(build_configs, versions, 0.05))
+                self.assertEqual(mock_rebuild.call_count, 0)
+
+            # The version was evicted before it could be incremented
+            def evicted(key):
+                cache.delete(key)
+                raise ValueError("Key '%s' not found" % key)
+
+            with patch.object(cache, 'incr', side_effect=evicted):
+                JobQueue.bump_version(job.config.name)
+            self.assertTrue(JobQueue.wait_for_jobs(build_configs, versions, 0.05))
+
+    @override_settings(GET_JOB_QUEUE_CACHE=False)
+    def test_claim_job_database(self):
+        j0 = self.create_ready_job('recipe0', priority=1)
+        j1 = self.create_ready_job('recipe1', priority=10)
+        other_user = utils.create_user_with_token(name='otherUser')
+        self.create_ready_job('recipe2', user=other_user, priority=20)
+        config_name = j0.config.name
+
+        # The queues aren't used
+        with self.captureOnCommitCallbacks() as callbacks:
+            JobQueue.update_job(j0)
+            JobQueue.remove_job(j1)
+        self.assertEqual(callbacks, [])
+
+        # Only the jobs for the build keys of the client
+        entries = JobQueue.candidate_entries(config_name, [self.user.build_key])
+        self.assertEqual([(key, entry['pk']) for key, entry in entries], [(None, j1.pk), (None, j0.pk)])
+
+        job, build_key = JobQueue.claim_job(self.client_obj, [self.user.build_key], [config_name])
+        self.assertEqual(job, j1)
+        self.assertEqual(build_key, self.user.build_key)
+        job, build_key = JobQueue.claim_job(self.client_obj, [self.user.build_key], [config_name])
+        self.assertEqual(job, j0)
+        job, build_key = JobQueue.claim_job(self.client_obj, [self.user.build_key], [config_name])
+        self.assertIsNone(job)
+        self.assertIsNone(cache.get(JobQueue.QUEUES_KEY))
+
+    @override_settings(GET_JOB_QUEUE_CACHE=False)
+    def test_wait_for_jobs_database(self):
+        job = self.create_ready_job('recipe0')
+        build_configs = [job.config.name]
+        versions = JobQueue.queue_versions(build_configs)
+        with self.settings(GET_JOB_WAIT_INTERVAL=10):
+            with patch.object(JobQueue, 'rebuild_queues') as mock_rebuild:
+                self.assertFalse(JobQueue.wait_for_jobs(build_configs, versions, 0.05))
+                # Only the versions are checked
+                self.assertEqual(mock_rebuild.call_count, 0)
+
+            self.create_ready_job('recipe1')
+            self.assertTrue(JobQueue.wait_for_jobs(build_configs, versions, 0.05))
+
+            # Other configs don't wake it up
+            versions = JobQueue.queue_versions(build_configs)
+            other_config = utils.create_build_config('otherConfig')
+            self.create_ready_job('recipe2', config=other_config)
+            self.assertFalse(JobQueue.wait_for_jobs(build_configs, versions, 0.05))
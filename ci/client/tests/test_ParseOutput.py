@@ -14,10 +14,11 @@
 # limitations under the License.
 
 from __future__ import unicode_literals, absolute_import
+from django.core.cache import cache
 from ci.client.tests import ClientTester
 from ci.client import ParseOutput
 from ci.tests import utils
-from ci import models
+from ci import models, OutputHTML
 
 class Tests(ClientTester.ClientTester):
     def check_modules(self, job, mods):
@@ -73,3 +74,15 @@ class Tests(ClientTester.ClientTester):
         self.assertEqual(js.passed, 123)
         self.assertEqual(js.skipped, 456)
         self.assertEqual(js.failed, 789)
+        # The output doesn't get rendered as HTML
+        self.assertIsNone(cache.get(OutputHTML.html_key(step_result.pk)))
+
+        # Without color codes, and summed over the steps
+        step_result = utils.create_step_result(job=job, position=1)
+        step_result.output = "1 passed, 2 skipped, 3 failed\nNot a 4 passed, 5 skipped line"
+        step_result.save()
+        ParseOutput.set_job_stats(job)
+        js = models.JobTestStatistics.objects.get()
+        self.assertEqual(js.passed, 124)
+        self.assertEqual(js.skipped, 458)
+        self.assertEqual(js.failed, 792)
@@ -0,0 +1,134 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import unicode_literals, absolute_import
+from django.test import override_settings
+from django.utils import timezone
+from datetime import timedelta
+from ci import models
+from ci.client import JobQueue, Scheduler
+from ci.tests import utils
+from ci.client.tests import ClientTester
+
+def scheduler(policy, **kwargs):
+    settings = {"policy": policy, "share_by": "repository", "weights": {}, "aging": 0}
+    settings.update(kwargs)
+    return override_settings(JOB_SCHEDULER=settings)
+
+@override_settings(INSTALLED_GITSERVERS=[utils.github_config()])
+class Tests(ClientTester.ClientTester):
+    def setUp(self):
+        super(Tests, self).setUp()
+        self.user = utils.get_test_user()
+        self.repo0 = utils.create_repo(name='repo0', user=self.user)
+        self.repo1 = utils.create_repo(name='repo1', user=self.user)
+        self.num_jobs = 0
+
+    def create_ready_job(self, repo, priority=0, age=0):
+        name = 'recipe%s' % self.num_jobs
+        self.num_jobs += 1
+        recipe = utils.create_recipe(name=name, user=self.user, repo=repo)
+        recipe.priority = priority
+        recipe.save()
+        job = utils.create_job(recipe=recipe, user=self.user)
+        job.created = timezone.now() - timedelta(seconds=age)
+        utils.update_job(job, ready=True, active=True, status=models.JobStatus.NOT_STARTED)
+        return job
+
+    def ordered(self, config_name):
+        JobQueue.rebuild_queues()
+        entries = JobQueue.queued_entries(config_name, [self.user.build_key])
+        return [entry['pk'] for key, entry in Scheduler.order_entries(config_name, entries)]
+
+    def test_priority(self):
+        j0 = self.create_ready_job(self.repo0, priority=10, age=1)
+        j1 = self.create_ready_job(self.repo0, priority=5, age=100)
+        j2 = self.create_ready_job(self.repo1, priority=5, age=50)
+        config_name = j0.config.name
+        with scheduler("priority"):
+            self.assertEqual(self.ordered(config_name), [j0.pk, j1.pk, j2.pk])
+
+        # j1 has waited long enough to get to priority 15
+        with scheduler("priority", aging=10):
+            self.assertEqual(self.ordered(config_name), [j1.pk, j0.pk, j2.pk])
+
+        with scheduler("foo"):
+            with self.assertRaises(ValueError):
+                self.ordered(config_name)
+
+    def test_fair_share(self):
+        # A burst of jobs on repo0
+        burst = [self.create_ready_job(self.repo0, priority=10) for i in range(4)]
+        other = [self.create_ready_job(self.repo1) for i in range(2)]
+        config_name = burst[0].config.name
+        with scheduler("priority"):
+            self.assertEqual(self.ordered(config_name), [j.pk for j in burst + other])
+
+        with scheduler("fair_share"):
+            self.assertEqual(self.ordered(config_name),
+                    [burst[0].pk, other[0].pk, burst[1].pk, other[1].pk, burst[2].pk, burst[3].pk])
+
+        with scheduler("fair_share", weights={str(self.repo0): 2}):
+            self.assertEqual(self.ordered(config_name),
+                    [burst[0].pk, other[0].pk, burst[1].pk, burst[2].pk, other[1].pk, burst[3].pk])
+
+        # Running jobs count against the repository
+        utils.update_job(burst[0], status=models.JobStatus.RUNNING)
+        with scheduler("fair_share"):
+            self.assertEqual(self.ordered(config_name),
+                    [other[0].pk, burst[1].pk, other[1].pk, burst[2].pk, burst[3].pk])
+
+        # All the jobs have the same build user
+        with scheduler("fair_share", share_by="build_user"):
+            self.assertEqual(self.ordered(config_name), [j.pk for j in burst[1:] + other])
+
+    def test_fair_share_no_weight(self):
+        burst = [self.create_ready_job(self.repo0, priority=10) for i in range(2)]
+        other = [self.create_ready_job(self.repo1) for i in range(2)]
+        config_name = burst[0].config.name
+        # Weights of 0 or less go after everyone else
+        for weight in [0, -1]:
+            with scheduler("fair_share", weights={str(self.repo0): weight}):
+                self.assertEqual(self.ordered(config_name), [j.pk for j in other + burst])
+
+        # And still get shared between themselves
+        with scheduler("fair_share", weights={str(self.repo0): 0, str(self.repo1): 0}):
+            self.assertEqual(self.ordered(config_name),
+                    [burst[0].pk, other[0].pk, burst[1].pk, other[1].pk])
+
+    def test_fair_share_current_push(self):
+        j0 = self.create_ready_job(self.repo0)
+        push_event = utils.create_event(user=self.user, cause=models.Event.PUSH, commit1='3456')
+        push_job = self.create_ready_job(self.repo1)
+        push_job.event = push_event
+        push_job.save()
+        j1 = self.create_ready_job(self.repo0)
+
+        repo = push_event.base.branch.repository
+        repo_settings = {str(repo): {"branch_settings":
+            {push_event.base.branch.name: {"auto_cancel_push_events_except_current": True}}}}
+        with self.settings(INSTALLED_GITSERVERS=[utils.github_config(repo_settings=repo_settings)]):
+            with scheduler("fair_share"):
+                self.assertEqual(self.ordered(j0.config.name), [j0.pk, j1.pk, push_job.pk])
+
+    def test_claim_job(self):
+        burst = [self.create_ready_job(self.repo0, priority=10) for i in range(2)]
+        other = self.create_ready_job(self.repo1)
+        client = utils.create_client()
+        config_name = other.config.name
+        with scheduler("fair_share"):
+            job, build_key = JobQueue.claim_job(client, [self.user.build_key], [config_name])
+            self.assertEqual(job, burst[0])
+            job, build_key = JobQueue.claim_job(client, [self.user.build_key], [config_name])
+            self.assertEqual(job, other)
@@ -18,13 +18,13 @@ from django.test import override_settings
 from django.conf import settings
 import  time
 from ci import models
-from ci.client import views
+from ci.client import views, JobQueue
 from ci.tests import utils
 from ci.client.tests import ClientTester
 from django.core.cache import cache
 
 @override_settings(INSTALLED_GITSERVERS=[utils.github_config()])
-@override_settings(GET_JOB_UPDATE_INTERVAL=5000)
+@override_settings(GET_JOB_UPDATE_INTERVAL=5000, GET_JOB_QUEUE_CACHE=True)
 class Tests(ClientTester.ClientTester):
     def setUp(self):
         super(ClientTester.ClientTester, self).setUp()
@@ -39,8 +39,8 @@ class Tests(ClientTester.ClientTester):
                                                            self.build_keys,
                                                            self.build_configs)[0]
 
-        self.cached_jobs_key = 'cached_jobs'
-        self.get_cached_jobs = lambda: cache.get(self.cached_jobs_key)
+        self.get_queues_state = lambda: cache.get(JobQueue.QUEUES_KEY)
+        cache.clear()
 
         self.event_counter = 0
 
@@ -55,22 +55,22 @@ class Tests(ClientTester.ClientTester):
         return job
 
     def test_cached(self):
-        # Should have no cache at this point
-        cached_jobs = self.get_cached_jobs()
-        self.assertIsNone(cached_jobs)
+        # Should have no queues at this point
+        self.assertIsNone(self.get_queues_state())
 
         # Nothing available
         self.assertIsNone(self.get_cached_job())
-        cached_jobs = self.get_cached_jobs()
-        self.assertIsNotNone(cached_jobs)
-        cached_jobs_expires = cached_jobs.get('expires')
+        state = self.get_queues_state()
+        self.assertIsNotNone(state)
+        self.assertEqual(state['queues'], [])
+        queues_expire = state.get('expires')
 
         # Create a job
         job = self.create_ready_job()
 
         # Should still be nothing available
-        cached_jobs = self.get_cached_jobs()
-        self.assertEqual(cached_jobs['expires'], cached_jobs_expires)
+        state = self.get_queues_state()
+        self.assertEqual(state['expires'], queues_expire)
         self.assertIsNone(self.get_cached_job())
 
         # Eventually a job should be available
@@ -79,14 +79,17 @@ class Tests(ClientTester.ClientTester):
             get_job = self.get_cached_job()
 
             if get_job is not None:
-                cached_jobs = self.get_cached_jobs()
-                self.assertNotEqual(cached_jobs.get('expires'), cached_jobs_expires)
+                state = self.get_queues_state()
+                self.assertNotEqual(state.get('expires'), queues_expire)
                 get_job_again = self.get_cached_job()
                 self.assertIsNone(get_job_again)
                 break
         self.assertGreater(i, 0)
         self.assertIsNotNone(get_job)
         self.assertEqual(get_job.pk, job.pk)
+        get_job.refresh_from_db()
+        self.assertEqual(get_job.status, models.JobStatus.RUNNING)
+        self.assertEqual(get_job.client, self.client)
 
     def test_config_priority(self):
         other_build_config = utils.create_build_config('testOtherBuildConfig')
@@ -101,25 +104,23 @@ class Tests(ClientTester.ClientTester):
         self.assertEqual(second_job.config, other_build_config)
 
         # Should get the second job first, even though it was added second
-        for i in range(self.poll_time):
-            job, _, _ = views.get_cached_job(self.client, self.build_keys, build_configs)
-
-            if job is not None:
-                self.assertEqual(other_build_config, job.config)
-                break
-        self.assertGreater(i, 0)
+        JobQueue.rebuild_queues()
+        job, _, _ = views.get_cached_job(self.client, self.build_keys, build_configs)
+        self.assertEqual(other_build_config, job.config)
+        job, _, _ = views.get_cached_job(self.client, self.build_keys, build_configs)
+        self.assertEqual(first_job, job)
 
     def test_job_changed(self):
         def check(before_action, after_action, modify_job=None):
-            cached_jobs = views.update_cached_jobs()
-            self.assertEqual(len(cached_jobs['jobs_by_config']), 0)
+            JobQueue.rebuild_queues()
+            self.assertEqual(self.get_queues_state()['queues'], [])
             job = self.create_ready_job()
             if modify_job is not None:
                 modify_job(job)
-            cached_jobs = views.update_cached_jobs()
-            self.assertEqual(len(cached_jobs['jobs_by_config']), 1)
-            self.assertIn(self.build_configs[0], cached_jobs['jobs_by_config'])
-            jobs = cached_jobs['jobs_by_config'][self.build_configs[0]]
+            JobQueue.rebuild_queues()
+            key = JobQueue.queue_key(self.build_configs[0], self.user.build_key)
+            self.assertEqual(self.get_queues_state()['queues'], [key])
+            jobs = JobQueue.get_queue(self.build_configs[0], self.user.build_key)
             self.assertEqual(len(jobs), 1)
             self.assertEqual(jobs[0]['pk'], job.pk)
 
@@ -127,10 +128,17 @@ class Tests(ClientTester.ClientTester):
             before_action(job, state)
             get_job = self.get_cached_job()
             self.assertIsNone(get_job)
+            # The stale entry gets dropped from the queue
+            self.assertEqual(JobQueue.get_queue(self.build_configs[0], self.user.build_key), [])
             after_action(job, state)
+            JobQueue.rebuild_queues()
             get_job = self.get_cached_job()
             self.assertIsNotNone(get_job)
-            self.assertEqual(cached_jobs['jobs_by_config'][self.build_configs[0]][0]['pk'], job.pk)
+            self.assertEqual(get_job.pk, job.pk)
+            job.refresh_from_db()
+            job.status = models.JobStatus.SUCCESS
+            job.complete = True
+            job.save()
 
         def set_running(job, state):
             job.status = models.JobStatus.RUNNING
@@ -157,17 +165,21 @@ class Tests(ClientTester.ClientTester):
         def change_back_build_key(job, state):
             self.user.build_key = state['build_key']
             self.user.save()
-        check(change_build_config, change_back_build_config)
+        check(change_build_key, change_back_build_key)
 
+        other_client = utils.create_client(name='otherClient')
         def set_client(job, state):
-            job.client = self.client
+            job.client = other_client
             job.save()
         def remove_client(job, state):
             job.client = None
             job.save()
         check(set_client, remove_client)
 
+        def set_own_client(job, state):
+            job.client = self.client
+            job.save()
         def modify_job(job):
             job.client = self.client
             job.save()
-        check(remove_client, set_client, modify_job)
+        check(remove_client, set_own_client, modify_job)
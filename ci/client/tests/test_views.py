@@ -17,10 +17,14 @@ from __future__ import unicode_literals, absolute_import
 from django.urls import reverse
 from django.http import HttpResponseNotAllowed, HttpResponseBadRequest
 from django.test import override_settings
-import json
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.core.cache import cache
+import gzip, json, sqlite3
+from datetime import timedelta
 from mock import patch
-from ci import models, Permissions
-from ci.client import views
+from ci import models, Permissions, OutputSearch, TimeUtils
+from ci.client import views, JobQueue
 from ci.recipe import file_utils
 from ci.tests import utils
 from ci.github.api import GitHubAPI
@@ -209,6 +213,66 @@ class Tests(ClientTester.ClientTester):
         self.assertNotEqual(data, None)
         self.assertTrue(isinstance(response, HttpResponseBadRequest))
 
+    def test_check_post_gzip(self):
+        body = json.dumps({'foo': 'bar' * 100}).encode('utf-8')
+        def gzip_request(data, encoding='gzip'):
+            return self.factory.post('/', data, content_type='application/json', HTTP_CONTENT_ENCODING=encoding)
+
+        data, response = views.check_post(gzip_request(gzip.compress(body)), ['foo'])
+        self.assertIsNone(response)
+        self.assertEqual(data, {'foo': 'bar' * 100})
+
+        data, response = views.check_post(gzip_request(body, 'identity'), ['foo'])
+        self.assertIsNone(response)
+        self.assertEqual(data, {'foo': 'bar' * 100})
+
+        # Not gzip data
+        data, response = views.check_post(gzip_request(body), ['foo'])
+        self.assertEqual(response.status_code, 400)
+        # Truncated
+        data, response = views.check_post(gzip_request(gzip.compress(body)[:-10]), ['foo'])
+        self.assertEqual(response.status_code, 400)
+
+        data, response = views.check_post(gzip_request(body, 'br'), ['foo'])
+        self.assertEqual(response.status_code, 415)
+
+        with self.settings(CLIENT_MAX_DECOMPRESSED_SIZE=len(body)):
+            data, response = views.check_post(gzip_request(gzip.compress(body)), ['foo'])
+            self.assertIsNone(response)
+        with self.settings(CLIENT_MAX_DECOMPRESSED_SIZE=len(body) - 1):
+            data, response = views.check_post(gzip_request(gzip.compress(body)), ['foo'])
+            self.assertEqual(response.status_code, 413)
+            self.assertIsNone(data)
+
+    def test_step_result_gzip(self):
+        user = utils.get_test_user()
+        job = utils.create_job(user=user)
+        result = utils.create_step_result(job=job)
+        client = utils.create_client()
+        job.client = client
+        job.status = models.JobStatus.RUNNING
+        job.save()
+        post_data = {'step_num': result.position, 'output': 'output\n' * 1000, 'time': 5,
+                'complete': False, 'exit_status': 0}
+        body = gzip.compress(json.dumps(post_data).encode('utf-8'))
+
+        url = reverse('ci:client:update_step_result', args=[user.build_key, client.name, result.pk])
+        response = self.client.post(url, body, content_type='application/json', HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Encoding'], 'gzip')
+        self.assertEqual(result.get_output(), 'output\n' * 1000)
+
+        # The messages in a batch aren't decompressed again
+        message = {'path': url, 'payload': post_data}
+        body = gzip.compress(json.dumps({'messages': [message]}).encode('utf-8'))
+        response = self.client.post(reverse('ci:client:post_messages'), body,
+                content_type='application/json', HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.json()['replies'][0]['status_code'], 200)
+        self.assertEqual(result.get_output(), 'output\n' * 2000)
+
+        response = self.client.post(reverse('ci:client:client_ping', args=[client.name]))
+        self.assertEqual(response['Accept-Encoding'], 'gzip')
+
     @patch.object(file_utils, 'get_contents')
     def test_get_job_info(self, contents_mock):
         with utils.RecipeDir():
@@ -233,6 +297,30 @@ class Tests(ClientTester.ClientTester):
             self.assertIn('prestep_sources', data)
             self.assertIn('steps', data)
 
+    @patch.object(file_utils, 'get_contents')
+    def test_get_job_info_num_queries(self, contents_mock):
+        contents_mock.return_value = 'contents'
+        user = utils.get_test_user()
+        num_queries = []
+        for num_steps in [1, 20]:
+            recipe = utils.create_recipe(name='recipe%s' % num_steps, user=user)
+            for i in range(num_steps):
+                utils.create_step(name='step%s' % i, recipe=recipe, position=i)
+            job = utils.create_job(recipe=recipe, user=user)
+            # Fill the payload cache
+            views.get_job_info(job)
+            with CaptureQueriesContext(connection) as queries:
+                data = views.get_job_info(job)
+            num_queries.append(len(queries))
+            self.assertEqual(len(data['steps']), num_steps)
+            step_results = list(job.step_results.order_by('position'))
+            self.assertEqual([step['stepresult_id'] for step in data['steps']],
+                    [result.pk for result in step_results])
+            self.assertEqual([result.name for result in step_results],
+                    ['step%s' % i for i in range(num_steps)])
+        # Doesn't depend on the number of steps
+        self.assertEqual(num_queries[0], num_queries[1])
+
     def test_get_job(self):
         user = utils.get_test_user()
         url = reverse('ci:client:get_job')
@@ -302,6 +390,8 @@ class Tests(ClientTester.ClientTester):
         job.event.save()
         job.event.pull_request.status = models.JobStatus.SUCCESS
         job.event.pull_request.save()
+        JobQueue.update_job(job)
+        JobQueue.update_job(job2)
 
         # valid job, should be ok, shouldn't update the status since
         # there is a newer event
@@ -328,6 +418,7 @@ class Tests(ClientTester.ClientTester):
         client = utils.create_client(name='old_client')
         job.client = client
         job.save()
+        JobQueue.update_job(job)
 
         # pull from previous client, should get other job
         self.set_counts()
@@ -356,6 +447,275 @@ class Tests(ClientTester.ClientTester):
             self.assertEqual(j.status, models.JobStatus.RUNNING)
             self.assertEqual(j.event.status, models.JobStatus.RUNNING)
 
+    def test_get_jobs(self):
+        user = utils.get_test_user()
+        url = reverse('ci:client:get_jobs')
+        other_config = utils.create_build_config('otherConfig')
+        jobs = []
+        for i in range(3):
+            recipe = utils.create_recipe(name='recipe%s' % i, user=user)
+            jobs.append(utils.create_job(recipe=recipe, user=user))
+        recipe = utils.create_recipe(name='recipe3', user=user)
+        jobs.append(utils.create_job(recipe=recipe, user=user, config=other_config))
+        for job in jobs:
+            utils.update_job(job, ready=True, active=True, status=models.JobStatus.NOT_STARTED)
+        config = jobs[0].config
+
+        post_data = {'client_name': 'testClient',
+                     'build_keys': [user.build_key],
+                     'build_configs': [config.name, other_config.name],
+                     'max_jobs': 0,
+                     }
+
+        # only post allowed
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 405)
+
+        # bad values
+        self.set_counts()
+        response = self.client_post_json(url, post_data)
+        self.compare_counts()
+        self.assertEqual(response.status_code, 400)
+        post_data['max_jobs'] = 3
+        post_data['slots'] = {config.name: 'foo'}
+        response = self.client_post_json(url, post_data)
+        self.assertEqual(response.status_code, 400)
+
+        # Only 2 from the first config
+        post_data['slots'] = {config.name: 2}
+        self.set_counts()
+        response = self.client_post_json(url, post_data)
+        self.compare_counts(num_clients=1, active_branches=1)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['status'], 'OK')
+        claimed = [job['job_id'] for job in data['jobs']]
+        self.assertEqual(len(claimed), 3)
+        self.assertIn(jobs[3].pk, claimed)
+        for job in data['jobs']:
+            self.assertEqual(job['job_info']['job_id'], job['job_id'])
+            self.assertEqual(job['build_key'], user.build_key)
+        client = models.Client.objects.get(name='testClient')
+        self.assertEqual(client.status, models.Client.RUNNING)
+        self.assertEqual(models.Job.objects.filter(client=client, status=models.JobStatus.RUNNING).count(), 3)
+
+        # Jobs the client is still running aren't canceled
+        post_data['running'] = claimed[:2]
+        response = self.client_post_json(url, post_data)
+        data = response.json()
+        self.assertEqual(len(data['jobs']), 1)
+        claimed_job = models.Job.objects.get(pk=claimed[2])
+        self.assertEqual(claimed_job.status, models.JobStatus.CANCELED)
+        for job_id in claimed[:2]:
+            self.assertEqual(models.Job.objects.get(pk=job_id).status, models.JobStatus.RUNNING)
+
+    @override_settings(GET_JOB_WAIT_INTERVAL=10, GET_JOB_MAX_WAIT=60000)
+    def test_get_job_wait(self):
+        user = utils.get_test_user()
+        url = reverse('ci:client:get_job')
+        job = utils.create_job(user=user)
+        post_data = {'client_name': 'testClient',
+                     'build_keys': [user.build_key],
+                     'build_configs': [job.config.name],
+                     'wait': 'foo'}
+
+        # bad wait value
+        self.set_counts()
+        response = self.client_post_json(url, post_data)
+        self.compare_counts()
+        self.assertEqual(response.status_code, 400)
+
+        # nothing becomes ready
+        post_data['wait'] = 0.05
+        with patch.object(JobQueue, 'rebuild_queues') as mock_rebuild:
+            response = self.client_post_json(url, post_data)
+            # The waiting request only checks whether jobs were added
+            self.assertEqual(mock_rebuild.call_count, 0)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['job_id'], None)
+
+        # With the cached queues only the first look rebuilds them, not every check while waiting
+        with self.settings(GET_JOB_QUEUE_CACHE=True):
+            cache.delete(JobQueue.QUEUES_KEY)
+            with patch.object(JobQueue, 'rebuild_queues') as mock_rebuild:
+                response = self.client_post_json(url, post_data)
+                self.assertEqual(mock_rebuild.call_count, 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['job_id'], None)
+
+        # job becomes ready while waiting
+        def make_ready(build_configs, versions, timeout):
+            utils.update_job(job, ready=True, active=True, status=models.JobStatus.NOT_STARTED)
+            JobQueue.update_job(job)
+            return True
+
+        post_data['wait'] = 10
+        with patch.object(JobQueue, 'wait_for_jobs', side_effect=make_ready) as mock_wait:
+            response = self.client_post_json(url, post_data)
+            self.assertEqual(mock_wait.call_count, 1)
+            self.assertLessEqual(mock_wait.call_args[0][2], 10)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['job_id'], job.pk)
+
+        # the wait is limited by the server
+        post_data['wait'] = 100
+        with self.settings(GET_JOB_MAX_WAIT=1000):
+            with patch.object(JobQueue, 'wait_for_jobs', return_value=False) as mock_wait:
+                response = self.client_post_json(url, post_data)
+                self.assertEqual(response.json()['job_id'], None)
+                self.assertLessEqual(mock_wait.call_args[0][2], 1)
+
+        # long polling is off by default
+        post_data['wait'] = 10
+        with self.settings(GET_JOB_MAX_WAIT=0):
+            with patch.object(JobQueue, 'wait_for_jobs', return_value=False) as mock_wait:
+                response = self.client_post_json(url, post_data)
+                self.assertEqual(response.json()['job_id'], None)
+                self.assertEqual(mock_wait.call_count, 0)
+
+        # too many requests are already waiting
+        with self.settings(GET_JOB_MAX_WAITERS=1):
+            self.assertTrue(views.start_waiting())
+            try:
+                with patch.object(JobQueue, 'wait_for_jobs', return_value=False) as mock_wait:
+                    response = self.client_post_json(url, post_data)
+                    self.assertEqual(response.json()['job_id'], None)
+                    self.assertEqual(mock_wait.call_count, 0)
+            finally:
+                views.stop_waiting()
+            # and the waiters are released after waiting
+            with patch.object(JobQueue, 'wait_for_jobs', return_value=False) as mock_wait:
+                response = self.client_post_json(url, post_data)
+                self.assertEqual(mock_wait.call_count, 1)
+                response = self.client_post_json(url, post_data)
+                self.assertEqual(mock_wait.call_count, 2)
+
+    def test_get_job_reserve(self):
+        user = utils.get_test_user()
+        url = reverse('ci:client:get_job')
+        jobs = []
+        for i in range(2):
+            recipe = utils.create_recipe(name='recipe%s' % i, user=user)
+            job = utils.create_job(recipe=recipe, user=user)
+            utils.update_job(job, ready=True, active=True, status=models.JobStatus.NOT_STARTED)
+            jobs.append(job)
+        post_data = {'client_name': 'testClient',
+                     'build_keys': [user.build_key],
+                     'build_configs': [jobs[0].config.name],
+                     'reserve': 'foo'}
+
+        # bad values
+        response = self.client_post_json(url, post_data)
+        self.assertEqual(response.status_code, 400)
+        post_data['reserve'] = False
+        post_data['running'] = 1
+        response = self.client_post_json(url, post_data)
+        self.assertEqual(response.status_code, 400)
+
+        del post_data['running']
+        response = self.client_post_json(url, post_data)
+        first_id = response.json()['job_id']
+        self.assertIsNotNone(first_id)
+        self.assertIsNone(models.Job.objects.get(pk=first_id).reserved_until)
+
+        # Claimed while the first job is finishing
+        post_data['reserve'] = True
+        post_data['running'] = [first_id]
+        response = self.client_post_json(url, post_data)
+        self.assertEqual(response.status_code, 200)
+        second_id = response.json()['job_id']
+        self.assertNotIn(second_id, [None, first_id])
+        first = models.Job.objects.get(pk=first_id)
+        second = models.Job.objects.get(pk=second_id)
+        self.assertEqual(first.status, models.JobStatus.RUNNING)
+        self.assertEqual(second.status, models.JobStatus.RUNNING)
+        self.assertEqual(second.client.name, 'testClient')
+        self.assertIsNotNone(second.reserved_until)
+        self.assertEqual(second.client.status, models.Client.RUNNING)
+
+        # Starting the job ends the reservation
+        result = utils.create_step_result(job=second)
+        step_url = reverse('ci:client:start_step_result', args=[user.build_key, 'testClient', result.pk])
+        step_data = {'step_num': result.position, 'output': '', 'time': 0, 'complete': False, 'exit_status': 0}
+        response = self.client_post_json(step_url, step_data)
+        self.assertEqual(response.status_code, 200)
+        second.refresh_from_db()
+        self.assertIsNone(second.reserved_until)
+
+        # The reservation expired before the client started the job
+        result.status = models.JobStatus.NOT_STARTED
+        result.save()
+        second.reserved_until = TimeUtils.get_local_time() - timedelta(seconds=1)
+        second.save()
+        post_data = {'client_name': 'otherClient',
+                     'build_keys': [user.build_key],
+                     'build_configs': [jobs[0].config.name]}
+        response = self.client_post_json(url, post_data)
+        self.assertEqual(response.json()['job_id'], second_id)
+        second.refresh_from_db()
+        # Released like the client gave it back, not invalidated
+        self.assertFalse(second.invalidated)
+        self.assertIsNone(second.reserved_until)
+        self.assertEqual(second.client.name, 'otherClient')
+        self.assertEqual(models.JobChangeLog.objects.filter(job=second).count(), 0)
+
+    def test_release_job(self):
+        user = utils.get_test_user()
+        job = utils.create_job(user=user)
+        utils.update_job(job, ready=True, active=True, status=models.JobStatus.NOT_STARTED)
+        get_url = reverse('ci:client:get_job')
+        post_data = {'client_name': 'testClient',
+                     'build_keys': [user.build_key],
+                     'build_configs': [job.config.name],
+                     'reserve': True}
+        url = reverse('ci:client:release_job', args=[user.build_key, 'testClient', job.pk])
+
+        # only post allowed
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 405)
+
+        # unknown client
+        response = self.client_post_json(url, {})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client_post_json(get_url, post_data)
+        self.assertEqual(response.json()['job_id'], job.pk)
+
+        # bad build key
+        bad_url = reverse('ci:client:release_job', args=[user.build_key + 1, 'testClient', job.pk])
+        response = self.client_post_json(bad_url, {})
+        self.assertEqual(response.status_code, 400)
+
+        # Already started
+        result = utils.create_step_result(job=job)
+        result.status = models.JobStatus.RUNNING
+        result.save()
+        response = self.client_post_json(url, {})
+        self.assertEqual(response.status_code, 400)
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.JobStatus.RUNNING)
+
+        result.status = models.JobStatus.NOT_STARTED
+        result.save()
+        self.set_counts()
+        response = self.client_post_json(url, {})
+        # The branch isn't running anything now
+        self.compare_counts(active_branches=-1)
+        self.assertEqual(response.status_code, 200)
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.JobStatus.NOT_STARTED)
+        self.assertIsNone(job.client)
+        self.assertIsNone(job.reserved_until)
+
+        # Not running anymore
+        response = self.client_post_json(url, {})
+        self.assertEqual(response.status_code, 400)
+
+        # Another client can get it
+        post_data['client_name'] = 'otherClient'
+        response = self.client_post_json(get_url, post_data)
+        self.assertEqual(response.json()['job_id'], job.pk)
+
     def test_job_finished_status(self):
         user = utils.get_test_user()
         recipe = utils.create_recipe(user=user)
@@ -686,6 +1046,16 @@ class Tests(ClientTester.ClientTester):
         self.assertEqual(data["command"], None)
         result.refresh_from_db()
         self.assertEqual(result.status, models.JobStatus.RUNNING)
+        self.assertEqual(result.output, '')
+        self.assertEqual(result.get_output(), 'output')
+
+        # More output gets appended as a new chunk
+        post_data['output'] = 'more'
+        response = self.client_post_json(url, post_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(result.output_chunks.count(), 2)
+        self.assertEqual(result.get_output(), 'outputmore')
+        self.assertEqual(result.output_length(), 10)
 
         # test when the user invalidates a job while it is running
         job.status = models.JobStatus.NOT_STARTED
@@ -756,6 +1126,84 @@ class Tests(ClientTester.ClientTester):
 
         return reverse('ci:client:complete_step_result', args=[build_key, name, pk])
 
+    def test_post_messages(self):
+        user = utils.get_test_user()
+        job = utils.create_job(user=user)
+        result = utils.create_step_result(job=job)
+        client = utils.create_client()
+        job.client = client
+        job.status = models.JobStatus.RUNNING
+        job.save()
+
+        def step_data(output, complete=False):
+            return {'step_num': result.position, 'output': output, 'time': 5, 'complete': complete, 'exit_status': 0}
+        def message(name, data, pk=result.pk):
+            return {'path': reverse('ci:client:%s' % name, args=[user.build_key, client.name, pk]), 'payload': data}
+
+        url = reverse('ci:client:post_messages')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 405)
+        response = self.client_post_json(url, {'foo': []})
+        self.assertEqual(response.status_code, 400)
+        response = self.client_post_json(url, {'messages': {}})
+        self.assertEqual(response.status_code, 400)
+        response = self.client_post_json(url, {'messages': [1]})
+        self.assertEqual(response.status_code, 400)
+        with self.settings(CLIENT_MAX_BATCH_MESSAGES=1):
+            response = self.client_post_json(url, {'messages': [{}, {}]})
+            self.assertEqual(response.status_code, 400)
+
+        messages = [message('start_step_result', step_data('')),
+                message('update_step_result', step_data('out1')),
+                message('update_step_result', step_data('out2')),
+                ]
+        response = self.client_post_json(url, {'messages': messages})
+        self.assertEqual(response.status_code, 200)
+        replies = response.json()['replies']
+        self.assertEqual(replies, [{'status_code': 200, 'reply': {'status': 'OK', 'message': 'success', 'command': None}}]*3)
+        result.refresh_from_db()
+        self.assertEqual(result.status, models.JobStatus.RUNNING)
+        self.assertEqual(result.get_output(), 'out1out2')
+
+        # Handling stops at the first message the client would stop on
+        messages = [message('update_step_result', step_data('out3')),
+                message('update_step_result', step_data('bad'), pk=0),
+                message('update_step_result', step_data('out4')),
+                ]
+        response = self.client_post_json(url, {'messages': messages})
+        replies = response.json()['replies']
+        self.assertEqual([r['status_code'] for r in replies], [200, 400])
+        self.assertEqual(result.get_output(), 'out1out2out3')
+
+        # Only the views the client posts to
+        for msg in [{'path': reverse('ci:client:client_ping', args=[client.name]), 'payload': {}},
+                {'path': '/foo/', 'payload': {}},
+                {'payload': {}},
+                message('update_step_result', 'foo')]:
+            response = self.client_post_json(url, {'messages': [msg]})
+            self.assertEqual(response.json()['replies'], [{'status_code': 400, 'reply': None}])
+
+        # An error in one of the messages doesn't stop the others
+        with patch.object(views, 'save_step_output') as mock_save:
+            mock_save.side_effect = [Exception("Oh no!"), None]
+            messages = [message('update_step_result', step_data('out5')),
+                    message('complete_step_result', step_data('all', True))]
+            response = self.client_post_json(url, {'messages': messages})
+        replies = response.json()['replies']
+        self.assertEqual([r['status_code'] for r in replies], [500, 200])
+
+        job.status = models.JobStatus.CANCELED
+        job.save()
+        messages = [message('update_step_result', step_data('out6')),
+                {'path': reverse('ci:client:job_finished', args=[user.build_key, client.name, job.pk]),
+                    'payload': {'seconds': 1, 'complete': True, 'canceled': True}}]
+        response = self.client_post_json(url, {'messages': messages})
+        replies = response.json()['replies']
+        self.assertEqual(replies[0]['reply']['command'], 'cancel')
+        self.assertEqual(replies[1]['status_code'], 200)
+        job.refresh_from_db()
+        self.assertTrue(job.complete)
+
     def test_complete_step_result_get(self):
         job, result = self.create_running_job()
 
@@ -810,6 +1258,63 @@ class Tests(ClientTester.ClientTester):
         self.assertEqual(result.status, models.JobStatus.SUCCESS)
         self.assertEqual(result.job.failed_step, "")
 
+    def test_step_result_output_retention(self):
+        job, result = self.create_running_job()
+        update_url = reverse('ci:client:update_step_result', args=[job.recipe.build_user.build_key, job.client.name, result.pk])
+        complete_url = self.complete_step_result_url(job)
+        post_data = self.create_complete_step_result_post_data(result.position, complete=False)
+        with self.settings(STEP_OUTPUT_RETENTION={"head": 1, "tail": 2}):
+            for i in range(4):
+                post_data["output"] = str(i) * 1024
+                response = self.client_post_json(update_url, post_data)
+                self.assertEqual(response.status_code, 200)
+            result.refresh_from_db()
+            self.assertEqual(result.get_output(), "0"*1024 + models.ELIDED_MARKER + "2"*1024 + "3"*1024)
+            self.assertEqual(result.sent_output_length(), 4096)
+
+            # The complete output gets the same treatment
+            post_data["output"] = "a"*1024 + "b"*1024 + "c"*2048
+            post_data["complete"] = True
+            response = self.client_post_json(complete_url, post_data)
+            self.assertEqual(response.status_code, 200)
+            result.refresh_from_db()
+            self.assertEqual(result.get_output(), "a"*1024 + models.ELIDED_MARKER + "c"*2048)
+
+    @override_settings(OUTPUT_SEARCH_INDEX='index.sqlite3')
+    @patch.object(OutputSearch, 'index_pending')
+    def test_complete_step_result_search_index(self, mock_index):
+        job, result = self.create_running_job()
+        url = self.complete_step_result_url(job)
+        # Not complete, nothing to index yet
+        post_data = self.create_complete_step_result_post_data(result.position, complete=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client_post_json(url, post_data)
+        OutputSearch.wait_for_index()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_index.call_count, 0)
+
+        # Indexed in the background after the request
+        post_data = self.create_complete_step_result_post_data(result.position)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client_post_json(url, post_data)
+            self.assertEqual(mock_index.call_count, 0)
+        OutputSearch.wait_for_index()
+        self.assertEqual(response.status_code, 200)
+        mock_index.assert_called_once_with(result.pk)
+
+        # New output has to be indexed again
+        models.StepResult.objects.filter(pk=result.pk).update(output_indexed=True)
+        # Failing to index isn't a problem for the client
+        mock_index.side_effect = sqlite3.OperationalError("database is locked")
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client_post_json(url, post_data)
+        OutputSearch.wait_for_index()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_index.call_count, 2)
+        result.refresh_from_db()
+        self.assertEqual(result.get_output(), "output")
+        self.assertFalse(result.output_indexed)
+
     def test_complete_step_result_intermittent_ok(self):
         job, result = self.create_running_job()
         post_data = self.create_complete_step_result_post_data(result.position)
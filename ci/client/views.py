@@ -15,18 +15,15 @@
 
 from __future__ import unicode_literals, absolute_import
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse, HttpResponseNotAllowed, HttpResponseBadRequest
-import json
-from ci import models, views, Permissions
-from ci.recipe import file_utils
+from django.http import JsonResponse, HttpResponse, HttpResponseNotAllowed, HttpResponseBadRequest, HttpRequest
+from django.urls import resolve, Resolver404
+import functools, json, threading, time, zlib
+from ci import models, views, Permissions, OutputSearch, TimeUtils
 import logging
 from django.conf import settings
 from datetime import timedelta
-from ci.client import UpdateRemoteStatus
+from ci.client import UpdateRemoteStatus, JobQueue, JobPayload
 from django.shortcuts import render, redirect, get_object_or_404
-from django.core.cache import cache
-from .ReadyJobs import get_ready_jobs
-from datetime import datetime
 from django.db import transaction
 
 logger = logging.getLogger('ci')
@@ -45,140 +42,175 @@ def get_or_create_client(name, ip):
         logger.debug('New client %s : %s seen' % (name, ip))
     return client
 
-def update_cached_jobs():
-    # Key in the cache used for storing the polled jobs
-    cached_jobs_key = 'cached_jobs'
-
-    logger.info('Rebuilding ready job cache')
-    cached_jobs = {'expires': None, 'jobs_by_config': {}}
-    jobs_by_config = cached_jobs.get('jobs_by_config')
-    ready_jobs = 0
-    for job in get_ready_jobs():
-        client_user = job.recipe.client_runner_user
-        build_key = None
-        client_build_key = None
-        if client_user is None:
-            build_key = job.recipe.build_user.build_key
-        else:
-            client_build_key = client_user.build_key
-
-        entry = {'pk': job.pk,
-                 'build_key': build_key,
-                 'client_build_key': client_build_key,
-                 'client': job.client.name if job.client else None}
-
-        if job.config.name not in jobs_by_config:
-            jobs_by_config[job.config.name] = []
-        jobs_by_config[job.config.name].append(entry)
-        ready_jobs += 1
+def accepts_gzip(view):
+    """
+    Tells the client that it can send the request body gzip compressed.
+    The body is decompressed by check_post().
+    """
+    @functools.wraps(view)
+    def wrapped(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        response['Accept-Encoding'] = 'gzip'
+        return response
+    return wrapped
 
-    logger.info(f'Job cache rebuilt with {ready_jobs} ready job(s)')
-    cached_jobs['expires'] = datetime.now().timestamp() + settings.GET_JOB_UPDATE_INTERVAL / 1000
-    cache.set(cached_jobs_key, cached_jobs)
+@transaction.atomic(durable=True)
+def get_cached_job(client, build_keys, build_configs, reserve=False):
+    """
+    Claims the next ready job for a client.
+    Input:
+      client[models.Client]: The client looking for a job
+      build_keys[list]: The build keys of the client
+      build_configs[list]: The build configs of the client, in order of preference
+      reserve[bool]: Whether the client won't start the job until it finishes
+        its current one. The job goes back in the queue if it isn't started
+        within CLIENT_RESERVATION_TTL seconds.
+    Return:
+      (models.Job, dict, int): The claimed job, the job information to send
+        to the client and the build key. All None if no job was claimed.
+    """
+    reserved_until = None
+    if reserve:
+        reserved_until = TimeUtils.get_local_time() + timedelta(seconds=settings.CLIENT_RESERVATION_TTL)
+    # The claim saves the job as running
+    job, build_key = JobQueue.claim_job(client, build_keys, build_configs, reserved_until)
+    if job is None:
+        return None, None, None
 
-    return cached_jobs
+    job_info = get_job_info(job)
+    job.event.set_status(models.JobStatus.RUNNING)
+    return job, job_info, build_key
 
 @transaction.atomic(durable=True)
-def get_cached_job(client, build_keys, build_configs):
-    # Key in the cache used for storing the polled jobs
-    cached_jobs_key = 'cached_jobs'
-
-    # For thread locking if we have a cache that supports it
-    lock_context = None
-    if hasattr(cache, 'lock'):
-        acquire_timeout = 2
-        lock_context = cache.lock('get_cached_job_lock',
-                                   blocking_timeout=acquire_timeout)
-
-    def run_locked():
-        build_key = None
-        job_info = None
-        job = None
-
-        cached_jobs = cache.get(cached_jobs_key)
-        rebuild_cache = False
-        now = datetime.now().timestamp()
-        if cached_jobs is None:
-            logger.info('Rebuilding job cache as it is not yet built')
-            rebuild_cache = True
-        elif cached_jobs['expires'] <= now:
-            logger.info('Rebuilding job cache because it is expired')
-            rebuild_cache = True
-        if rebuild_cache:
-            cached_jobs = update_cached_jobs()
-
-        # Sort through the cached jobs by our build configs; this lets
-        # a client prioritize build config. That is, if any jobs exist
-        # with the first config, they will take prioriy. Then the second,
-        # and so on
-        jobs_by_config = cached_jobs['jobs_by_config']
-        for build_config in build_configs:
-            # No jobs by this config found
-            if build_config not in jobs_by_config:
-                continue
-
-            jobs = jobs_by_config[build_config]
-            for job_i in range(len(jobs)):
-                job_entry = jobs[job_i]
-                job_build_key = job_entry['build_key']
-                job_client_build_key = job_entry['client_build_key']
-                # Job isn't for this build key
-                if job_build_key is not None and job_build_key in build_keys:
-                    build_key = job_build_key
-                elif job_client_build_key is not None and job_client_build_key in build_keys:
-                    build_key = job_client_build_key
-                else:
-                    continue
-                # Job has a client set and it's not this one
-                if job_entry['client'] is not None and job_entry['client'] != client.name:
-                    continue
-                # We could check server here, but I don't think it's necessary beacuse
-                # the build keys should be unique
-
-                job = (models.Job.objects
-                    .select_related('config', 'client', 'recipe', 'event')
-                    .get(pk=job_entry['pk']))
-
-                if job.status != models.JobStatus.NOT_STARTED:
-                    logger.warning(f'Job {job.pk} is cached but has already started')
-                    job = None
-                    continue
-                if job.config.name != build_config or \
-                    job.recipe.build_user.build_key != job_entry['build_key'] or \
-                    (job.client is not None and job_entry['client'] != job.client.name) or \
-                    (job.client is None and job_entry['client'] is not None):
-                    logger.warning(f'Job {job.pk} is in different state than cache')
-                    job = None
-                    continue
-
-                job_info = get_job_info(job)
-                job.client = client
-                job.set_status(models.JobStatus.RUNNING) # will save
-
-                # Remove this job from being available in the cache
-                del cached_jobs['jobs_by_config'][build_config][job_i]
-                cache.set(cached_jobs_key, cached_jobs)
+def get_cached_jobs(client, build_keys, build_configs, max_jobs, slots):
+    """
+    Claims several ready jobs for a client at once.
+    Either all of the jobs are claimed or none of them are.
+    Input:
+      client[models.Client]: The client looking for jobs
+      build_keys[list]: The build keys of the client
+      build_configs[list]: The build configs of the client, in order of preference
+      max_jobs[int]: The maximum number of jobs to claim
+      slots[dict]: The maximum number of jobs to claim for each build config.
+        Build configs that aren't in here are only limited by max_jobs.
+    Return:
+      list[(models.Job, dict, int)]: The claimed jobs, as returned by get_cached_job()
+    """
+    claimed = []
+    used = {}
+    while len(claimed) < max_jobs:
+        configs = [c for c in build_configs if used.get(c, 0) < slots.get(c, max_jobs)]
+        job, build_key = JobQueue.claim_job(client, build_keys, configs)
+        if job is None:
+            break
+
+        job_info = get_job_info(job)
+        job.event.set_status(models.JobStatus.RUNNING)
+        claimed.append((job, job_info, build_key))
+        used[job.config.name] = used.get(job.config.name, 0) + 1
+    return claimed
+
+def get_wait(data):
+    """
+    Gets the number of seconds that the client wants to wait for a job to become available.
+    Input:
+      data[dict]: The POST data from the client
+    Return:
+      float: The number of seconds, limited by GET_JOB_MAX_WAIT. None if invalid.
+    """
+    try:
+        return min(max(float(data.get('wait', 0)), 0), settings.GET_JOB_MAX_WAIT / 1000)
+    except (TypeError, ValueError):
+        return None
 
-                break
+# Number of requests in this process that are waiting for jobs
+_waiters = {'count': 0}
+_waiters_lock = threading.Lock()
 
-            if job:
-                break
+def start_waiting():
+    """
+    Registers a request that is going to wait for jobs.
+    Return:
+      bool: False if there are already GET_JOB_MAX_WAITERS requests waiting
+    """
+    with _waiters_lock:
+        if _waiters['count'] >= settings.GET_JOB_MAX_WAITERS:
+            return False
+        _waiters['count'] += 1
+        return True
 
-        return job, job_info, build_key
+def stop_waiting():
+    """
+    Unregisters a request registered with start_waiting()
+    """
+    with _waiters_lock:
+        _waiters['count'] -= 1
 
-    if lock_context is None:
-        return run_locked()
-    else:
-        from redis.exceptions import LockError
-        try:
-            with lock_context:
-                return run_locked()
-        except LockError:
-            logger.warning(f'Failed to acquire cached job lock for {client.name}')
+def wait_for_claim(claim, build_configs, wait):
+    """
+    Tries to claim jobs, waiting for jobs to become available if there aren't any.
+    Input:
+      claim[function]: Called with no arguments to try to claim. Returns a list of what was claimed.
+      build_configs[list]: The build configs of the client
+      wait[float]: Maximum number of seconds to wait
+    Return:
+      list: The return value of the last call to claim()
+    """
+    # Get the versions before looking so that we don't miss a job added in between
+    versions = JobQueue.queue_versions(build_configs)
+    deadline = time.monotonic() + wait
+    claimed = claim()
+    if claimed or not wait or not start_waiting():
+        return claimed
+    try:
+        while not claimed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not JobQueue.wait_for_jobs(build_configs, versions, remaining):
+                break
+            versions = JobQueue.queue_versions(build_configs)
+            claimed = claim()
+    finally:
+        stop_waiting()
+    return claimed
 
-    return None, None, None
+def cancel_past_running_jobs(client, still_running=None):
+    """
+    If a client is asking for work then any jobs it was running that it isn't
+    still running need to be canceled.
+    Input:
+      client[models.Client]: The client
+      still_running[list]: The ids of the jobs that the client is still running
+    """
+    past_running_jobs = models.Job.objects.filter(client=client, complete=False, status=models.JobStatus.RUNNING)
+    if still_running:
+        past_running_jobs = past_running_jobs.exclude(pk__in=still_running)
+    msg = "Canceled due to client %s not finishing job" % client.name
+    for j in past_running_jobs.all():
+        views.set_job_canceled(j, msg)
+        UpdateRemoteStatus.job_complete(j)
+
+def release_expired_reservations():
+    """
+    Puts the jobs that clients claimed ahead of time, but didn't start
+    before their reservation expired, back in the queue.
+    """
+    expired = (models.Job.objects
+            .filter(complete=False, status=models.JobStatus.RUNNING, reserved_until__lt=TimeUtils.get_local_time())
+            .select_related('client', 'event', 'recipe'))
+    for job in expired:
+        # The client might be starting it right now
+        if models.Job.objects.filter(pk=job.pk, reserved_until=job.reserved_until).update(reserved_until=None) != 1:
+            continue
+        job.reserved_until = None
+        client_name = job.client.name if job.client else None
+        if not job.same_client:
+            job.client = None
+        job.set_status(models.JobStatus.NOT_STARTED, calc_event=True) # will save job and event
+        JobQueue.update_job(job)
+        logger.info('Client %s did not start job %s: %s: before its reservation expired' % (client_name, job.pk, job))
 
 @csrf_exempt
+@accepts_gzip
 def get_job(request):
     data, response = check_post(request, ['client_name', 'build_keys', 'build_configs'])
     if response is not None:
@@ -187,6 +219,14 @@ def get_job(request):
     client_name = data.get('client_name')
     build_keys = data.get('build_keys')
     build_configs = data.get('build_configs')
+    # Optional number of seconds to wait for a job to become available
+    wait = get_wait(data)
+    # Optional, for claiming the next job while the client is still finishing
+    # the jobs in "running"
+    reserve = data.get('reserve', False)
+    running = data.get('running', [])
+    if wait is None or not isinstance(reserve, bool) or not isinstance(running, list):
+        return HttpResponseBadRequest('Bad POST data')
 
     client, created = models.Client.objects.get_or_create(name=client_name,ip=get_client_ip(request))
     if created:
@@ -194,22 +234,26 @@ def get_job(request):
     else:
         # if a client is talking to us here then if they have any running jobs assigned to them they need
         # to be canceled
-        past_running_jobs = models.Job.objects.filter(client=client, complete=False, status=models.JobStatus.RUNNING)
-        msg = "Canceled due to client %s not finishing job" % client.name
-        for j in past_running_jobs.all():
-            views.set_job_canceled(j, msg)
-            UpdateRemoteStatus.job_complete(j)
+        cancel_past_running_jobs(client, running)
 
-    client.status_message = 'Looking for work'
-    client.status = models.Client.IDLE
-    client.save()
+    if not running:
+        client.status_message = 'Looking for work'
+        client.status = models.Client.IDLE
+        client.save()
 
-    # This is atomic
-    job, job_info, build_key = get_cached_job(client, build_keys, build_configs)
+    release_expired_reservations()
+
+    def claim():
+        # This is atomic
+        job, job_info, build_key = get_cached_job(client, build_keys, build_configs, reserve)
+        return [(job, job_info, build_key)] if job is not None else []
+
+    claimed = wait_for_claim(claim, build_configs, wait)
 
     # No job found
-    if job is None:
+    if not claimed:
         return json_claim_response(None, None, None, None, None, None)
+    job, job_info, build_key = claimed[0]
 
     # The client is now running
     client.status = models.Client.RUNNING
@@ -221,11 +265,100 @@ def get_job(request):
     UpdateRemoteStatus.job_started(job)
     return json_claim_response(job.pk, job.config.name, True, 'Success', build_key, job_info)
 
+@csrf_exempt
+@accepts_gzip
+def get_jobs(request):
+    """
+    Claims several jobs for a client that can run them concurrently.
+    On top of what get_job takes, the POST data has:
+      max_jobs[int]: The maximum number of jobs to claim
+      slots[dict]: Optional maximum number of jobs for each build config
+      running[list]: Optional ids of the jobs that the client is still running.
+        Any other jobs the client was running get canceled.
+    """
+    data, response = check_post(request, ['client_name', 'build_keys', 'build_configs', 'max_jobs'])
+    if response is not None:
+        return response
+
+    client_name = data.get('client_name')
+    build_keys = data.get('build_keys')
+    build_configs = data.get('build_configs')
+    max_jobs = data.get('max_jobs')
+    slots = data.get('slots', {})
+    running = data.get('running', [])
+    wait = get_wait(data)
+    if (wait is None
+            or not isinstance(max_jobs, int)
+            or max_jobs < 1
+            or not isinstance(slots, dict)
+            or not all(isinstance(v, int) for v in slots.values())
+            or not isinstance(running, list)):
+        return HttpResponseBadRequest('Bad POST data')
+    max_jobs = min(max_jobs, settings.GET_JOBS_MAX_JOBS)
+
+    client, created = models.Client.objects.get_or_create(name=client_name,ip=get_client_ip(request))
+    if created:
+        logger.debug('New client %s : %s seen' % (client_name, get_client_ip(request)))
+    else:
+        cancel_past_running_jobs(client, running)
+
+    if not running:
+        client.status_message = 'Looking for work'
+        client.status = models.Client.IDLE
+        client.save()
+
+    release_expired_reservations()
+
+    # This is atomic
+    claimed = wait_for_claim(lambda: get_cached_jobs(client, build_keys, build_configs, max_jobs, slots),
+            build_configs, wait)
+
+    jobs = []
+    for job, job_info, build_key in claimed:
+        logger.info('Client %s got job %s: %s: on %s' % (client_name, job.pk, job, job.recipe.repository))
+        UpdateRemoteStatus.job_started(job)
+        jobs.append(claim_dict(job.pk, job.config.name, True, 'Success', build_key, job_info))
+
+    if claimed:
+        client.status = models.Client.RUNNING
+        client.status_message = 'Jobs {}'.format(', '.join([str(job.pk) for job, job_info, build_key in claimed]))
+        client.save()
+
+    return JsonResponse({'status': 'OK', 'jobs': jobs})
+
+def get_request_body(request):
+    """
+    The body of a request, decompressed if the client sent it with "Content-Encoding: gzip".
+    Return:
+      (bytes, HttpResponse): The body and None, or None and the error response
+    """
+    encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+    if not encoding or encoding == 'identity':
+        return request.body, None
+    if encoding != 'gzip':
+        return None, HttpResponse('Unsupported content encoding', status=415)
+
+    max_size = settings.CLIENT_MAX_DECOMPRESSED_SIZE
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        body = decompressor.decompress(request.body, max_size + 1)
+    except zlib.error:
+        return None, HttpResponseBadRequest('Invalid gzip data')
+    if len(body) > max_size or decompressor.unconsumed_tail:
+        logger.warning('Decompressed body over {} bytes in request to {}'.format(max_size, request.path))
+        return None, HttpResponse('Decompressed body too large', status=413)
+    if not decompressor.eof:
+        return None, HttpResponseBadRequest('Invalid gzip data')
+    return body, None
+
 def check_post(request, required_keys):
     if request.method != 'POST':
         return None, HttpResponseNotAllowed(['POST'])
+    body, response = get_request_body(request)
+    if response:
+        return None, response
     try:
-        data = json.loads(request.body)
+        data = json.loads(body)
         required = set(required_keys)
         available = set(data.keys())
         if not required.issubset(available):
@@ -242,7 +375,12 @@ def get_job_info(job):
     We do it like this because we don't want the chance
     of the user changing the recipe while a job is running
     and causing problems.
+    The parts that only depend on the recipe come from
+    JobPayload so that reading the scripts is only done
+    once per recipe.
     """
+    payload, repo_sha = JobPayload.recipe_payload(job.recipe)
+
     job_dict = {
         'recipe_name': job.recipe.name,
         'job_id': job.pk,
@@ -275,74 +413,40 @@ def get_job_info(job):
     else:
         recipe_env["CIVET_PR_NUM"] = "0"
 
-    for env in job.recipe.environment_vars.all():
-        recipe_env[env.name] = env.value
+    recipe_env.update(payload['environment'])
 
     job_dict['environment'] = recipe_env
+    job_dict['prestep_sources'] = list(payload['prestep_sources'])
+
+    models.delete_step_results(job.step_results.all())
+    step_results = models.StepResult.objects.bulk_create([models.StepResult(
+        job=job,
+        name=step['step_name'],
+        position=step['step_position'],
+        abort_on_failure=step['abort_on_failure'],
+        allowed_to_fail=step['allowed_to_fail'],
+        filename=step['filename']) for step in payload['steps']])
+    if step_results and step_results[0].pk is None:
+        # The database can't return the ids from a bulk insert
+        step_results = list(job.step_results.order_by('position'))
+    logger.info('Created {} step results for {}: {}'.format(len(step_results), job.pk, job))
 
-    base_file_dir = settings.RECIPE_BASE_DIR
-    prestep_env = []
-    for prestep in job.recipe.prestepsources.all():
-        if prestep.filename:
-            contents = file_utils.get_contents(base_file_dir, prestep.filename)
-            if contents:
-                prestep_env.append(contents)
-
-    job_dict['prestep_sources'] = prestep_env
-
-    job.step_results.all().delete()
     step_recipes = []
-    for step in job.recipe.steps.order_by('position'):
-        step_dict = {
-            'step_num': step.position,
-            'step_position': step.position,
-            'step_name': step.name,
-            'abort_on_failure': step.abort_on_failure,
-            'allowed_to_fail': step.allowed_to_fail,
-            }
-
-        step_result, created = models.StepResult.objects.get_or_create(
-            job=job,
-            name=step.name,
-            position=step.position,
-            abort_on_failure=step.abort_on_failure,
-            allowed_to_fail=step.allowed_to_fail,
-            filename=step.filename)
-
-        logger.info('Created step result for {}: {}: {}: {}'.format(job.pk, job, step_result.pk, step.name))
-        step_result.output = ''
-        step_result.complete = False
-        step_result.seconds = timedelta(seconds=0)
-        step_result.status = models.JobStatus.NOT_STARTED
-        step_result.save()
+    for step, step_result in zip(payload['steps'], step_results):
+        step_dict = {key: value for key, value in step.items() if key != 'filename'}
+        step_dict['environment'] = dict(step['environment'])
         step_dict['stepresult_id'] = step_result.pk
-
-        step_env = {
-            'CIVET_STEP_NUM': step_dict["step_num"],
-            'CIVET_STEP_POSITION': step_dict["step_position"],
-            'CIVET_STEP_NAME': step_dict["step_name"],
-            'CIVET_STEP_ABORT_ON_FAILURE': step_dict["abort_on_failure"],
-            'CIVET_STEP_ALLOWED_TO_FAIL': step_dict["allowed_to_fail"],
-            }
-        for env in step.step_environment.all():
-            step_env[env.name] = env.value
-        step_dict['environment'] = step_env
-
-        if step.filename:
-            contents = file_utils.get_contents(base_file_dir, step.filename)
-            step_dict['script'] = str(contents) # in case of empty file, use str
-
         step_recipes.append(step_dict)
 
     job_dict['environment']['CIVET_NUM_STEPS'] = str(len(step_recipes))
     job_dict['steps'] = step_recipes
-    job.recipe_repo_sha = file_utils.get_repo_sha(base_file_dir)
+    job.recipe_repo_sha = repo_sha
     job.save()
 
     return job_dict
 
-def json_claim_response(job_id, config_name, claimed, msg, build_key, job_info=None):
-    return JsonResponse({
+def claim_dict(job_id, config_name, claimed, msg, build_key, job_info=None):
+    return {
       'job_id': job_id,
       'config': config_name,
       'success': claimed,
@@ -350,7 +454,10 @@ def json_claim_response(job_id, config_name, claimed, msg, build_key, job_info=N
       'status': 'OK',
       'job_info': job_info,
       'build_key': build_key
-      })
+      }
+
+def json_claim_response(job_id, config_name, claimed, msg, build_key, job_info=None):
+    return JsonResponse(claim_dict(job_id, config_name, claimed, msg, build_key, job_info))
 
 def json_finished_response(status, msg):
     return JsonResponse({'status': status, 'message': msg})
@@ -374,6 +481,7 @@ def check_job_finished_post(request, build_key, client_name, job_id):
     return None, data, client, job
 
 @csrf_exempt
+@accepts_gzip
 def job_finished(request, build_key, client_name, job_id):
     """
     Called when all the steps in the job are finished or when a job fails and is not
@@ -385,6 +493,7 @@ def job_finished(request, build_key, client_name, job_id):
         return response
 
     job.running_step = ""
+    job.reserved_until = None
     job.seconds = timedelta(seconds=data['seconds'])
     job.complete = data['complete']
     # In addition to the server sending the cancel command to the client, this
@@ -407,6 +516,42 @@ def job_finished(request, build_key, client_name, job_id):
         job.event.make_jobs_ready()
     return json_finished_response('OK', 'Success')
 
+@csrf_exempt
+@accepts_gzip
+def release_job(request, build_key, client_name, job_id):
+    """
+    Called when a client claimed a job that it isn't going to run, like when
+    it got jobs from several servers at once. The job goes back in the queue.
+    """
+    data, response = check_post(request, [])
+    if response:
+        return response
+
+    try:
+        client = models.Client.objects.get(name=client_name, ip=get_client_ip(request))
+    except models.Client.DoesNotExist:
+        return HttpResponseBadRequest('Invalid client')
+
+    try:
+        job = models.Job.objects.select_related('event').get(pk=job_id,
+                client=client,
+                complete=False,
+                status=models.JobStatus.RUNNING,
+                event__build_user__build_key=build_key)
+    except models.Job.DoesNotExist:
+        return HttpResponseBadRequest('Invalid job/build_key')
+
+    if job.step_results.exclude(status=models.JobStatus.NOT_STARTED).exists():
+        return HttpResponseBadRequest('Job already started')
+
+    if not job.same_client:
+        job.client = None
+    job.reserved_until = None
+    job.set_status(models.JobStatus.NOT_STARTED, calc_event=True) # will save job and event
+    JobQueue.update_job(job)
+    logger.info('Client %s released job %s: %s: on %s' % (client_name, job.pk, job, job.recipe.repository))
+    return json_finished_response('OK', 'Success')
+
 
 def json_update_response(status, msg, cmd=None):
     """
@@ -427,6 +572,7 @@ def check_step_result_post(request, build_key, client_name, stepresult_id):
     try:
         step_result = (models.StepResult.objects
                 .select_related('job',
+                    'job__recipe__repository__user__server',
                     'job__event',
                     'job__event__base__branch__repository',
                     'job__client',
@@ -445,6 +591,7 @@ def check_step_result_post(request, build_key, client_name, stepresult_id):
     return None, data, step_result, client
 
 @csrf_exempt
+@accepts_gzip
 def start_step_result(request, build_key, client_name, stepresult_id):
     response, data, step_result, client = check_step_result_post(request, build_key, client_name, stepresult_id)
     if response:
@@ -461,6 +608,8 @@ def start_step_result(request, build_key, client_name, stepresult_id):
     step_result.job.running_step = '{}/{}'.format(step_result.position+1, step_result.job.step_results.count())
     step_result.save()
     step_result.job.seconds = step_result.job.calc_total_time()
+    # The client has started the job if it was reserved
+    step_result.job.reserved_until = None
     step_result.job.save() # update timestamp
     client.status_msg = 'Starting {} on job {}'.format(step_result.name, step_result.job)
     client.save()
@@ -468,25 +617,43 @@ def start_step_result(request, build_key, client_name, stepresult_id):
     UpdateRemoteStatus.step_start_pr_status(step_result, step_result.job)
     return json_update_response('OK', 'success', cmd)
 
-def save_step_result(step_result):
+def save_step_output(step_result, output, append=True):
+    """
+    Stores the output of a step result.
+    Input:
+      step_result[models.StepResult]: The step result
+      output[str]: The output
+      append[bool]: Whether to append to the existing output or replace it
+    """
+    retention = step_result.job.recipe.output_retention()
     try:
-        step_result.save()
+        with transaction.atomic():
+            if append:
+                step_result.append_output(output, retention)
+            else:
+                step_result.set_output(output, retention)
     except Exception as e:
         # We could potentially have bad output that causes errors when saving.
         # For example, on Postgresql:
         # ValueError: A string literal cannot contain NUL (0x00) characters.
-        step_result.output = "Failed to save output:\n%s" % e
-        step_result.save()
+        msg = "Failed to save output:\n%s" % e
+        if append:
+            step_result.append_output(msg)
+        else:
+            step_result.set_output(msg)
 
-def step_result_from_data(step_result, data, status):
+def step_result_from_data(step_result, data, status, append=True):
     step_result.seconds = timedelta(seconds=data['time'])
-    step_result.output = step_result.output + data['output']
     step_result.complete = data['complete']
     step_result.exit_status = int(data['exit_status'])
     step_result.status = status
-    save_step_result(step_result)
+    if append:
+        # Only the fields that changed so the output doesn't get written again
+        step_result.save(update_fields=['seconds', 'complete', 'exit_status', 'status', 'last_modified'])
+    save_step_output(step_result, data['output'], append)
 
 @csrf_exempt
+@accepts_gzip
 def complete_step_result(request, build_key, client_name, stepresult_id):
     response, data, step_result, client = check_step_result_post(request, build_key, client_name, stepresult_id)
     if response:
@@ -507,21 +674,24 @@ def complete_step_result(request, build_key, client_name, stepresult_id):
         if step_result.allowed_to_fail:
             status = models.JobStatus.FAILED_OK
 
-    step_result_from_data(step_result, data, status)
+    if data['complete']:
+        # The new output gets indexed once it is saved
+        step_result.output_indexed = False
+    # The client sends all the output when the step is complete
+    step_result_from_data(step_result, data, status, append=not data['complete'])
 
     step_result.job.seconds = step_result.job.calc_total_time()
     step_result.job.save() # update timestamp
     step_result.job.event.save() # update timestamp
     if data['complete']:
-        step_result.output = data['output']
-        save_step_result(step_result)
-
         client.status_msg = 'Completed {}: {}'.format(step_result.job, step_result.name)
         client.save()
+        OutputSearch.index_later(step_result)
 
     return json_update_response('OK', 'success')
 
 @csrf_exempt
+@accepts_gzip
 def update_step_result(request, build_key, client_name, stepresult_id):
     response, data, step_result, client = check_step_result_post(request, build_key, client_name, stepresult_id)
     if response:
@@ -534,7 +704,7 @@ def update_step_result(request, build_key, client_name, stepresult_id):
     # somebody canceled or invalidated the job
     if job.status == models.JobStatus.CANCELED or job.status == models.JobStatus.NOT_STARTED:
         step_result.status = job.status
-        step_result.save()
+        step_result.save(update_fields=['status', 'last_modified'])
         cmd = 'cancel'
 
     client.status_msg = 'Running {} ({}): {} : {}'.format(step_result.job,
@@ -549,7 +719,76 @@ def update_step_result(request, build_key, client_name, stepresult_id):
 
     return json_update_response('OK', 'success', cmd)
 
+# The views that can be posted to in post_messages()
+BATCH_VIEWS = ['start_step_result', 'update_step_result', 'complete_step_result', 'job_finished']
+
+def batch_request(request, data):
+    """
+    A copy of a request with a different JSON body
+    """
+    sub_request = HttpRequest()
+    sub_request.method = 'POST'
+    # The body of the batch was already decompressed
+    sub_request.META = {k: v for k, v in request.META.items() if k != 'HTTP_CONTENT_ENCODING'}
+    sub_request._body = json.dumps(data).encode('utf-8')
+    return sub_request
+
+def post_batch_message(request, message):
+    """
+    Handles one of the messages in post_messages() with its view.
+    Input:
+      request[HttpRequest]: The request to post_messages()
+      message[dict]: With keys path, the path of the view relative to the
+        server root, and payload, the data that would be posted to it
+    Return:
+      dict: With keys status_code and reply, the JSON of the response or None
+    """
+    try:
+        match = resolve(message['path'])
+    except (Resolver404, KeyError, TypeError):
+        return {'status_code': 400, 'reply': None}
+    if match.namespace != 'ci:client' or match.url_name not in BATCH_VIEWS or not isinstance(message.get('payload'), dict):
+        return {'status_code': 400, 'reply': None}
+
+    try:
+        response = match.func(batch_request(request, message['payload']), *match.args, **match.kwargs)
+    except Exception as e:
+        # Like the 500 the client would get if it posted the message by itself
+        logger.warning("Error while handling {} in a batch: {}".format(message['path'], e))
+        return {'status_code': 500, 'reply': None}
+
+    reply = None
+    if response.status_code == 200:
+        reply = json.loads(response.content)
+    return {'status_code': response.status_code, 'reply': reply}
+
+@csrf_exempt
+@accepts_gzip
+def post_messages(request):
+    """
+    Lets a client send several updates in one request.
+    Each message is handled in order by the view it would have been posted to.
+    Handling stops at the first message that the client would stop on.
+    The reply has the responses of the messages that were handled.
+    """
+    data, response = check_post(request, ['messages'])
+    if response:
+        return response
+    if not isinstance(data['messages'], list) or len(data['messages']) > settings.CLIENT_MAX_BATCH_MESSAGES:
+        return HttpResponseBadRequest('Bad messages')
+
+    replies = []
+    for message in data['messages']:
+        if not isinstance(message, dict):
+            return HttpResponseBadRequest('Bad messages')
+        reply = post_batch_message(request, message)
+        replies.append(reply)
+        if reply['status_code'] in (400, 413):
+            break
+    return JsonResponse({'status': 'OK', 'replies': replies})
+
 @csrf_exempt
+@accepts_gzip
 def client_ping(request, client_name):
     client = get_or_create_client(client_name, get_client_ip(request))
 
@@ -17,7 +17,7 @@ from __future__ import unicode_literals, absolute_import
 from ci import models
 import logging
 import re
-from ci.client import UpdateRemoteStatus
+from ci.client import UpdateRemoteStatus, JobQueue
 logger = logging.getLogger('ci')
 
 def cancel_event(ev, message, update_remote=False, do_pr_status_update=True):
@@ -35,6 +35,7 @@ def cancel_event(ev, message, update_remote=False, do_pr_status_update=True):
             job.status = models.JobStatus.CANCELED
             job.complete = True
             job.save()
+            JobQueue.remove_job(job)
             logger.info('Canceling event {}: {} : job {}: {}'.format(ev.pk,
                 ev, job.pk, job.str_with_client()))
             models.JobChangeLog.objects.create(job=job, message=message)
@@ -96,6 +97,7 @@ def auto_cancel_event(ev, message):
             job.status = models.JobStatus.CANCELED
             job.complete = True
             job.save()
+            JobQueue.remove_job(job)
             logger.info('Auto canceling event {}: {} : job {}: {}'.format(ev.pk,
                 ev, job.pk, job.str_with_client()))
             models.JobChangeLog.objects.create(job=job, message=message)
@@ -15,7 +15,7 @@
 
 from __future__ import unicode_literals, absolute_import
 from django import forms
-from ci import models
+from ci import models, OutputSearch
 
 class JobInfoForm(forms.Form):
     os_versions = forms.ModelMultipleChoiceField(
@@ -27,6 +27,20 @@ class JobInfoForm(forms.Form):
         widget=forms.CheckboxSelectMultiple,
         required=False)
 
+class OutputSearchForm(forms.Form):
+    text = forms.CharField(min_length=OutputSearch.MIN_SEARCH_LENGTH, max_length=200)
+    repository = forms.ModelChoiceField(
+        queryset=models.Repository.objects.filter(active=True).order_by("user__name", "name"),
+        required=False)
+    recipe = forms.CharField(max_length=120, required=False, help_text="Name of the recipe")
+    status = forms.TypedChoiceField(choices=[("", "Any")] + list(models.JobStatus.STATUS_CHOICES),
+        coerce=int,
+        empty_value=None,
+        required=False,
+        help_text="Status of the step")
+    since = forms.DateField(required=False, help_text="YYYY-MM-DD")
+    until = forms.DateField(required=False, help_text="YYYY-MM-DD, inclusive")
+
 class AlternateRecipesForm(forms.Form):
     recipes = forms.MultipleChoiceField(widget=forms.CheckboxSelectMultiple, required=False)
     default_recipes = forms.MultipleChoiceField(widget=forms.CheckboxSelectMultiple, required=False)
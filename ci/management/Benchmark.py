@@ -0,0 +1,430 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Load testing of the client endpoints.
+
+A synthetic database is seeded with seed(), then run_clients() starts a thread
+for each simulated client. Each one claims jobs with the real JobGetter and
+reports the step results through the real ServerUpdater, like a client running
+a job that finishes instantly. While that runs QueryCounter counts the queries
+and lock errors on the server for each endpoint.
+
+This is used by the benchmark_clients management command. It is kept with
+the management commands since it uses the client package, which the server
+itself doesn't need.
+
+flood_step() measures how fast a client reads the output of a step
+that produces a lot of it. This is used by the benchmark_step_output
+management command.
+"""
+from __future__ import unicode_literals, absolute_import
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from ci import models
+from ci.client import JobQueue
+from client import JobGetter, JobRunner, ServerUpdater, SessionPool
+from queue import Queue
+import os
+import threading
+import time
+import logging
+logger = logging.getLogger('ci')
+
+# The endpoints that the simulated clients use, in the order they appear in the report
+ENDPOINTS = ['get_job', 'start_step_result', 'update_step_result', 'complete_step_result', 'job_finished']
+
+def seed(num_events, jobs_per_event, num_steps=2, num_clients=0, build_config='benchmark'):
+    """
+    Creates ready jobs to be claimed by the simulated clients.
+    Everything is created with bulk inserts so that large databases can be seeded quickly.
+    Input:
+      num_events[int]: Number of events to create
+      jobs_per_event[int]: Number of jobs on each event. Each job has its own recipe.
+      num_steps[int]: Number of steps in each recipe
+      num_clients[int]: Number of extra idle clients to create
+      build_config[str]: Name of the build config of the jobs
+    Return:
+      models.GitUser: The build user of the jobs
+    """
+    server_config = settings.INSTALLED_GITSERVERS[0]
+    server, created = models.GitServer.objects.get_or_create(host_type=server_config["type"],
+            name=server_config["hostname"])
+    user, created = models.GitUser.objects.get_or_create(name='benchmark', server=server)
+    repo, created = models.Repository.objects.get_or_create(name='benchmark', user=user)
+    branch, created = models.Branch.objects.get_or_create(name='master', repository=repo)
+    config, created = models.BuildConfig.objects.get_or_create(name=build_config)
+
+    recipes = []
+    for i in range(jobs_per_event):
+        recipe = models.Recipe.objects.create(name='benchmark%s' % i,
+                display_name='benchmark%s' % i,
+                filename='recipes/benchmark%s.cfg' % i,
+                build_user=user,
+                repository=repo,
+                cause=models.Recipe.CAUSE_PULL_REQUEST,
+                current=True,
+                active=True)
+        recipe.build_configs.add(config)
+        recipes.append(recipe)
+    models.Step.objects.bulk_create([models.Step(recipe=recipe, name='step%s' % i, filename='scripts/1.sh', position=i)
+        for recipe in recipes for i in range(num_steps)])
+
+    base = models.Commit.objects.create(branch=branch, sha='0'*40)
+    heads = models.Commit.objects.bulk_create([models.Commit(branch=branch, sha='%040x' % (i+1))
+        for i in range(num_events)])
+    events = models.Event.objects.bulk_create([models.Event(build_user=user, head=head, base=base)
+        for head in heads])
+    models.Job.objects.bulk_create([models.Job(recipe=recipe, event=event, config=config, ready=True, active=True)
+        for event in events for recipe in recipes])
+    models.Client.objects.bulk_create([models.Client(name='benchmark-idle%s' % i, ip='127.0.0.1')
+        for i in range(num_clients)])
+    JobQueue.rebuild_queues()
+    return user
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of a sorted list
+    """
+    if not values:
+        return 0
+    idx = max(int(round(pct / 100.0 * len(values))) - 1, 0)
+    return values[min(idx, len(values) - 1)]
+
+def endpoint_name(path):
+    """
+    Gets the client endpoint from the path of a request, like "get_job" for "/client/get_job/"
+    """
+    parts = path.strip('/').split('/')
+    if len(parts) > 1 and parts[0] == 'client':
+        return parts[1]
+    return 'other'
+
+def is_lock_error(error):
+    """
+    Whether a database error is from failing to get a lock.
+    "database is locked" on SQLite, lock timeouts, deadlocks or serialization failures on PostgreSQL.
+    """
+    msg = str(error).lower()
+    return ('locked' in msg
+            or ('lock' in msg and 'timeout' in msg)
+            or 'deadlock' in msg
+            or 'could not serialize' in msg)
+
+class QueryCounter(object):
+    """
+    Counts the queries, and the queries that failed due to locking, for each client endpoint.
+    This works by adding an execute wrapper to every database connection
+    so it includes the connections created by the threads of the live server.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.queries = {}
+        self.lock_errors = {}
+        self.requests = {}
+        self.wrapped = []
+
+    def __enter__(self):
+        request_started.connect(self.request_started)
+        connection_created.connect(self.connection_created)
+        for conn in connections.all(initialized_only=True):
+            self.wrap(conn)
+        return self
+
+    def __exit__(self, exc, value, tb):
+        request_started.disconnect(self.request_started)
+        connection_created.disconnect(self.connection_created)
+        for conn in self.wrapped:
+            if self in conn.execute_wrappers:
+                conn.execute_wrappers.remove(self)
+        self.wrapped = []
+
+    def wrap(self, conn):
+        with self.lock:
+            if self not in conn.execute_wrappers:
+                conn.execute_wrappers.append(self)
+                self.wrapped.append(conn)
+
+    def connection_created(self, sender, connection, **kwargs):
+        self.wrap(connection)
+
+    def request_started(self, sender, environ=None, **kwargs):
+        name = endpoint_name(environ.get('PATH_INFO', '') if environ else '')
+        self.local.endpoint = name
+        self.add(self.requests, name)
+
+    def add(self, counts, name):
+        with self.lock:
+            counts[name] = counts.get(name, 0) + 1
+
+    def __call__(self, execute, sql, params, many, context):
+        name = getattr(self.local, 'endpoint', 'other')
+        self.add(self.queries, name)
+        try:
+            return execute(sql, params, many, context)
+        except Exception as e:
+            if is_lock_error(e):
+                self.add(self.lock_errors, name)
+            raise
+
+class Stats(object):
+    """
+    Latencies of the requests of all the simulated clients
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.failures = {}
+        self.empty_polls = 0
+        self.jobs = 0
+
+    def add(self, endpoint, seconds, success=True):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not success:
+                self.failures[endpoint] = self.failures.get(endpoint, 0) + 1
+
+    def add_job(self):
+        with self.lock:
+            self.jobs += 1
+
+    def add_empty_poll(self):
+        with self.lock:
+            self.empty_polls += 1
+
+def post(updater, stats, endpoint, item):
+    start = time.time()
+    sent = updater.post_message(item)
+    stats.add(endpoint, time.time() - start, sent)
+    return sent
+
+def run_job(client_info, updater, stats, claimed, num_updates, output_size):
+    """
+    Sends the same updates that JobRunner would for a job where every step succeeds.
+    """
+    server = client_info["server"]
+    client_name = client_info["client_name"]
+    build_key = claimed["build_key"]
+    job_info = claimed["job_info"]
+    job_id = job_info["job_id"]
+    chunk = "x" * (output_size - 1) + "\n"
+
+    for step in job_info["steps"]:
+        step_data = {'job_id': job_id,
+            'client_name': client_name,
+            'stepresult_id': step['stepresult_id'],
+            'step_num': step['step_num'],
+            'output': None,
+            'exit_status': 0,
+            'complete': False,
+            'time': 0,
+            'canceled': False,
+            }
+        for stage, count in (('start_step_result', 1), ('update_step_result', num_updates),
+                ('complete_step_result', 1)):
+            url = "{}/client/{}/{}/{}/{}/".format(server, stage, build_key, client_name, step['stepresult_id'])
+            for i in range(count):
+                if stage == 'update_step_result':
+                    step_data['output'] = chunk
+                elif stage == 'complete_step_result':
+                    step_data['output'] = chunk * num_updates
+                    step_data['complete'] = True
+                item = {"server": server, "job_id": job_id, "url": url, "payload": step_data.copy()}
+                post(updater, stats, stage, item)
+
+    url = "{}/client/job_finished/{}/{}/{}/".format(server, build_key, client_name, job_id)
+    job_msg = {'canceled': False, 'failed': False, 'seconds': 0, 'complete': True, 'client_name': client_name}
+    post(updater, stats, 'job_finished', {"server": server, "job_id": job_id, "url": url, "payload": job_msg})
+    stats.add_job()
+
+def run_client(client_info, stats, num_updates, output_size, max_empty_polls):
+    """
+    Main loop of a simulated client. Claims jobs until there aren't any left.
+    """
+    # Like a real client, keep the connection to the server open
+    sessions = SessionPool.SessionPool()
+    getter = JobGetter.JobGetter(client_info, sessions)
+    updater = ServerUpdater.ServerUpdater(client_info["server"], client_info, Queue(), Queue(), Queue(), sessions)
+    empty_polls = 0
+    try:
+        while empty_polls < max_empty_polls:
+            start = time.time()
+            claimed = getter.get_job()
+            stats.add('get_job', time.time() - start)
+            if claimed is None:
+                stats.add_empty_poll()
+                empty_polls += 1
+                continue
+            empty_polls = 0
+            run_job(client_info, updater, stats, claimed, num_updates, output_size)
+    finally:
+        sessions.close()
+
+def run_clients(server_url, build_keys, num_clients, build_config='benchmark', num_updates=2,
+        output_size=1024, max_empty_polls=2):
+    """
+    Runs simulated clients against a server until there aren't any jobs left.
+    Input:
+      server_url[str]: URL of the server
+      build_keys[list]: Build keys the clients use
+      num_clients[int]: Number of clients to run at once
+      build_config[str]: The build config the clients claim jobs for
+      num_updates[int]: Number of update_step_result posts for each step
+      output_size[int]: Size in bytes of the output in each update
+      max_empty_polls[int]: A client stops after this many polls in a row without a job
+    Return:
+      (Stats, float): The latencies of the requests and the total time in seconds
+    """
+    stats = Stats()
+    threads = []
+    for i in range(num_clients):
+        client_info = {"server": server_url,
+                "servers": [server_url],
+                "client_name": "benchmark%s" % i,
+                "build_keys": build_keys,
+                "build_configs": [build_config],
+                "ssl_verify": False,
+                "request_timeout": 30,
+                "server_update_interval": 30,
+                }
+        thread = threading.Thread(target=run_client,
+                args=(client_info, stats, num_updates, output_size, max_empty_polls))
+        threads.append(thread)
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, time.time() - start
+
+def report(stats, counter, elapsed):
+    """
+    Summarizes the results of run_clients()
+    Input:
+      stats[Stats]: From run_clients()
+      counter[QueryCounter]: The queries made on the server while running
+      elapsed[float]: Total time in seconds
+    Return:
+      list[str]: Lines of the report
+    """
+    lines = ["Jobs: %s in %.2f s (%.2f jobs/s), empty polls: %s" % (stats.jobs, elapsed,
+        stats.jobs / elapsed if elapsed else 0, stats.empty_polls)]
+    lines.append("%-22s %8s %8s %8s %8s %8s %8s %10s %6s %6s" % ("endpoint", "requests", "req/s",
+        "p50 ms", "p90 ms", "p99 ms", "max ms", "queries/req", "fails", "locks"))
+    names = ENDPOINTS + sorted(set(stats.latencies.keys()) - set(ENDPOINTS))
+    for name in names:
+        latencies = sorted(stats.latencies.get(name, []))
+        if not latencies:
+            continue
+        requests = counter.requests.get(name, 0)
+        queries = counter.queries.get(name, 0)
+        lines.append("%-22s %8s %8.1f %8.1f %8.1f %8.1f %8.1f %10.1f %6s %6s" % (name,
+            len(latencies),
+            len(latencies) / elapsed if elapsed else 0,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000,
+            latencies[-1] * 1000,
+            float(queries) / requests if requests else 0,
+            stats.failures.get(name, 0),
+            counter.lock_errors.get(name, 0),
+            ))
+    return lines
+
+def flood_script(size, line_length):
+    """
+    Bash script that writes size bytes of lines that are line_length long
+    """
+    line = "x" * (line_length - 1)
+    return 'yes "{}" | head -c {}\n'.format(line, size)
+
+def flood_step(size, line_length=100, max_output_size=5*1024*1024, cancel_after=None):
+    """
+    Runs a step on a JobRunner that writes a lot of output.
+    Input:
+      size[int]: Bytes of output the step writes
+      line_length[int]: Length of each line of output
+      max_output_size[int]: The output the runner keeps
+      cancel_after[float]: If set, the job is canceled after this many seconds
+        and the step writes output until then
+    Return:
+      dict: With keys:
+        seconds: Time to read all the output
+        cpu_seconds: CPU time used by the client while reading
+        output_size: Size of the output the step result got
+        cancel_latency: Seconds between sending the cancel and killing the step, or None
+    """
+    client_info = {"client_name": "benchmark",
+            "server": "http://localhost",
+            "update_step_time": 1,
+            "max_output_size": max_output_size,
+            "environment": {},
+            }
+    job = {"job_id": 1,
+            "recipe_name": "benchmark",
+            "environment": {},
+            "prestep_sources": [],
+            "steps": [{"step_name": "flood", "step_num": 0, "stepresult_id": 1, "environment": {}, "script": ""}],
+            }
+    message_q = Queue()
+    command_q = Queue()
+    runner = JobRunner.JobRunner(client_info, job, message_q, command_q, "benchmark")
+    step = job["steps"][0]
+    script = flood_script(size, line_length)
+    if cancel_after is not None:
+        script = 'while true; do {}; done\n'.format(script.strip())
+
+    killed = []
+    kill_job = runner.kill_job
+    def record_kill(proc):
+        killed.append(time.time())
+        kill_job(proc)
+    runner.kill_job = record_kill
+
+    cancel_time = []
+    def cancel():
+        time.sleep(cancel_after)
+        cancel_time.append(time.time())
+        command_q.put({"job_id": 1, "command": "cancel"})
+
+    with JobRunner.temp_file() as script_file:
+        script_file.write(script.encode("utf-8"))
+        script_file.close()
+        with open(os.devnull, "wb") as devnull:
+            proc = runner.create_process(script_file.name, {}, devnull)
+            thread = None
+            if cancel_after is not None:
+                thread = threading.Thread(target=cancel)
+                thread.start()
+            start = time.time()
+            start_cpu = time.process_time()
+            data = runner.read_process_output(proc, step, {})
+            end_cpu = time.process_time()
+            seconds = time.time() - start
+            proc.wait()
+            if thread:
+                thread.join()
+
+    cancel_latency = None
+    if killed and cancel_time:
+        cancel_latency = killed[0] - cancel_time[0]
+    return {"seconds": seconds,
+            "cpu_seconds": end_cpu - start_cpu,
+            "output_size": len((data.get("output") or "").encode("utf-8")),
+            "cancel_latency": cancel_latency,
+            }
@@ -0,0 +1,81 @@
+from __future__ import unicode_literals, absolute_import
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.testcases import LiveServerThread
+from django.test.utils import setup_databases, teardown_databases
+from django.test import override_settings
+from django.conf import settings
+from ci.tests import utils
+from ci.management import Benchmark
+import os, shutil, tempfile
+import logging
+
+class Command(BaseCommand):
+    help = 'Load test the client endpoints. This seeds a separate test database with ready jobs, ' \
+            'starts a server on it and runs simulated clients against it until all the jobs are done. ' \
+            'It uses the database engine in the settings so the results for SQLite and PostgreSQL ' \
+            'can be compared between revisions.'
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=1000, help="Number of events. Default: %(default)s")
+        parser.add_argument('--jobs-per-event', type=int, default=4,
+                help="Number of jobs on each event. Default: %(default)s")
+        parser.add_argument('--steps', type=int, default=2, help="Number of steps in each job. Default: %(default)s")
+        parser.add_argument('--clients', type=int, default=8,
+                help="Number of simulated clients running at once. Default: %(default)s")
+        parser.add_argument('--idle-clients', type=int, default=1000,
+                help="Number of extra clients in the database. Default: %(default)s")
+        parser.add_argument('--updates', type=int, default=2,
+                help="Number of output updates sent for each step. Default: %(default)s")
+        parser.add_argument('--output-size', type=int, default=1024,
+                help="Size in bytes of the output in each update. Default: %(default)s")
+        parser.add_argument('--keepdb', default=False, action='store_true',
+                help="Don't destroy the test database when done")
+
+    @override_settings(INSTALLED_GITSERVERS=[utils.github_config()], ALLOWED_HOSTS=['localhost'], DEBUG=False)
+    def handle(self, *args, **options):
+        if options["clients"] < 1:
+            raise CommandError("Need at least one client")
+        # Don't let the per request logging skew the timings
+        logging.getLogger('ci').setLevel(logging.WARNING)
+        logging.getLogger('civet_client').setLevel(logging.ERROR)
+        # Lock errors are counted in the report
+        logging.getLogger('django.request').setLevel(logging.CRITICAL)
+        logging.getLogger('django.server').setLevel(logging.CRITICAL)
+
+        tmp_dir = tempfile.mkdtemp()
+        orig_recipe_dir = settings.RECIPE_BASE_DIR
+        settings.RECIPE_BASE_DIR = utils.create_recipe_dir()
+        if connection.vendor == 'sqlite':
+            # The default in-memory test database can't be shared between the server threads
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(tmp_dir, 'benchmark.sqlite3')
+
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=options["keepdb"])
+        server = None
+        try:
+            self.stdout.write("Seeding %s events with %s jobs each on %s" % (options["events"],
+                options["jobs_per_event"], connection.vendor))
+            user = Benchmark.seed(options["events"], options["jobs_per_event"], options["steps"],
+                    options["idle_clients"])
+            connection.close()
+
+            # No static files, just the wrapped WSGIHandler
+            server = LiveServerThread('localhost', lambda handler: handler)
+            server.daemon = True
+            server.start()
+            server.is_ready.wait()
+            if server.error:
+                raise server.error
+            url = 'http://localhost:%s' % server.port
+
+            with Benchmark.QueryCounter() as counter:
+                stats, elapsed = Benchmark.run_clients(url, [user.build_key], options["clients"],
+                        num_updates=options["updates"], output_size=options["output_size"])
+            for line in Benchmark.report(stats, counter, elapsed):
+                self.stdout.write(line)
+        finally:
+            if server:
+                server.terminate()
+            teardown_databases(old_config, verbosity=0, keepdb=options["keepdb"])
+            shutil.rmtree(settings.RECIPE_BASE_DIR)
+            settings.RECIPE_BASE_DIR = orig_recipe_dir
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,31 @@
+from __future__ import unicode_literals, absolute_import
+from django.core.management.base import BaseCommand, CommandError
+from ci.management import Benchmark
+import logging
+
+class Command(BaseCommand):
+    help = 'Measures how fast the client reads the output of a step that floods it with output, ' \
+            'and how long it takes to kill the step when the job is canceled.'
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=200,
+                help="Megabytes of output the step writes. Default: %(default)s")
+        parser.add_argument('--line-length', type=int, default=100,
+                help="Length of each line of output. Default: %(default)s")
+        parser.add_argument('--max-output-size', type=int, default=5,
+                help="Megabytes of output the client keeps. Default: %(default)s")
+        parser.add_argument('--cancel-after', type=float, default=2,
+                help="Seconds to flood the step before canceling it. Default: %(default)s")
+
+    def handle(self, *args, **options):
+        if options["size"] < 1 or options["line_length"] < 1:
+            raise CommandError("Need a positive size and line length")
+        logging.getLogger('civet_client').setLevel(logging.ERROR)
+        mb = 1024*1024
+        stats = Benchmark.flood_step(options["size"]*mb, options["line_length"], options["max_output_size"]*mb)
+        self.stdout.write("Read %s MB in %.2f s (%.1f MB/s), %.2f s CPU, kept %.1f MB" % (options["size"],
+            stats["seconds"], options["size"] / stats["seconds"] if stats["seconds"] else 0,
+            stats["cpu_seconds"], stats["output_size"] / float(mb)))
+
+        stats = Benchmark.flood_step(options["size"]*mb, options["line_length"], options["max_output_size"]*mb,
+                cancel_after=options["cancel_after"])
+        self.stdout.write("Killed the step %.1f ms after canceling it" % (stats["cancel_latency"] * 1000))
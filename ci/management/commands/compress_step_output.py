@@ -0,0 +1,46 @@
+from __future__ import unicode_literals, absolute_import
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ci import models
+
+class Command(BaseCommand):
+    help = 'Compress the step output that is still stored uncompressed, or move it to files ' \
+            'if STEP_OUTPUT_DIR is set. This is done in batches so it can be run while the server is up.'
+    def add_arguments(self, parser):
+        parser.add_argument('--dryrun', default=False, action='store_true',
+                help="Don't make any changes, just report how many step results would be compressed")
+        parser.add_argument('--batch-size', type=int, default=100,
+                help="Number of step results to compress in each transaction. Default: %(default)s")
+
+    def handle(self, *args, **options):
+        # Running steps are compressed when they complete
+        q = models.StepResult.objects.exclude(output='').exclude(status=models.JobStatus.RUNNING)
+        total = q.count()
+        if options["dryrun"]:
+            self.stdout.write("DRY RUN: Would compress %s step results" % total)
+            return
+
+        done = 0
+        before = 0
+        after = 0
+        last_pk = 0
+        while True:
+            # Only get the ids so that a batch of big outputs isn't in memory at once
+            pks = list(q.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:options["batch_size"]])
+            if not pks:
+                break
+            with transaction.atomic():
+                for pk in pks:
+                    result = models.StepResult.objects.get(pk=pk)
+                    output = result.get_output()
+                    before += len(output.encode("utf-8", "replace"))
+                    result.set_output(output)
+                    after += len(result.compressed_output) or result.output_length()
+            last_pk = pks[-1]
+            done += len(pks)
+            self.stdout.write("Compressed %s/%s step results" % (done, total))
+
+        if done:
+            self.stdout.write("Output size: %s -> %s" % (models.humanize_bytes(before), models.humanize_bytes(after)))
+        else:
+            self.stdout.write("No step results to compress")
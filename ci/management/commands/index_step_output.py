@@ -0,0 +1,46 @@
+from __future__ import unicode_literals, absolute_import
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from datetime import timedelta
+from ci import models, OutputSearch
+
+class Command(BaseCommand):
+    help = 'Add the output of completed steps to the output search index in OUTPUT_SEARCH_INDEX. ' \
+            'New output is added as steps complete so this is only needed for older output ' \
+            'or output that a server process didn\'t get to.'
+    def add_arguments(self, parser):
+        parser.add_argument('--dryrun', default=False, action='store_true',
+                help="Don't make any changes, just report how many step results would be indexed")
+        parser.add_argument('--days', type=int, default=30,
+                help="Only index steps modified in this many days. Default: %(default)s")
+        parser.add_argument('--batch-size', type=int, default=100,
+                help="Number of step results to load at a time. Default: %(default)s")
+        parser.add_argument('--reindex', default=False, action='store_true',
+                help="Also index steps whose output is already in the index")
+
+    def handle(self, *args, **options):
+        if not OutputSearch.enabled():
+            raise CommandError("OUTPUT_SEARCH_INDEX is not set")
+
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        # Oldest first since newer rows come first in the search results
+        q = models.StepResult.objects.filter(complete=True, last_modified__gte=cutoff)
+        if not options["reindex"]:
+            q = q.filter(output_indexed=False)
+        total = q.count()
+        if options["dryrun"]:
+            self.stdout.write("DRY RUN: Would index %s step results" % total)
+            return
+
+        done = 0
+        pks = list(q.order_by('last_modified', 'pk').values_list('pk', flat=True))
+        for i in range(0, len(pks), options["batch_size"]):
+            batch = pks[i:i+options["batch_size"]]
+            results = models.StepResult.objects.select_related('job__recipe').in_bulk(batch)
+            for pk in batch:
+                if pk in results:
+                    OutputSearch.index_step_result(results[pk])
+            done += len(batch)
+            self.stdout.write("Indexed %s/%s step results" % (done, total))
+        if not done:
+            self.stdout.write("No step results to index")
@@ -0,0 +1,62 @@
+from __future__ import unicode_literals, absolute_import
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Q
+from ci import models, views, TimeUtils
+from ci.client import UpdateRemoteStatus
+from datetime import timedelta
+
+class Command(BaseCommand):
+    help = 'Find running jobs whose client has stopped talking to the server and put them back in the ' \
+            'queue so that another client can run them. Meant to be run periodically, like from cron.'
+    def add_arguments(self, parser):
+        parser.add_argument('--dryrun', default=False, action='store_true',
+                help="Don't make any changes, just report what would have happened")
+        parser.add_argument('--cancel', default=False, action='store_true',
+                help="Cancel the orphaned jobs instead of invalidating them so they run again")
+        parser.add_argument('--minutes', type=int, default=30,
+                help="A job is orphaned if neither its client nor its output have been updated " \
+                        "in this many minutes. Default: %(default)s")
+
+    def handle(self, *args, **options):
+        dryrun = options["dryrun"]
+        cancel = options["cancel"]
+        cutoff = TimeUtils.get_local_time() - timedelta(minutes=options["minutes"])
+
+        jobs = (models.Job.objects
+                .filter(complete=False, status=models.JobStatus.RUNNING, last_modified__lt=cutoff)
+                .filter(Q(client=None) | Q(client__last_seen__lt=cutoff))
+                .annotate(output_modified=Max('step_results__last_modified'))
+                .filter(Q(output_modified=None) | Q(output_modified__lt=cutoff))
+                .select_related('client', 'event', 'recipe')
+                .order_by('pk'))
+
+        prefix = ""
+        if dryrun:
+            prefix = "DRY RUN: "
+
+        if cancel:
+            msg = "Job canceled"
+        else:
+            msg = "Job invalidated"
+
+        events = {}
+        for job in jobs:
+            client_name = job.client.name if job.client else None
+            self.stdout.write("%s%s: %s: %s: client %s" % (prefix, msg, job.pk, job, client_name))
+            if dryrun:
+                continue
+            err_msg = "Client %s stopped responding while running this job" % client_name
+            if cancel:
+                views.set_job_canceled(job, err_msg)
+                UpdateRemoteStatus.job_complete(job)
+                job.event.set_complete_if_done()
+            else:
+                # Only make the jobs ready once per event, like when invalidating an event
+                job.set_invalidated(err_msg, check_ready=False)
+                events[job.event.pk] = job.event
+
+        for event in events.values():
+            event.make_jobs_ready()
+
+        if not jobs:
+            self.stdout.write("No orphaned jobs")
@@ -14,7 +14,7 @@
 # limitations under the License.
 
 from __future__ import unicode_literals, absolute_import
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.urls import reverse
 from six import python_2_unicode_compatible
@@ -24,15 +24,16 @@ from ci.bitbucket import api as bitbucket_api
 from ci.bitbucket import oauth as bitbucket_auth
 from ci.github import api as github_api
 from ci.github import oauth as github_auth
-import random, re
+import random, re, zlib, codecs, itertools
 from django.utils import timezone
 from datetime import timedelta, datetime
-from ci import TimeUtils
+from ci import TimeUtils, OutputFiles, OutputHTML
 import json
-import ansi2html
 import logging
 import pytz
 from django.db.models import Sum
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 logger = logging.getLogger('ci')
 
 class DBException(Exception):
@@ -583,6 +584,7 @@ class Event(models.Model):
         Jobs are checked to see if dependencies are met and
         if so, then they are marked as ready.
         """
+        from ci.client import JobQueue # ci.client.JobQueue imports this module
 
         if self.check_done():
             self.complete = True
@@ -604,6 +606,7 @@ class Event(models.Model):
             if ready:
                 job.ready = ready
                 job.save()
+                JobQueue.update_job(job)
                 logger.info('{}: {}: {} : ready: {} : on {}'.format(job.event,
                     job.pk, job, job.ready, job.recipe.repository))
 
@@ -738,6 +741,26 @@ class Recipe(models.Model):
     def auto_str(self):
         return self.AUTO_CHOICES[self.automatic][1]
 
+    def output_retention(self):
+        """
+        How much of the output of each step of this recipe to keep.
+        This is the "output_retention" repository setting, with sizes in KB. For example:
+          {"head": 1024, "tail": 4096, "recipes": {"recipes/big.cfg": {"tail": 16384}}}
+        The entries in "recipes" are by recipe filename.
+        If it isn't set then settings.STEP_OUTPUT_RETENTION is used.
+        Return:
+          (int, int): Bytes to keep at the start and at the end of the output. None to keep all of it.
+        """
+        policy = self.repository.get_repo_setting("output_retention", settings.STEP_OUTPUT_RETENTION)
+        if not policy:
+            return None
+        recipe_policy = policy.get("recipes", {}).get(self.filename, {})
+        head = recipe_policy.get("head", policy.get("head"))
+        tail = recipe_policy.get("tail", policy.get("tail"))
+        if head is None or tail is None:
+            return None
+        return head*1024, tail*1024
+
 @python_2_unicode_compatible
 class RecipeViewableByTeam(models.Model):
     """
@@ -912,6 +935,9 @@ class Job(models.Model):
     failed_step = models.CharField(max_length=120, blank=True)
     # Just a cached value of the current running step
     running_step = models.CharField(max_length=120, blank=True)
+    # Set when a client claims the job before it finishes its current one.
+    # If the client hasn't started the job by then it goes back in the queue.
+    reserved_until = models.DateTimeField(null=True, blank=True, db_index=True)
     last_modified = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
 
@@ -955,7 +981,7 @@ class Job(models.Model):
     def total_output_size(self):
         total = 0
         for result in self.step_results.all():
-            total += len(result.output)
+            total += result.output_length()
         return humanize_bytes(total)
 
     def unique_name(self):
@@ -990,7 +1016,10 @@ class Job(models.Model):
             self.event.set_status(status)
 
     def set_invalidated(self, message, same_client=False, client=None, check_ready=False):
+        from ci.client import JobQueue # ci.client.JobQueue imports this module
         logger.info("Invalidating: %s : %s: %s" % (self.str_with_client(), self.pk, message))
+        # Take it out of the ready queue before the recipe changes. make_jobs_ready() will put it back.
+        JobQueue.remove_job(self)
         old_recipe = self.recipe
         self.complete = False
         latest_recipe = (Recipe.objects.filter(filename=self.recipe.filename, current=True,
@@ -1006,7 +1035,7 @@ class Job(models.Model):
             self.client = None
         self.active = True
         self.ready = False
-        self.step_results.all().delete()
+        delete_step_results(self.step_results.all())
         self.failed_step = ""
         self.running_step = ""
         self.event.complete = False
@@ -1086,20 +1115,50 @@ class JobChangeLog(models.Model):
     class Meta:
         ordering = ['-created',]
 
-def terminalize_output(output):
-    # Replace "<,&,>" signs
-    output = output.replace("&", "&amp;")
-    output = output.replace("<", "&lt;")
-    output = output.replace(">", "&gt;")
-    output = output.replace("\n", "<br/>")
-    '''
-       Substitute terminal color codes for CSS tags.
-       The bold tag can be a modifier on another tag
-       and thus sometimes doesn't have its own
-       closing tag. Just ignore it in that case.
-    '''
-    conv = ansi2html.Ansi2HTMLConverter(escaped=False, scheme="xterm")
-    return conv.convert(output, full=False)
+def compress_output(data):
+    """
+    Compresses step output for storage.
+    Input:
+      data[bytes]: The UTF-8 encoded output
+    Return:
+      bytes: zlib compressed output, empty if the output is empty
+    """
+    if not data:
+        return b''
+    return zlib.compress(data, settings.STEP_OUTPUT_COMPRESSION_LEVEL)
+
+def decompress_output(data):
+    """
+    Decompresses output from compress_output()
+    Input:
+      data[bytes or memoryview]: As stored in the database
+    Return:
+      str: The output
+    """
+    if not data:
+        return ""
+    return zlib.decompress(data).decode("utf-8", "replace")
+
+# Put in place of the output removed by an output retention policy
+ELIDED_MARKER = "\n\n... Output removed here to limit the size stored. Only the start and the end of the output are kept ...\n\n"
+ELIDED_MARKER_LENGTH = len(ELIDED_MARKER.encode("utf-8"))
+
+def utf8_boundary(data, pos):
+    """
+    The first position at or after pos that doesn't split a UTF-8 encoded character
+    """
+    while pos < len(data) and (data[pos] & 0xC0) == 0x80:
+        pos += 1
+    return pos
+
+def strip_color_codes(output):
+    """
+    Removes the terminal color codes from output
+    """
+    prefix = re.escape("\33[")
+    new_out = re.sub(prefix + r"1m", "", output)
+    new_out = re.sub(prefix + r"(1;)*(\d{1,2})m", "", new_out)
+    return new_out
 
 @python_2_unicode_compatible
 class StepResult(models.Model):
@@ -1122,7 +1181,21 @@ class StepResult(models.Model):
     exit_status = models.IntegerField(default=0) # return value of the script
     status = models.IntegerField(choices=JobStatus.STATUS_CHOICES, default=JobStatus.NOT_STARTED)
     complete = models.BooleanField(default=False)
-    output = models.TextField(blank=True) # output of the step
+    # Output of the step. Only older results have it stored here uncompressed.
+    # Output is stored compressed in compressed_output and, while the step is
+    # running, appended as StepResultChunk records. If settings.STEP_OUTPUT_DIR
+    # is set then it is stored in output_file instead.
+    # Use get_output() or read_output() to get it.
+    output = models.TextField(blank=True)
+    compressed_output = models.BinaryField(blank=True, default=b'')
+    compressed_length = models.PositiveIntegerField(default=0) # size in bytes of the output in compressed_output
+    output_file = models.CharField(max_length=300, blank=True, default='')
+    # Set when the middle of the output was removed by the output retention policy.
+    # The removed output started at elided_offset, where ELIDED_MARKER is now.
+    elided_offset = models.PositiveIntegerField(default=0)
+    elided_length = models.BigIntegerField(default=0) # size in bytes of the removed output
+    # Whether the complete output is in the output search index
+    output_indexed = models.BooleanField(default=False)
     seconds = models.DurationField(default=timedelta) #run time
     last_modified = models.DateTimeField(auto_now=True)
 
@@ -1133,23 +1206,395 @@ class StepResult(models.Model):
         unique_together = ['job', 'position']
         ordering = ['position',]
 
+    def delete(self, *args, **kwargs):
+        """
+        Also removes the output kept outside of the database, see delete_step_results()
+        """
+        results = [(self.pk, self.output_file)]
+        ret = super(StepResult, self).delete(*args, **kwargs)
+        transaction.on_commit(lambda: delete_step_output(results))
+        return ret
+
     def status_slug(self):
         return JobStatus.to_slug(self.status)
 
+    def get_output(self):
+        """
+        Reassembles the output from the output fields and the appended chunks, or the output file.
+        Uses the chunks from prefetch_related('output_chunks') if they are there.
+        """
+        if self.output_file:
+            return self.read_output()
+        parts = [self.output, decompress_output(self.compressed_output)]
+        parts.extend([chunk.get_output() for chunk in self.output_chunks.all()])
+        return "".join(parts)
+
+    def read_output(self, start=0, end=None):
+        """
+        Reads a range of the output. Only the parts of the output
+        in that range are read and decompressed.
+        Input:
+          start[int]: Byte offset in the UTF-8 encoded output
+          end[int]: Byte offset after the end, None for the end of the output
+        Return:
+          str: The output. Any characters split by the offsets are replaced.
+        """
+        if self.output_file:
+            return OutputFiles.read_range(self.output_file, start, end).decode("utf-8", "replace")
+
+        output = self.output.encode("utf-8", "replace")
+        # (size, function to get the data) of each part of the output in order
+        parts = [(len(output), lambda: output),
+                (self.compressed_length, lambda: zlib.decompress(self.compressed_output))]
+        if 'output_chunks' in getattr(self, '_prefetched_objects_cache', {}):
+            for chunk in self.output_chunks.all():
+                parts.append((chunk.length, lambda chunk=chunk: zlib.decompress(chunk.data)))
+        else:
+            # Only load the data of the chunks in the range
+            chunk_data = {}
+            def get_chunk(pk):
+                if not chunk_data:
+                    chunk_data.update(self.output_chunks.filter(pk__in=wanted).values_list('pk', 'data'))
+                return zlib.decompress(chunk_data[pk])
+
+            wanted = []
+            pos = len(output) + self.compressed_length
+            for pk, length in self.output_chunks.values_list('pk', 'length'):
+                if length and pos + length > start and (end is None or pos < end):
+                    wanted.append(pk)
+                parts.append((length, lambda pk=pk: get_chunk(pk)))
+                pos += length
+
+        data = []
+        pos = 0
+        for size, get_data in parts:
+            if end is not None and pos >= end:
+                break
+            if size and pos + size > start:
+                part_end = None if end is None else end - pos
+                data.append(get_data()[max(start - pos, 0):part_end])
+            pos += size
+        return b"".join(data).decode("utf-8", "replace")
+
+    def tail_output(self, size):
+        """
+        The last size bytes of the output
+        """
+        return self.read_output(max(self.output_length() - size, 0))
+
+    def iter_output(self, chunk_size=64*1024):
+        """
+        Reads the output in pieces so that all of it doesn't have
+        to be in memory at once.
+        Input:
+          chunk_size[int]: Maximum number of bytes to read at a time
+        Return:
+          generator of str: The output
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        for data in self._iter_output_bytes(chunk_size):
+            text = decoder.decode(data)
+            if text:
+                yield text
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
+
+    def _iter_output_bytes(self, chunk_size):
+        if self.output_file:
+            start = 0
+            while True:
+                data = OutputFiles.read_range(self.output_file, start, start + chunk_size)
+                if not data:
+                    return
+                yield data
+                start += len(data)
+
+        if self.output:
+            yield self.output.encode("utf-8", "replace")
+        if 'output_chunks' in getattr(self, '_prefetched_objects_cache', {}):
+            chunks = self.output_chunks.all()
+        else:
+            chunks = self.output_chunks.iterator()
+        for compressed in itertools.chain([self.compressed_output], (chunk.data for chunk in chunks)):
+            decompressor = zlib.decompressobj()
+            # Feed the compressed data in pieces and limit the size of what
+            # comes out since output usually compresses very well.
+            for i in range(0, len(compressed), chunk_size):
+                data = compressed[i:i+chunk_size]
+                while data:
+                    yield decompressor.decompress(data, chunk_size)
+                    data = decompressor.unconsumed_tail
+            yield decompressor.flush()
+
+    def use_output_file(self):
+        """
+        Whether new output goes in a file. Output that already started in
+        the database stays there until the step is complete.
+        """
+        if self.output_file:
+            return True
+        if not settings.STEP_OUTPUT_DIR or self.pk is None:
+            return False
+        return not self.output and not self.compressed_output and not self.output_chunks.exists()
+
+    def append_output(self, output, retention=None):
+        """
+        Appends output without rewriting what is already stored.
+        Input:
+          output[str]: The output to append
+          retention[(int, int)]: Sizes in bytes of the start and the end of the output
+            to keep, as from Recipe.output_retention(). None to keep all of it.
+        """
+        if not output:
+            return
+        data = output.encode("utf-8", "replace")
+        if retention is not None:
+            head_size, tail_size = retention
+            if self.elided_length:
+                self.append_tail(data, tail_size)
+                return
+            if self.output_length() + len(data) > head_size + tail_size:
+                # What is stored is small enough to read back
+                data = self.get_output().encode("utf-8", "replace") + data
+                head, tail = self.elide(data, head_size, tail_size)
+                self.write_output(head)
+                self.save()
+                self.append_data(tail)
+                OutputHTML.clear(self.pk)
+                return
+        self.append_data(data)
+
+    def append_data(self, data):
+        """
+        Appends UTF-8 encoded output
+        """
+        if not data:
+            return
+        if self.use_output_file():
+            if not self.output_file:
+                self.output_file = OutputFiles.output_path(settings.STEP_OUTPUT_DIR, self.job_id, self.pk)
+                StepResult.objects.filter(pk=self.pk).update(output_file=self.output_file)
+            OutputFiles.append(self.output_file, data)
+        else:
+            StepResultChunk.objects.create(step_result=self, data=compress_output(data), length=len(data))
+
+    def elide(self, data, head_size, tail_size):
+        """
+        Removes the middle of the output and sets elided_offset and elided_length.
+        Input:
+          data[bytes]: All the UTF-8 encoded output
+          head_size[int]: Bytes to keep at the start
+          tail_size[int]: Bytes to keep at the end
+        Return:
+          (bytes, bytes): The start of the output followed by ELIDED_MARKER, and the end of the output
+        """
+        head_end = utf8_boundary(data, head_size)
+        tail_start = max(utf8_boundary(data, len(data) - tail_size), head_end)
+        self.elided_offset = head_end
+        self.elided_length = tail_start - head_end
+        return data[:head_end] + ELIDED_MARKER.encode("utf-8"), data[tail_start:]
+
+    def append_tail(self, data, tail_size):
+        """
+        Appends to output that already had its middle removed. The oldest
+        output after ELIDED_MARKER is removed so that about tail_size bytes are kept.
+        """
+        head_length = self.elided_offset + ELIDED_MARKER_LENGTH
+        removed = 0
+        if self.output_file:
+            OutputFiles.append(self.output_file, data)
+            size = OutputFiles.size(self.output_file)
+            # Let the file grow to twice the tail so it isn't rewritten on every append
+            if size - head_length > 2*tail_size:
+                tail = OutputFiles.read_range(self.output_file, size - tail_size)
+                tail = tail[utf8_boundary(tail, 0):]
+                head = OutputFiles.read_range(self.output_file, 0, head_length)
+                OutputFiles.write(self.output_file, head + tail)
+                removed = size - head_length - len(tail)
+        else:
+            if len(data) > tail_size:
+                # All the older output after the marker has to go too
+                cut = utf8_boundary(data, len(data) - tail_size)
+                removed = cut + (self.output_chunks.aggregate(length=Sum('length'))['length'] or 0)
+                self.output_chunks.all().delete()
+                data = data[cut:]
+            self.append_data(data)
+            chunks = list(self.output_chunks.order_by('pk').values_list('pk', 'length'))
+            total = sum([length for pk, length in chunks])
+            old_chunks = []
+            for pk, length in chunks[:-1]:
+                if total - length < tail_size:
+                    break
+                old_chunks.append(pk)
+                total -= length
+                removed += length
+            if old_chunks:
+                StepResultChunk.objects.filter(pk__in=old_chunks).delete()
+
+        if removed:
+            self.elided_length += removed
+            self.save(update_fields=['elided_length'])
+            OutputHTML.clear(self.pk)
+
+    def set_output(self, output, retention=None):
+        """
+        Replaces all the output, compacting any chunks into compressed_output
+        or the output file.
+        Input:
+          output[str]: The output
+          retention[(int, int)]: As in append_output()
+        """
+        data = output.encode("utf-8", "replace")
+        self.elided_offset = 0
+        self.elided_length = 0
+        if retention is not None and len(data) > sum(retention):
+            head, tail = self.elide(data, retention[0], retention[1])
+            data = head + tail
+        self.write_output(data)
+        self.save()
+        OutputHTML.clear(self.pk)
+
+    def write_output(self, data):
+        """
+        Replaces the stored output with UTF-8 encoded output. Doesn't save.
+        """
+        self.output_chunks.all().delete()
+        self.output = ""
+        if settings.STEP_OUTPUT_DIR and self.pk is not None:
+            self.output_file = OutputFiles.output_path(settings.STEP_OUTPUT_DIR, self.job_id, self.pk)
+            OutputFiles.write(self.output_file, data)
+            self.compressed_output = b''
+            self.compressed_length = 0
+        else:
+            if self.output_file:
+                OutputFiles.delete(self.output_file)
+                self.output_file = ''
+            self.compressed_length = len(data)
+            self.compressed_output = compress_output(data)
+
+    def output_position(self, offset):
+        """
+        Where a byte offset in the stored output is in all the output that was sent.
+        They differ after output was removed by the output retention policy.
+        """
+        if self.elided_length and offset >= self.elided_offset + ELIDED_MARKER_LENGTH:
+            return offset - ELIDED_MARKER_LENGTH + self.elided_length
+        return offset
+
+    def output_offset(self, position):
+        """
+        The reverse of output_position().
+        Return:
+          int: The byte offset in the stored output, None if the position was in removed output
+        """
+        if not self.elided_length or position <= self.elided_offset:
+            return position
+        offset = position + ELIDED_MARKER_LENGTH - self.elided_length
+        if offset < self.elided_offset + ELIDED_MARKER_LENGTH:
+            return None
+        return offset
+
+    def sent_output_length(self):
+        """
+        Size in bytes of all the output that was sent, including any removed output.
+        """
+        return self.output_position(self.output_length())
+
     def clean_output(self):
-        # If the output is over 2Mb then just return a too big message.
-        if len(self.output) > (1024*1024*2):
-            return "Output too large. You will need to download the results to see this."
-        return terminalize_output(self.output)
+        """
+        The output as HTML. Only the end of it if it is too large.
+        """
+        return OutputHTML.render(self)
+
+    def clean_output_position(self):
+        """
+        The output as HTML, as in clean_output(), and the position of the end
+        of the rendered output in all the output that was sent.
+        Return:
+          (str, int): The HTML and the position
+        """
+        html, offset = OutputHTML.render_with_offset(self)
+        return html, self.output_position(offset)
 
     def plain_output(self):
-        prefix = re.escape("\33[")
-        new_out = re.sub(prefix + r"1m", "", self.output)
-        new_out = re.sub(prefix + r"(1;)*(\d{1,2})m", "", new_out)
-        return new_out
+        return strip_color_codes(self.get_output())
+
+    def output_length(self):
+        """
+        Size in bytes of the output, without reading or decompressing it.
+        """
+        if self.output_file:
+            return OutputFiles.size(self.output_file)
+        if 'output_chunks' in getattr(self, '_prefetched_objects_cache', {}):
+            chunks = sum([chunk.length for chunk in self.output_chunks.all()])
+        else:
+            chunks = self.output_chunks.aggregate(length=Sum('length'))['length']
+        return len(self.output.encode("utf-8", "replace")) + self.compressed_length + (chunks or 0)
 
     def output_size(self):
-        return humanize_bytes(len(self.output))
+        return humanize_bytes(self.output_length())
+
+class StepResultChunk(models.Model):
+    """
+    Output appended to a StepResult while it is running.
+    Appending a chunk is a single small insert instead of
+    rewriting all the output of the StepResult.
+    Each chunk is compressed on its own.
+    """
+    step_result = models.ForeignKey(StepResult, related_name='output_chunks', on_delete=models.CASCADE)
+    data = models.BinaryField(blank=True, default=b'')
+    length = models.PositiveIntegerField(default=0) # size in bytes of the decompressed output
+
+    class Meta:
+        ordering = ['pk',]
+
+    def get_output(self):
+        return decompress_output(self.data)
+
+def delete_step_results(step_results):
+    """
+    Deletes step results with a plain queryset delete and removes their output
+    files, cached HTML and search index rows once the transaction commits.
+    There are no delete signals on StepResult since with them Django would
+    load every row, with its output, to delete them.
+    Input:
+      step_results[QuerySet]: The StepResults to delete
+    """
+    results = list(step_results.values_list('pk', 'output_file'))
+    if results:
+        # The output chunks cascade so Django loads the rows, only load their IDs
+        StepResult.objects.filter(pk__in=[pk for pk, output_file in results]).only('pk').delete()
+        transaction.on_commit(lambda: delete_step_output(results))
+
+def delete_step_output(results):
+    """
+    Removes what is kept outside of the database for deleted step results
+    Input:
+      results[list of (int, str)]: The pk and output_file of each step result
+    """
+    from ci import OutputSearch # ci.OutputSearch imports this module
+    for pk, output_file in results:
+        if output_file:
+            OutputFiles.delete(output_file)
+    pks = [pk for pk, output_file in results]
+    OutputHTML.clear_many(pks)
+    OutputSearch.remove_later(pks)
+
+@receiver(post_delete, sender=Job)
+def delete_job_output(sender, instance, **kwargs):
+    """
+    The step results of a deleted job are removed by the cascade, which doesn't
+    say which ones they were. So remove their output by job. Any cached HTML
+    just expires.
+    """
+    from ci import OutputSearch # ci.OutputSearch imports this module
+    job_pk = instance.pk
+    def delete_output():
+        if settings.STEP_OUTPUT_DIR:
+            OutputFiles.delete_job(settings.STEP_OUTPUT_DIR, job_pk)
+        OutputSearch.remove_job_later(job_pk)
+    transaction.on_commit(delete_output)
 
 def incomplete_status(status):
     """
@@ -16,6 +16,7 @@
 from __future__ import unicode_literals, absolute_import
 from django.test import TestCase, Client
 from django.conf import settings
+from django.core.cache import cache
 from ci import models
 from ci.tests import utils
 from django.test.client import RequestFactory
@@ -173,5 +174,7 @@ class DBCompare(object):
 
 class DBTester(TestCase, DBCompare):
     def setUp(self):
+        # The ready job queues are kept in the cache which isn't reset between tests
+        cache.clear()
         self.client = Client()
         self.factory = RequestFactory()
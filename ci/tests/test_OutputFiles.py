@@ -0,0 +1,80 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import unicode_literals, absolute_import
+from django.test import SimpleTestCase
+from mock import patch
+from ci import OutputFiles
+import os, shutil, tempfile
+
+class Tests(SimpleTestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.path = OutputFiles.output_path(self.base_dir, 1, 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def test_output_path(self):
+        self.assertEqual(self.path, os.path.join(self.base_dir, "1", "2.log"))
+
+    def test_write(self):
+        OutputFiles.write(self.path, b"foo")
+        OutputFiles.append(self.path, b"bar")
+        self.assertEqual(OutputFiles.read_range(self.path), b"foobar")
+        OutputFiles.write(self.path, b"baz")
+        self.assertEqual(OutputFiles.read_range(self.path), b"baz")
+
+        # A failed write leaves the old contents and no temporary file
+        with patch.object(os, 'replace', side_effect=OSError("No space left on device")):
+            with self.assertRaises(OSError):
+                OutputFiles.write(self.path, b"new")
+        self.assertEqual(OutputFiles.read_range(self.path), b"baz")
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["2.log"])
+
+    def test_read(self):
+        # Missing file
+        self.assertEqual(OutputFiles.size(self.path), 0)
+        self.assertEqual(OutputFiles.read_range(self.path), b"")
+        self.assertEqual(OutputFiles.read_range(self.path, 1, 2), b"")
+
+        OutputFiles.write(self.path, b"0123456789")
+        self.assertEqual(OutputFiles.size(self.path), 10)
+        self.assertEqual(OutputFiles.read_range(self.path, 2, 5), b"234")
+        self.assertEqual(OutputFiles.read_range(self.path, 8), b"89")
+        self.assertEqual(OutputFiles.read_range(self.path, 8, 100), b"89")
+        self.assertEqual(OutputFiles.read_range(self.path, 5, 5), b"")
+        self.assertEqual(OutputFiles.read_range(self.path, 100), b"")
+
+    def test_delete(self):
+        # Missing file
+        OutputFiles.delete(self.path)
+
+        other = OutputFiles.output_path(self.base_dir, 1, 3)
+        OutputFiles.write(self.path, b"foo")
+        OutputFiles.write(other, b"bar")
+        # The directory still has the other file
+        OutputFiles.delete(self.path)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(os.path.exists(other))
+        # Now it is empty
+        OutputFiles.delete(other)
+        self.assertFalse(os.path.exists(os.path.dirname(other)))
+
+        OutputFiles.write(self.path, b"foo")
+        OutputFiles.write(other, b"bar")
+        OutputFiles.delete_job(self.base_dir, 1)
+        self.assertFalse(os.path.exists(os.path.dirname(self.path)))
+        # Already gone
+        OutputFiles.delete_job(self.base_dir, 1)
@@ -0,0 +1,103 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import unicode_literals, absolute_import
+from django.core.cache import cache
+from mock import patch
+from ci.tests import DBTester, utils
+from ci import OutputHTML
+
+class Tests(DBTester.DBTester):
+    def test_carry_codes(self):
+        self.assertEqual(OutputHTML.carry_codes("", "foo"), "")
+        self.assertEqual(OutputHTML.carry_codes("", "\33[1mfoo\33[31m"), "\33[1m\33[31m")
+        self.assertEqual(OutputHTML.carry_codes("\33[1m", "\33[31mfoo"), "\33[1m\33[31m")
+        self.assertEqual(OutputHTML.carry_codes("\33[1m", "\33[31mfoo\33[0mbar"), "")
+        self.assertEqual(OutputHTML.carry_codes("\33[1m", "\33[mbar\33[32m"), "\33[32m")
+
+    def test_render(self):
+        sr = utils.create_step_result()
+        self.assertEqual(sr.clean_output(), "")
+
+        sr.append_output("<a>\n\33[31mred")
+        self.assertEqual(sr.clean_output(), '&lt;a&gt;<br/><span class="ansi31">red</span>')
+
+        # Unchanged output isn't rendered again
+        with patch.object(OutputHTML, 'terminalize_output') as mock_render:
+            self.assertEqual(sr.clean_output(), '&lt;a&gt;<br/><span class="ansi31">red</span>')
+            self.assertEqual(OutputHTML.render_since(sr, 12), ("", 12))
+            self.assertEqual(mock_render.call_count, 0)
+
+        # Only the new output is rendered, with the colors in effect before it
+        sr.append_output(" still\n\33[0mplain")
+        with patch.object(OutputHTML, 'terminalize_output', wraps=OutputHTML.terminalize_output) as mock_render:
+            html, offset = OutputHTML.render_since(sr, 12)
+            mock_render.assert_called_once_with("\33[31m still\n\33[0mplain")
+        self.assertEqual(html, '<span class="ansi31"> still<br/></span>plain')
+        self.assertEqual(offset, 28)
+        self.assertEqual(sr.clean_output(), '&lt;a&gt;<br/><span class="ansi31">red</span>' + html)
+        # Earlier offsets that the HTML was extended at still work
+        self.assertEqual(OutputHTML.render_since(sr, 0)[0], sr.clean_output())
+        self.assertIsNone(OutputHTML.render_since(sr, 5))
+
+        # An escape sequence split between appends waits for the rest of it
+        sr.append_output("a\33[3")
+        self.assertEqual(OutputHTML.render_since(sr, 28), ("a", 29))
+        self.assertEqual(OutputHTML.render_with_offset(sr)[1], 29)
+        self.assertEqual(sr.clean_output_position(), (sr.clean_output(), 29))
+        sr.append_output("2mb")
+        self.assertEqual(OutputHTML.render_since(sr, 29), ('<span class="ansi32">b</span>', 35))
+        self.assertTrue(sr.clean_output().endswith('plaina<span class="ansi32">b</span>'))
+
+        # Replacing the output clears the cache
+        sr.set_output("\33[31mred and more")
+        self.assertEqual(sr.clean_output(), '<span class="ansi31">red and more</span>')
+        self.assertIsNone(OutputHTML.render_since(sr, 28))
+
+        pk = sr.pk
+        self.assertIsNotNone(cache.get(OutputHTML.html_key(pk)))
+        with self.captureOnCommitCallbacks(execute=True):
+            sr.delete()
+        self.assertIsNone(cache.get(OutputHTML.html_key(pk)))
+
+    def test_render_range(self):
+        sr = utils.create_step_result()
+        sr.append_output("\33[1mbold \33[31mred\33[0m plain \33[32mgreen\33[3")
+        self.assertEqual(OutputHTML.render_range(sr, 0, 9), ('<span class="ansi1">bold </span>', 9))
+        self.assertEqual(OutputHTML.render_range(sr, 14, 17), ('<span class="ansi1"></span><span class="ansi1 ansi31">red</span>', 17))
+        self.assertEqual(OutputHTML.render_range(sr, 21, 28), (' plain ', 28))
+        # A split escape sequence is left for later
+        html, end = OutputHTML.render_range(sr, 33, sr.output_length())
+        self.assertEqual(html, '<span class="ansi32">green</span>')
+        self.assertEqual(end, 38)
+        self.assertEqual(OutputHTML.render_range(sr, 38, sr.output_length()), ("", 38))
+        # Only so far back for the colors
+        with patch.object(OutputHTML, 'MAX_CARRY_SEARCH', 3):
+            self.assertEqual(OutputHTML.render_range(sr, 33, 38), ('green', 38))
+
+    def test_render_tail(self):
+        sr = utils.create_step_result()
+        sr.set_output("first\n" + "g"*(OutputHTML.MAX_SIZE) + "\nend")
+        html = sr.clean_output()
+        self.assertTrue(html.startswith("Output too large"))
+        self.assertTrue(html.endswith("<br/>end"))
+        self.assertNotIn("first", html)
+        self.assertIsNone(OutputHTML.render_since(sr, 6))
+
+        with patch.object(OutputHTML, 'terminalize_output') as mock_render:
+            self.assertEqual(sr.clean_output(), html)
+            self.assertEqual(mock_render.call_count, 0)
+
+        sr.append_output("\nmore")
+        self.assertTrue(sr.clean_output().endswith("<br/>more"))
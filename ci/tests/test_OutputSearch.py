@@ -0,0 +1,222 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import unicode_literals, absolute_import
+from django.test import override_settings
+from mock import patch, Mock, call
+from ci.tests import DBTester, utils
+from ci import models, OutputSearch, Permissions
+import os, queue, shutil, sqlite3, tempfile, time
+
+@override_settings(INSTALLED_GITSERVERS=[utils.github_config()])
+class Tests(DBTester.DBTester):
+    def setUp(self):
+        super(Tests, self).setUp()
+        self.index_dir = tempfile.mkdtemp()
+        self.index_settings = override_settings(OUTPUT_SEARCH_INDEX=os.path.join(self.index_dir, "index.sqlite3"))
+        self.index_settings.enable()
+
+    def tearDown(self):
+        OutputSearch.close()
+        self.index_settings.disable()
+        shutil.rmtree(self.index_dir)
+        super(Tests, self).tearDown()
+
+    def create_result(self, output, position=0, job=None, status=models.JobStatus.SUCCESS):
+        result = utils.create_step_result(job=job, position=position, status=status)
+        result.complete = True
+        result.set_output(output)
+        OutputSearch.index_step_result(result)
+        return result
+
+    def test_search(self):
+        self.assertEqual(OutputSearch.search("error"), [])
+        r0 = self.create_result("ok\n\33[31mError: <bad> thing\33[0m\n\nlast error")
+        r1 = self.create_result("another ERROR\n", position=1, job=r0.job, status=models.JobStatus.FAILED)
+
+        matches = OutputSearch.search("error")
+        self.assertEqual([(m['step_result_id'], m['line']) for m in matches],
+                [(r1.pk, 1), (r0.pk, 4), (r0.pk, 2)])
+        self.assertEqual(matches[0]['job_id'], r0.job.pk)
+        self.assertEqual(matches[0]['snippet'], "another <mark>ERROR</mark>")
+        self.assertEqual(matches[2]['snippet'], "<mark>Error</mark>: &lt;bad&gt; thing")
+
+        # The whole text has to match
+        self.assertEqual(len(OutputSearch.search("error: <bad>")), 1)
+        self.assertEqual(len(OutputSearch.search('bad" thing')), 0)
+        # Too short for the index
+        self.assertEqual(OutputSearch.search("ok"), [])
+
+        self.assertEqual(len(OutputSearch.search("error", limit=1)), 1)
+        self.assertEqual(len(OutputSearch.search("error", status=models.JobStatus.FAILED)), 1)
+        repo = r0.job.recipe.repository
+        self.assertEqual(len(OutputSearch.search("error", repository_ids=[repo.pk])), 3)
+        self.assertEqual(OutputSearch.search("error", repository_ids=[repo.pk + 1]), [])
+        self.assertEqual(OutputSearch.search("error", repository_ids=[]), [])
+        self.assertEqual(len(OutputSearch.search("error", recipe_name=r0.job.recipe.name)), 3)
+        self.assertEqual(OutputSearch.search("error", recipe_name="foo"), [])
+        self.assertEqual(len(OutputSearch.search("error", since=time.time() - 60)), 3)
+        self.assertEqual(OutputSearch.search("error", until=time.time() - 60), [])
+
+        # Indexing again replaces the lines
+        r0.set_output("nothing")
+        OutputSearch.index_step_result(r0)
+        self.assertEqual(len(OutputSearch.search("error")), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            r1.delete()
+        OutputSearch.wait_for_index()
+        self.assertEqual(OutputSearch.search("error"), [])
+        self.assertEqual(len(OutputSearch.search("nothing")), 1)
+
+        # The rest of the step results go with the job
+        with self.captureOnCommitCallbacks(execute=True):
+            r0.job.delete()
+        OutputSearch.wait_for_index()
+        self.assertEqual(OutputSearch.search("nothing"), [])
+
+    def test_remove_error(self):
+        # Nothing is left half removed
+        conn = Mock()
+        conn.execute.side_effect = [None, sqlite3.OperationalError("database is locked"), None]
+        with patch.object(OutputSearch, 'get_connection', return_value=conn):
+            with self.assertRaises(sqlite3.OperationalError):
+                OutputSearch.remove([1])
+            self.assertEqual(conn.execute.call_args, call("ROLLBACK"))
+
+            conn.execute.side_effect = [None, sqlite3.OperationalError("database is locked"), None]
+            with self.assertRaises(sqlite3.OperationalError):
+                OutputSearch.remove_job(1)
+            self.assertEqual(conn.execute.call_args, call("ROLLBACK"))
+
+    def test_index_batches(self):
+        with patch.object(OutputSearch, 'INSERT_BATCH_SIZE', 2):
+            result = self.create_result("".join("line{}\n".format(i) for i in range(5)))
+        self.assertEqual(sorted(m['line'] for m in OutputSearch.search("line")), [1, 2, 3, 4, 5])
+        result.refresh_from_db()
+        self.assertTrue(result.output_indexed)
+
+        # A failure part way through leaves the old lines
+        result.output_indexed = False
+        result.set_output("other\n")
+        with patch.object(OutputSearch, 'output_lines', side_effect=MemoryError):
+            with self.assertRaises(MemoryError):
+                OutputSearch.index_step_result(result)
+        self.assertEqual(len(OutputSearch.search("line")), 5)
+        self.assertEqual(OutputSearch.search("other"), [])
+        result.refresh_from_db()
+        self.assertFalse(result.output_indexed)
+
+    def test_long_lines(self):
+        with self.settings(OUTPUT_SEARCH_MAX_LINE=10):
+            self.create_result("a" * 9 + "bc\nfoo")
+        self.assertEqual(len(OutputSearch.search("aab")), 1)
+        self.assertEqual(OutputSearch.search("abc"), [])
+        self.assertEqual(OutputSearch.search("foo")[0]['line'], 2)
+
+    def test_index_later(self):
+        result = utils.create_step_result(status=models.JobStatus.SUCCESS)
+        result.complete = True
+        result.set_output("error")
+        index_queue = queue.Queue()
+        with patch.object(OutputSearch, 'get_index_queue', return_value=index_queue):
+            # Only after the transaction commits
+            with self.captureOnCommitCallbacks(execute=True):
+                OutputSearch.index_later(result)
+                self.assertTrue(index_queue.empty())
+        self.assertEqual(index_queue.get_nowait(), (OutputSearch.index_pending, result.pk))
+
+        OutputSearch.index_pending(result.pk)
+        self.assertEqual(len(OutputSearch.search("error")), 1)
+        result.refresh_from_db()
+        self.assertTrue(result.output_indexed)
+
+        # Already indexed
+        with patch.object(OutputSearch, 'index_step_result') as mock_index:
+            OutputSearch.index_pending(result.pk)
+            self.assertEqual(mock_index.call_count, 0)
+
+        # Not complete
+        models.StepResult.objects.filter(pk=result.pk).update(complete=False, output_indexed=False)
+        with patch.object(OutputSearch, 'index_step_result') as mock_index:
+            OutputSearch.index_pending(result.pk)
+            self.assertEqual(mock_index.call_count, 0)
+
+        # Deleted
+        OutputSearch.index_pending(result.pk + 1)
+
+        # Not indexed if the index fails
+        models.StepResult.objects.filter(pk=result.pk).update(complete=True)
+        with patch.object(OutputSearch, 'get_connection', side_effect=sqlite3.OperationalError("database is locked")):
+            with self.assertRaises(sqlite3.OperationalError):
+                OutputSearch.index_pending(result.pk)
+        result.refresh_from_db()
+        self.assertFalse(result.output_indexed)
+
+    def test_index_worker(self):
+        # Errors are logged by the background thread
+        func = Mock(side_effect=Exception("Bad index"))
+        OutputSearch.get_index_queue().put((func, 1))
+        OutputSearch.wait_for_index()
+        func.assert_called_once_with(1)
+        # And it keeps going
+        func.side_effect = None
+        OutputSearch.get_index_queue().put((func, 2))
+        OutputSearch.wait_for_index()
+        self.assertEqual(func.call_count, 2)
+        func.assert_called_with(2)
+
+    def test_disabled(self):
+        with self.settings(OUTPUT_SEARCH_INDEX=None):
+            result = self.create_result("error")
+            OutputSearch.remove([result.pk])
+            OutputSearch.remove_job(result.job.pk)
+            OutputSearch.remove_later([result.pk])
+            OutputSearch.remove_job_later(result.job.pk)
+        self.assertEqual(OutputSearch.search("error"), [])
+
+    @patch.object(Permissions, 'viewable_repos')
+    def test_find_jobs(self, mock_repos):
+        r0 = self.create_result("error 0")
+        r1 = self.create_result("error 1", position=1, job=r0.job)
+        job = utils.create_job(recipe=utils.create_recipe(name="other"))
+        r2 = self.create_result("error 2", job=job)
+        models.Recipe.objects.update(private=False)
+        repo = r0.job.recipe.repository
+        mock_repos.return_value = [repo.pk]
+        session = self.client.session
+
+        jobs = OutputSearch.find_jobs(session, "error")
+        self.assertEqual([j.pk for j, matches in jobs], [job.pk, r0.job.pk])
+        self.assertEqual([m['step_result'] for m in jobs[1][1]], [r1, r0])
+
+        jobs = OutputSearch.find_jobs(session, "error", repository=repo, recipe_name="other")
+        self.assertEqual([j.pk for j, matches in jobs], [job.pk])
+
+        # Can't see the repo
+        mock_repos.return_value = []
+        self.assertEqual(OutputSearch.find_jobs(session, "error"), [])
+
+        # Can't see the results of a private recipe
+        mock_repos.return_value = [repo.pk]
+        models.Recipe.objects.filter(pk=job.recipe.pk).update(private=True)
+        jobs = OutputSearch.find_jobs(session, "error")
+        self.assertEqual([j.pk for j, matches in jobs], [r0.job.pk])
+
+        # Deleted without updating the index
+        with self.settings(OUTPUT_SEARCH_INDEX=None):
+            r2.job.delete()
+            r0.delete()
+        jobs = OutputSearch.find_jobs(session, "error")
+        self.assertEqual([m['step_result'] for m in jobs[0][1]], [r1])
@@ -18,9 +18,9 @@ from django.core.management.base import CommandError
 from six import StringIO
 from django.test import override_settings
 from mock import patch
-from ci import models, TimeUtils
+from ci import models, TimeUtils, OutputSearch
 from ci.tests import DBTester, utils
-import json
+import json, os, shutil, tempfile
 from requests_oauthlib import OAuth2Session
 from datetime import timedelta
 
@@ -323,6 +323,172 @@ class Tests(DBTester.DBTester):
                     stdout=out)
         self.compare_counts()
 
+    @patch.object(OAuth2Session, 'get')
+    @patch.object(OAuth2Session, 'post')
+    def test_reap_orphaned_jobs(self, mock_post, mock_get):
+        out = StringIO()
+        management.call_command("reap_orphaned_jobs", stdout=out)
+        self.assertIn("No orphaned jobs", out.getvalue())
+
+        client = utils.create_client()
+        j = utils.create_job()
+        utils.update_job(j, ready=True, active=True, status=models.JobStatus.RUNNING, client=client)
+        result = utils.create_step_result(job=j)
+        old = TimeUtils.get_local_time() - timedelta(hours=1)
+
+        def make_old(client_old=True, job_old=True, result_old=True):
+            # Use update() so that the auto_now fields don't get set
+            if client_old:
+                models.Client.objects.filter(pk=client.pk).update(last_seen=old)
+            if job_old:
+                models.Job.objects.filter(pk=j.pk).update(last_modified=old)
+            if result_old:
+                models.StepResult.objects.filter(pk=result.pk).update(last_modified=old)
+
+        # Everything is recent
+        out = StringIO()
+        self.set_counts()
+        management.call_command("reap_orphaned_jobs", stdout=out)
+        self.compare_counts()
+        self.assertIn("No orphaned jobs", out.getvalue())
+
+        # The client is still talking to the server
+        make_old(client_old=False)
+        out = StringIO()
+        management.call_command("reap_orphaned_jobs", stdout=out)
+        self.assertIn("No orphaned jobs", out.getvalue())
+
+        # The client is still sending output
+        make_old(result_old=False)
+        models.StepResult.objects.filter(pk=result.pk).update(last_modified=TimeUtils.get_local_time())
+        out = StringIO()
+        management.call_command("reap_orphaned_jobs", stdout=out)
+        self.assertIn("No orphaned jobs", out.getvalue())
+
+        # Make sure dryrun doesn't change anything
+        make_old()
+        out = StringIO()
+        self.set_counts()
+        management.call_command("reap_orphaned_jobs", "--dryrun", stdout=out)
+        self.compare_counts()
+        self.assertIn("DRY RUN: Job invalidated: %s" % j.pk, out.getvalue())
+
+        # Not old enough
+        out = StringIO()
+        management.call_command("reap_orphaned_jobs", "--minutes", "90", stdout=out)
+        self.assertIn("No orphaned jobs", out.getvalue())
+
+        # The job gets invalidated and is ready to run again
+        out = StringIO()
+        self.set_counts()
+        management.call_command("reap_orphaned_jobs", stdout=out)
+        self.compare_counts(invalidated=1, num_changelog=1)
+        self.assertIn("Job invalidated: %s" % j.pk, out.getvalue())
+        j.refresh_from_db()
+        self.assertEqual(j.status, models.JobStatus.NOT_STARTED)
+        self.assertTrue(j.ready)
+        self.assertIsNone(j.client)
+        self.assertEqual(j.step_results.count(), 0)
+
+        # Cancel instead
+        utils.update_job(j, status=models.JobStatus.RUNNING, client=client)
+        result = utils.create_step_result(job=j)
+        make_old()
+        out = StringIO()
+        self.set_counts()
+        management.call_command("reap_orphaned_jobs", "--cancel", stdout=out)
+        self.compare_counts(canceled=1, events_canceled=1, num_events_completed=1,
+                num_jobs_completed=1, num_changelog=1, active_branches=1)
+        self.assertIn("Job canceled: %s" % j.pk, out.getvalue())
+        j.refresh_from_db()
+        self.assertEqual(j.status, models.JobStatus.CANCELED)
+        self.assertTrue(j.complete)
+
+    def test_compress_step_output(self):
+        out = StringIO()
+        management.call_command("compress_step_output", stdout=out)
+        self.assertIn("No step results to compress", out.getvalue())
+
+        results = []
+        for i in range(3):
+            result = utils.create_step_result(position=i)
+            result.output = "output %s\n" % i * 100
+            result.status = models.JobStatus.SUCCESS
+            result.save()
+            results.append(result)
+        results[1].append_output("more")
+        results[2].status = models.JobStatus.RUNNING
+        results[2].save()
+
+        out = StringIO()
+        management.call_command("compress_step_output", "--dryrun", stdout=out)
+        self.assertIn("Would compress 2 step results", out.getvalue())
+        results[0].refresh_from_db()
+        self.assertNotEqual(results[0].output, "")
+
+        out = StringIO()
+        management.call_command("compress_step_output", "--batch-size", "1", stdout=out)
+        self.assertIn("Compressed 1/2 step results", out.getvalue())
+        self.assertIn("Compressed 2/2 step results", out.getvalue())
+        for result in results:
+            result.refresh_from_db()
+        self.assertEqual(results[0].output, "")
+        self.assertEqual(results[0].get_output(), "output 0\n" * 100)
+        self.assertEqual(results[1].output, "")
+        self.assertEqual(results[1].output_chunks.count(), 0)
+        self.assertEqual(results[1].get_output(), "output 1\n" * 100 + "more")
+        # Still running, so not changed
+        self.assertEqual(results[2].output, "output 2\n" * 100)
+
+        out = StringIO()
+        management.call_command("compress_step_output", stdout=out)
+        self.assertIn("No step results to compress", out.getvalue())
+
+    def test_index_step_output(self):
+        with self.assertRaises(CommandError):
+            management.call_command("index_step_output", stdout=StringIO())
+
+        index_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(OUTPUT_SEARCH_INDEX=os.path.join(index_dir, "index.sqlite3")):
+                out = StringIO()
+                management.call_command("index_step_output", stdout=out)
+                self.assertIn("No step results to index", out.getvalue())
+
+                for i in range(3):
+                    result = utils.create_step_result(position=i)
+                    result.complete = i != 2
+                    result.set_output("error %s\n" % i)
+
+                out = StringIO()
+                management.call_command("index_step_output", "--dryrun", stdout=out)
+                self.assertIn("Would index 2 step results", out.getvalue())
+                self.assertEqual(OutputSearch.search("error"), [])
+
+                out = StringIO()
+                management.call_command("index_step_output", "--batch-size", "1", stdout=out)
+                self.assertIn("Indexed 2/2 step results", out.getvalue())
+                self.assertEqual([m['snippet'] for m in OutputSearch.search("error")],
+                        ["<mark>error</mark> 1", "<mark>error</mark> 0"])
+                self.assertEqual(models.StepResult.objects.filter(output_indexed=True).count(), 2)
+
+                # Already indexed
+                out = StringIO()
+                management.call_command("index_step_output", stdout=out)
+                self.assertIn("No step results to index", out.getvalue())
+
+                out = StringIO()
+                management.call_command("index_step_output", "--reindex", stdout=out)
+                self.assertIn("Indexed 2/2 step results", out.getvalue())
+                self.assertEqual(len(OutputSearch.search("error")), 2)
+
+                out = StringIO()
+                management.call_command("index_step_output", "--reindex", "--days", "0", stdout=out)
+                self.assertIn("No step results to index", out.getvalue())
+                OutputSearch.close()
+        finally:
+            shutil.rmtree(index_dir)
+
     def test_sync_badges(self):
         # Nothing configured
         out = StringIO()
@@ -17,9 +17,12 @@ from __future__ import unicode_literals, absolute_import
 from django.test import TestCase
 from django.conf import settings
 from django.test import override_settings
-from ci import models
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from ci import models, OutputArchive
 from . import utils
 import math
+import os, shutil, tempfile
 
 @override_settings(INSTALLED_GITSERVERS=[utils.github_config()])
 class Tests(TestCase):
@@ -468,6 +471,259 @@ class Tests(TestCase):
         sr.save()
         self.assertTrue(sr.clean_output().startswith("Output too large"))
 
+    def test_stepresult_chunks(self):
+        sr = utils.create_step_result()
+        sr.output = 'a'
+        sr.save()
+        sr.append_output('b')
+        sr.append_output('')
+        sr.append_output('\33[30mc\33[0m')
+        self.assertEqual(sr.output_chunks.count(), 2)
+        self.assertEqual(sr.get_output(), 'ab\33[30mc\33[0m')
+        self.assertEqual(sr.plain_output(), 'abc')
+        self.assertEqual(sr.output_length(), 12)
+        self.assertEqual(sr.job.total_output_size(), '12.0 B')
+        # Ranges can span the legacy output and the chunks
+        self.assertEqual(sr.read_output(0, 2), 'ab')
+        self.assertEqual(sr.read_output(1, 3), 'b\33')
+        self.assertEqual(sr.read_output(2), '\33[30mc\33[0m')
+        self.assertEqual(sr.read_output(12), '')
+        # Only the data of the chunks in the range is loaded
+        chunks = list(sr.output_chunks.values_list('pk', flat=True))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(sr.read_output(2), '\33[30mc\33[0m')
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('"data"', queries[0]['sql'])
+        self.assertIn('IN (%s)' % chunks[1], queries[1]['sql'])
+        with self.assertNumQueries(1):
+            self.assertEqual(sr.read_output(12), '')
+
+        # Reading in pieces doesn't split characters or color codes
+        sr.append_output('\u2018x' * 10)
+        self.assertEqual(''.join(sr.iter_output(chunk_size=2)), sr.get_output())
+        self.assertTrue(all(len(part.encode('utf-8')) <= 3 for part in sr.iter_output(chunk_size=2)))
+        self.assertEqual(b''.join(OutputArchive.plain_output_chunks(sr, chunk_size=2)).decode('utf-8'),
+                "abc" + "'x" * 10)
+        sr.output_chunks.last().delete()
+
+        # Output that ends part way through a character
+        other = utils.create_step_result(position=1)
+        other.append_data('x\u2018'.encode('utf-8')[:-1])
+        self.assertEqual(list(other.iter_output()), ['x', '\ufffd'])
+        # Or of a color code
+        other.append_output('\33[3')
+        self.assertEqual(b''.join(OutputArchive.plain_output_chunks(other, chunk_size=2)),
+                other.plain_output().encode('utf-8'))
+
+        # Chunks from prefetch_related don't need more queries
+        sr = models.StepResult.objects.prefetch_related('output_chunks').get(pk=sr.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(sr.get_output(), 'ab\33[30mc\33[0m')
+            self.assertEqual(sr.output_length(), 12)
+            self.assertEqual(sr.read_output(1, 3), 'b\33')
+            self.assertEqual(''.join(sr.iter_output(chunk_size=2)), 'ab\33[30mc\33[0m')
+
+        sr.set_output('d'*1000)
+        sr.refresh_from_db()
+        self.assertEqual(sr.output_chunks.count(), 0)
+        self.assertEqual(sr.output, '')
+        self.assertLess(len(sr.compressed_output), 100)
+        self.assertEqual(sr.get_output(), 'd'*1000)
+        self.assertEqual(sr.output_length(), 1000)
+
+        # Appending to compressed output
+        sr.append_output('e\u2018')
+        self.assertEqual(sr.get_output(), 'd'*1000 + 'e\u2018')
+        # Size is in bytes
+        self.assertEqual(sr.output_length(), 1004)
+
+        sr.set_output('')
+        sr.refresh_from_db()
+        self.assertEqual(bytes(sr.compressed_output), b'')
+        self.assertEqual(sr.get_output(), '')
+        self.assertEqual(sr.output_length(), 0)
+
+    def test_stepresult_retention(self):
+        sr = utils.create_step_result()
+        retention = (10, 20)
+        sr.append_output('a'*8, retention)
+        sr.append_output('b'*15, retention)
+        self.assertEqual(sr.elided_length, 0)
+        self.assertEqual(sr.sent_output_length(), 23)
+        sr.append_data(b'')
+        self.assertEqual(sr.output_chunks.count(), 2)
+
+        # Over the limit, the middle gets removed
+        sr.append_output('c'*10, retention)
+        self.assertEqual(sr.get_output(), 'a'*8 + 'bb' + models.ELIDED_MARKER + 'b'*10 + 'c'*10)
+        self.assertEqual(sr.elided_offset, 10)
+        self.assertEqual(sr.elided_length, 3)
+        self.assertEqual(sr.sent_output_length(), 33)
+
+        # Whole chunks are removed once there is enough of the end without them
+        sr.append_output('d'*5, retention)
+        self.assertEqual(sr.get_output(), 'a'*8 + 'bb' + models.ELIDED_MARKER + 'b'*10 + 'c'*10 + 'd'*5)
+        sr.append_output('e'*16, retention)
+        self.assertEqual(sr.get_output(), 'a'*8 + 'bb' + models.ELIDED_MARKER + 'd'*5 + 'e'*16)
+        self.assertEqual(sr.elided_length, 23)
+        self.assertEqual(sr.sent_output_length(), 54)
+        sr.refresh_from_db()
+        self.assertEqual(sr.elided_length, 23)
+
+        # Positions in all the output sent
+        self.assertEqual(sr.output_offset(5), 5)
+        self.assertEqual(sr.output_position(5), 5)
+        self.assertIsNone(sr.output_offset(20))
+        offset = sr.output_offset(33)
+        self.assertEqual(sr.read_output(offset), 'd'*5 + 'e'*16)
+        self.assertEqual(sr.output_position(offset), 33)
+
+        # More than the tail at once
+        sr.append_output('f'*25, retention)
+        self.assertEqual(sr.get_output(), 'a'*8 + 'bb' + models.ELIDED_MARKER + 'f'*20)
+        self.assertEqual(sr.sent_output_length(), 79)
+
+        # Characters aren't split
+        sr.set_output('x'*9 + '\u2018'*10, retention)
+        self.assertEqual(sr.get_output(), 'x'*9 + '\u2018' + models.ELIDED_MARKER + '\u2018'*6)
+        self.assertEqual(sr.elided_length, 9)
+
+        sr.set_output('short', retention)
+        self.assertEqual(sr.elided_length, 0)
+        self.assertEqual(sr.get_output(), 'short')
+        sr.set_output('a'*40)
+        self.assertEqual(sr.get_output(), 'a'*40)
+
+    def test_stepresult_retention_file(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(STEP_OUTPUT_DIR=output_dir):
+                sr = utils.create_step_result()
+                retention = (10, 20)
+                sr.append_output('a'*30, retention)
+                sr.append_output('b'*5, retention)
+                self.assertEqual(sr.get_output(), 'a'*10 + models.ELIDED_MARKER + 'a'*15 + 'b'*5)
+                self.assertEqual(sr.elided_length, 5)
+                # The file can get to twice the tail before it is rewritten
+                sr.append_output('c'*15, retention)
+                self.assertEqual(sr.get_output(), 'a'*10 + models.ELIDED_MARKER + 'a'*15 + 'b'*5 + 'c'*15)
+                sr.append_output('d'*10, retention)
+                self.assertEqual(sr.get_output(), 'a'*10 + models.ELIDED_MARKER + 'c'*10 + 'd'*10)
+                self.assertEqual(sr.elided_length, 30)
+                self.assertEqual(sr.sent_output_length(), 60)
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_recipe_output_retention(self):
+        recipe = utils.create_recipe()
+        self.assertIsNone(recipe.output_retention())
+        with self.settings(STEP_OUTPUT_RETENTION={"head": 1, "tail": 2}):
+            self.assertEqual(recipe.output_retention(), (1024, 2048))
+        # Both ends need a size
+        with self.settings(STEP_OUTPUT_RETENTION={"head": 1}):
+            self.assertIsNone(recipe.output_retention())
+
+        repo_settings = {"%s/%s" % (recipe.repository.user.name, recipe.repository.name):
+                {"output_retention": {"head": 3, "tail": 4, "recipes": {recipe.filename: {"tail": 5}, "other": {"head": 1}}}}}
+        with self.settings(INSTALLED_GITSERVERS=[utils.github_config(repo_settings=repo_settings)]):
+            self.assertEqual(recipe.output_retention(), (3072, 5120))
+            recipe.filename = "other"
+            self.assertEqual(recipe.output_retention(), (1024, 4096))
+
+    def test_delete_step_results(self):
+        sr = utils.create_step_result()
+        sr.set_output("foo")
+        # The output isn't loaded to delete the step results
+        with CaptureQueriesContext(connection) as queries:
+            models.delete_step_results(sr.job.step_results.all())
+        self.assertEqual([q["sql"] for q in queries if "compressed_output" in q["sql"]], [])
+        self.assertEqual(models.StepResult.objects.count(), 0)
+
+        sr = utils.create_step_result()
+        sr.set_output("foo")
+        with CaptureQueriesContext(connection) as queries:
+            sr.job.delete()
+        self.assertEqual([q["sql"] for q in queries if "compressed_output" in q["sql"]], [])
+        self.assertEqual(models.StepResult.objects.count(), 0)
+
+    def test_stepresult_output_file(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(STEP_OUTPUT_DIR=output_dir):
+                sr = utils.create_step_result()
+                sr.append_output('a\n')
+                sr.append_output('b\u2018\n')
+                self.assertTrue(sr.output_file.startswith(output_dir))
+                self.assertEqual(sr.output_chunks.count(), 0)
+                self.assertEqual(sr.get_output(), 'a\nb\u2018\n')
+                self.assertEqual(sr.output_length(), 7)
+                self.assertEqual(sr.read_output(2, 3), 'b')
+                self.assertEqual(sr.read_output(2), 'b\u2018\n')
+                self.assertEqual(sr.tail_output(4), '\u2018\n')
+                self.assertEqual(sr.read_output(100), '')
+                sr.refresh_from_db()
+                self.assertEqual(sr.get_output(), 'a\nb\u2018\n')
+
+                sr.set_output('c')
+                sr.refresh_from_db()
+                self.assertEqual(sr.get_output(), 'c')
+                self.assertEqual(bytes(sr.compressed_output), b'')
+
+                # Back in the database if the output directory isn't set any more
+                path = sr.output_file
+                with self.settings(STEP_OUTPUT_DIR=None):
+                    sr.set_output('h')
+                self.assertEqual(sr.output_file, '')
+                self.assertFalse(os.path.exists(path))
+                self.assertEqual(sr.get_output(), 'h')
+                sr.set_output('c')
+                self.assertEqual(sr.output_file, path)
+
+                # Output that started in the database stays there
+                sr2 = utils.create_step_result(position=1)
+                with self.settings(STEP_OUTPUT_DIR=None):
+                    sr2.append_output('d')
+                sr2.append_output('e')
+                self.assertEqual(sr2.output_file, '')
+                self.assertEqual(sr2.get_output(), 'de')
+                self.assertEqual(sr2.read_output(1), 'e')
+
+                self.assertEqual(''.join(sr.iter_output(chunk_size=3)), sr.get_output())
+
+                # Large output only shows the end
+                sr.set_output('first\n' + ('g' * 99 + '\n') * 22000 + 'end')
+                output = sr.clean_output()
+                self.assertTrue(output.startswith("Output too large"))
+                self.assertTrue(output.endswith("<br/>end"))
+                self.assertIn("<br/>%s<br/>" % ('g' * 99), output)
+                self.assertNotIn("first", output)
+
+                path = sr.output_file
+                self.assertTrue(os.path.exists(path))
+                with self.captureOnCommitCallbacks(execute=True):
+                    models.delete_step_results(sr.job.step_results.all())
+                    # Not until the transaction commits
+                    self.assertTrue(os.path.exists(path))
+                self.assertFalse(os.path.exists(path))
+                self.assertEqual(sr.job.step_results.count(), 0)
+
+                # The step results of a deleted job are removed by the cascade
+                sr = utils.create_step_result()
+                sr.append_output('f')
+                path = sr.output_file
+                with self.captureOnCommitCallbacks(execute=True):
+                    sr.job.delete()
+                self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+            # Back to storing in the database
+            sr = utils.create_step_result()
+            sr.append_output('h')
+            self.assertEqual(sr.output_file, '')
+            sr.set_output('i')
+            self.assertEqual(sr.get_output(), 'i')
+        finally:
+            shutil.rmtree(output_dir)
+
     def test_generate_build_key(self):
         build_key = models.generate_build_key()
         self.assertNotEqual('', build_key)
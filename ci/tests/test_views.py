@@ -16,11 +16,12 @@
 from __future__ import unicode_literals, absolute_import
 from django.urls import reverse
 from django.test import override_settings
+from django.utils.text import get_valid_filename
 from mock import patch
-from ci import models, views, Permissions, PullRequestEvent, GitCommitData
+from ci import models, views, Permissions, PullRequestEvent, GitCommitData, OutputSearch
 from ci.tests import utils, DBTester
 from ci.github import api
-import datetime
+import datetime, io, os, shutil, tarfile, tempfile, zipfile
 from requests_oauthlib import OAuth2Session
 
 @override_settings(INSTALLED_GITSERVERS=[utils.github_config()])
@@ -241,6 +242,20 @@ class Tests(DBTester.DBTester):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
 
+        # The page's updates start at the end of the output it shows, which
+        # doesn't include an escape sequence that isn't all there yet
+        job.recipe.private = False
+        job.recipe.save()
+        # The page only updates while the job can still run
+        utils.update_job(job, ready=True, active=True, complete=False)
+        result = utils.create_step_result(job=job)
+        result.append_output("foo\33[3")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['step_results'][0].output_html, "foo")
+        self.assertEqual(response.context['step_results'][0].output_sent, 3)
+        self.assertContains(response, '"%s": 3,' % result.pk)
+
         self.check_private_repo(url)
 
     def test_get_paginated(self):
@@ -1162,6 +1177,36 @@ class Tests(DBTester.DBTester):
         utils.simulate_login(self.client.session, user)
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
+        sr.append_output("\33[31mmore\33[0m \u2018quoted\u2019")
+        sr2 = utils.create_step_result(job=job, position=1, name="step 2")
+        sr2.set_output("second")
+        base = "results_{}_{}".format(job.pk, get_valid_filename(job.recipe.name))
+        name = "{}/00_{}".format(base, get_valid_filename(sr.name))
+        name2 = "{}/01_step_2".format(base)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(".tar.gz", response["Content-Disposition"])
+        with tarfile.open(fileobj=io.BytesIO(b"".join(response.streaming_content))) as tar:
+            self.assertEqual(tar.getnames(), [name, name2])
+            self.assertEqual(tar.extractfile(name).read(), b"some outputmore 'quoted'")
+            self.assertEqual(tar.extractfile(name2).read(), b"second")
+
+        response = self.client.get(url, {"format": "zip"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(".zip", response["Content-Disposition"])
+        with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as archive:
+            self.assertEqual(archive.namelist(), [name, name2])
+            self.assertEqual(archive.read(name), b"some outputmore 'quoted'")
+            self.assertEqual(archive.read(name2), b"second")
+
+        response = self.client.get(url, {"format": "txt"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content).decode("utf-8"),
+                "==> %s <==\nsome outputmore 'quoted'\n==> %s <==\nsecond\n" % (name, name2))
+
+        response = self.client.get(url, {"format": "foo"})
+        self.assertEqual(response.status_code, 400)
 
         self.check_private_repo(url)
 
@@ -1206,6 +1251,44 @@ class Tests(DBTester.DBTester):
         response = self.client.get(url, {'os_versions': [osversion.pk], 'modules': [mod0.pk]})
         self.assertEqual(response.status_code, 200)
 
+    @patch.object(Permissions, 'viewable_repos')
+    def test_output_search(self, mock_repos):
+        url = reverse('ci:output_search')
+        response = self.client.get(url, {'text': 'error'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'not enabled')
+
+        index_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(OUTPUT_SEARCH_INDEX=os.path.join(index_dir, 'index.sqlite3')):
+                result = utils.create_step_result()
+                result.set_output('some error\n')
+                OutputSearch.index_step_result(result)
+                models.Recipe.objects.update(private=False)
+                mock_repos.return_value = [result.job.recipe.repository.pk]
+
+                # no options
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotContains(response, 'No matches')
+
+                response = self.client.get(url, {'text': 'error'})
+                self.assertEqual(response.status_code, 200)
+                self.assertContains(response, 'some <mark>error</mark>')
+                self.assertContains(response, reverse('ci:view_job', args=[result.job.pk]))
+
+                response = self.client.get(url, {'text': 'error', 'since': '2000-01-01', 'until': '2000-01-02'})
+                self.assertEqual(response.status_code, 200)
+                self.assertContains(response, 'No matches')
+
+                # too short
+                response = self.client.get(url, {'text': 'er'})
+                self.assertEqual(response.status_code, 200)
+                self.assertNotContains(response, 'No matches')
+                OutputSearch.close()
+        finally:
+            shutil.rmtree(index_dir)
+
     @override_settings(PERMISSION_CACHE_TIMEOUT=0)
     def test_get_user_repos_info(self):
         request = self.factory.get('/')
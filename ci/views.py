@@ -17,6 +17,7 @@ from __future__ import unicode_literals, absolute_import
 from django.shortcuts import render, redirect, get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.http import HttpResponse, HttpResponseNotAllowed, HttpResponseForbidden, Http404
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
 from django.urls import reverse
 from django.core.exceptions import PermissionDenied
 from django.conf import settings
@@ -25,14 +26,11 @@ from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.contrib import messages
 from django.db.models import Prefetch
 from datetime import timedelta
-import time
-import tarfile
-from io import BytesIO
-from ci import RepositoryStatus, EventsStatus, Permissions, PullRequestEvent, ManualEvent, TimeUtils
+from ci import RepositoryStatus, EventsStatus, Permissions, PullRequestEvent, ManualEvent, TimeUtils, OutputArchive, OutputSearch
 from django.utils.html import escape
-from django.utils.text import get_valid_filename
 from django.views.decorators.cache import never_cache
-from ci.client import UpdateRemoteStatus
+from django.utils import timezone
+from ci.client import UpdateRemoteStatus, JobQueue
 import os, re
 from datetime import datetime
 from croniter import croniter
@@ -311,9 +309,16 @@ def view_event(request, event_id):
 
 def get_job_results(request, job_id):
     """
-    Just download all the output of the job into a tarball.
+    Download all the output of the job.
+    The download is generated while it is sent so big outputs don't have to fit in memory.
+    GET parameters:
+      format: One of "tar.gz" (the default), "zip" or "txt" (all the output in one file)
     """
-    q = models.Job.objects.select_related('recipe__repository').prefetch_related('step_results')
+    fmt = request.GET.get('format', 'tar.gz')
+    if fmt not in OutputArchive.FORMATS:
+        return HttpResponseBadRequest('Bad format')
+
+    q = models.Job.objects.select_related('recipe__repository')
     job = get_object_or_404(q, pk=job_id)
 
     unauthorized = render_unauthorized_repo(request, job.recipe.repository)
@@ -324,18 +329,11 @@ def get_job_results(request, job_id):
     if not perms['can_see_results']:
         return HttpResponseForbidden('Not allowed to see results')
 
-    response = HttpResponse(content_type='application/x-gzip')
-    base_name = 'results_{}_{}'.format(job.pk, get_valid_filename(job.recipe.name))
-    response['Content-Disposition'] = 'attachment; filename="{}.tar.gz"'.format(base_name)
-    tar = tarfile.open(fileobj=response, mode='w:gz')
-    for result in job.step_results.all():
-        info = tarfile.TarInfo(name='{}/{:02}_{}'.format(base_name, result.position, get_valid_filename(result.name)))
-        s = BytesIO(result.plain_output().replace('\u2018', "'").replace("\u2019", "'").encode("utf-8", "replace"))
-        buf = s.getvalue()
-        info.size = len(buf)
-        info.mtime = time.time()
-        tar.addfile(tarinfo=info, fileobj=s)
-    tar.close()
+    extension, content_type = OutputArchive.FORMATS[fmt]
+    # Chunks are read one step result at a time while streaming
+    step_results = job.step_results.all()
+    response = StreamingHttpResponse(OutputArchive.archive_chunks(job, step_results, fmt), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(OutputArchive.base_name(job), extension)
     return response
 
 def view_job(request, job_id):
@@ -367,6 +365,12 @@ def view_job(request, job_id):
         clients = sorted_clients(models.Client.objects.exclude(status=models.Client.DOWN))
     perms['job'] = job
     perms['clients'] = clients
+    perms['step_results'] = list(job.step_results.all())
+    if perms['can_see_results']:
+        # The position goes with the same output as the HTML so that the
+        # page's updates start right after what it shows.
+        for result in perms['step_results']:
+            result.output_html, result.output_sent = result.clean_output_position()
     perms['update_interval'] = settings.JOB_PAGE_UPDATE_INTERVAL
     return render(request, 'ci/job.html', perms)
 
@@ -919,6 +923,7 @@ def set_job_active(request, job, user):
     job.active = True
     job.event.complete = False
     job.set_status(models.JobStatus.NOT_STARTED, calc_event=True) # will save job and event
+    JobQueue.update_job(job)
     message = "Activated by %s" % user
     models.JobChangeLog.objects.create(job=job, message=message)
     messages.info(request, 'Job %s activated' % job)
@@ -1040,6 +1045,7 @@ def cancel_event(request, event_id):
 def set_job_canceled(job, msg=None, status=models.JobStatus.CANCELED):
     job.complete = True
     job.set_status(status, calc_event=True) # This will save the job
+    JobQueue.remove_job(job)
     if msg:
         models.JobChangeLog.objects.create(job=job, message=msg)
 
@@ -1159,6 +1165,55 @@ def job_info_search(request):
     jobs = get_paginated(request, jobs)
     return render(request, 'ci/job_info_search.html', {"form": form, "jobs": jobs})
 
+def date_timestamp(date):
+    """
+    Timestamp of the start of a day in the local time zone
+    """
+    return timezone.make_aware(datetime.combine(date, datetime.min.time())).timestamp()
+
+def get_output_search_results(request, form):
+    """
+    Searches the step output with the options in a valid OutputSearchForm.
+    Input:
+      request: django.http.HttpRequest
+      form: forms.OutputSearchForm
+    Return:
+      list of (models.Job, list of dict): As from OutputSearch.find_jobs()
+    """
+    data = form.cleaned_data
+    since = None
+    if data['since']:
+        since = date_timestamp(data['since'])
+    until = None
+    if data['until']:
+        until = date_timestamp(data['until'] + timedelta(days=1))
+    return OutputSearch.find_jobs(request.session,
+            data['text'],
+            repository=data['repository'],
+            recipe_name=data['recipe'],
+            status=data['status'],
+            since=since,
+            until=until,
+            limit=settings.OUTPUT_SEARCH_MAX_RESULTS)
+
+def output_search(request):
+    """
+    Presents a form to search the output of completed steps for some text.
+    Input:
+      request: django.http.HttpRequest
+    Return: django.http.HttpResponse based object
+    """
+    jobs = []
+    form = forms.OutputSearchForm(request.GET or None)
+    if OutputSearch.enabled() and form.is_valid():
+        jobs = get_output_search_results(request, form)
+    context = {"form": form,
+        "jobs": jobs,
+        "enabled": OutputSearch.enabled(),
+        "max_results": settings.OUTPUT_SEARCH_MAX_RESULTS,
+        }
+    return render(request, 'ci/output_search.html', context)
+
 def get_branch_status(branch):
     """
     Returns an SVG image of the status of a branch.
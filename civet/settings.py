@@ -263,9 +263,104 @@ HOME_PAGE_UPDATE_INTERVAL = 20000
 JOB_PAGE_UPDATE_INTERVAL = 20000
 EVENT_PAGE_UPDATE_INTERVAL = 20000
 
-# Internal (in milliseconds) at which to rebuild the cache for available jobs
-# 0 means to always update
-GET_JOB_UPDATE_INTERVAL = 0
+# Whether to keep queues of the jobs that are ready to run in the cache.
+# Without them every poll from a client looks for jobs in the database, but
+# only for the build configs and build keys of the client.
+# The queues are updated as jobs change state, so every server process has to
+# see the same cache. Only turn this on after configuring a cache backend that
+# is shared by all the server processes, for example:
+# CACHES = {
+#     'default': {
+#         'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+#         'LOCATION': 'redis://127.0.0.1:6379',
+#     }
+# }
+GET_JOB_QUEUE_CACHE = False
+
+# Interval (in milliseconds) at which to fully rebuild the ready job queues
+# when GET_JOB_QUEUE_CACHE is on. The queues are updated as jobs change state,
+# this just reconciles them with the database. 0 means to always rebuild.
+GET_JOB_UPDATE_INTERVAL = 60000
+
+# Maximum time (in milliseconds) that a client can ask get_job to hold
+# the request while waiting for a job (long polling). 0 turns long polling off.
+# It is off by default since every held request ties up a server worker, so
+# only turn it on if the server has workers to spare (see GET_JOB_MAX_WAITERS).
+# A held request only checks whether jobs were added every GET_JOB_WAIT_INTERVAL,
+# without looking through the ready jobs.
+GET_JOB_MAX_WAIT = 0
+
+# Maximum number of get_job/get_jobs requests that each server process will
+# hold at once while waiting for jobs. Past this, requests return right away.
+# This should be less than the number of requests that each server process can
+# handle at the same time.
+GET_JOB_MAX_WAITERS = 8
+
+# Interval (in milliseconds) at which a held get_job request checks for new jobs
+GET_JOB_WAIT_INTERVAL = 250
+
+# Maximum number of jobs that a client can claim at once with get_jobs
+GET_JOBS_MAX_JOBS = 16
+
+# Number of seconds that a client has to start a job that it claimed
+# while finishing its previous job. After that the job goes back in the queue.
+CLIENT_RESERVATION_TTL = 10*60
+
+# How ready jobs are handed out to clients. See ci/client/Scheduler.py for details.
+# policy: "priority" or "fair_share"
+# share_by: What "fair_share" shares clients between, "repository" or "build_user"
+# weights: Weight of a repository ("owner/repo") or build user for "fair_share". Default is 1.
+# aging: Seconds a job has to wait to gain a priority point. 0 disables it.
+JOB_SCHEDULER = {
+    "policy": "priority",
+    "share_by": "repository",
+    "weights": {},
+    "aging": 0,
+}
+
+# Interval (in milliseconds) at which to check the SHA of the recipe repository
+# when claiming jobs. Job payloads are cached by recipe and repository SHA
+# and expire after this interval.
+RECIPE_REPO_SHA_UPDATE_INTERVAL = 60000
+
+# zlib compression level (1-9) of the step output stored in the database.
+# Existing uncompressed output can be compressed with "./manage.py compress_step_output".
+STEP_OUTPUT_COMPRESSION_LEVEL = 6
+
+# If set, step output is stored in files under this directory instead
+# of in the database. Only the file name is kept in the database.
+STEP_OUTPUT_DIR = None
+
+# How much of the output of each step is kept, with sizes in KB. Once a
+# step has more output than this only the first "head" KB and about the last
+# "tail" KB are kept. Repositories and recipes can have their own with
+# the "output_retention" repository setting. None keeps all the output.
+# For example: {"head": 1024, "tail": 4096}
+STEP_OUTPUT_RETENTION = None
+
+# Seconds to cache the HTML rendering of step output. While a step is
+# running only the new output is rendered and added to the cached HTML.
+STEP_OUTPUT_HTML_CACHE_TIMEOUT = 60*60
+
+# Path of a SQLite database used as a full text search index of step output.
+# The output of a step is added to it in the background when the step completes.
+# Output search is disabled if this is None.
+# Existing output, and any a server process stopped before indexing, can be
+# added with "./manage.py index_step_output".
+OUTPUT_SEARCH_INDEX = None
+
+# Lines of step output longer than this are cut off in the search index
+OUTPUT_SEARCH_MAX_LINE = 500
+
+# Maximum number of matching lines returned by an output search
+OUTPUT_SEARCH_MAX_RESULTS = 200
+
+# Maximum number of messages a client can send in one post to client/post_messages/
+CLIENT_MAX_BATCH_MESSAGES = 100
+
+# Clients can gzip what they post to the client/ endpoints. This is the
+# largest a body can be after it is decompressed.
+CLIENT_MAX_DECOMPRESSED_SIZE = 64*1024*1024
 
 # This allows for cross origin resource sharing.
 # Mainly so that mooseframework.org can have access
@@ -18,6 +18,8 @@ import logging, logging.handlers
 from client.JobGetter import JobGetter
 from client.JobRunner import JobRunner
 from client.ServerUpdater import ServerUpdater
+from client.SessionPool import SessionPool
+from client.MessageSpool import MessageSpool
 from client.InterruptHandler import InterruptHandler
 import os, signal, sys
 import time
@@ -27,7 +29,7 @@ from typing import Callable
 import logging
 logger = logging.getLogger("civet_client")
 
-from threading import Thread
+from threading import Thread, Event
 try:
     from queue import Queue
 except ImportError:
@@ -84,6 +86,8 @@ class BaseClient(object):
         self.runner_error = False
         self.runner_killed = False
         self.thread_join_wait = 2*60*60 # 2 hours
+        # Connections to the servers, shared by everything that talks to them
+        self.sessions = SessionPool()
 
         if self.client_info["log_file"]:
             self.set_log_file(self.client_info["log_file"])
@@ -94,6 +98,11 @@ class BaseClient(object):
 
         setup_logger(self.client_info["log_file"])
 
+        # Keeps the messages to the servers on disk until they are sent
+        self.spool = None
+        if self.client_info.get("spool"):
+            self.spool = MessageSpool(self.spool_file())
+
         try:
             self.cancel_signal = InterruptHandler(self.command_q, sig=[signal.SIGUSR1, signal.SIGINT])
             self.graceful_signal = InterruptHandler(self.command_q, sig=[signal.SIGUSR2])
@@ -218,17 +227,37 @@ class BaseClient(object):
         environment[str(var)] = str(value)
         self.set_client_info('environment', environment)
 
-    def run_claimed_job(self, server, servers, claimed, fail: bool = False):
+    def run_claimed_job(self, server, servers, claimed, fail: bool = False, command_q=None, prefetch=None,
+                        client_info=None):
+        """
+        Runs a claimed job with its own JobRunner and ServerUpdater.
+        Input:
+          server: The URL of the server the job was claimed on
+          servers: The URLs of all the servers the client talks to
+          claimed: The claimed job, as returned by JobGetter
+          fail: Whether to fail the job instead of running it
+          command_q: The queue for commands to the job. Defaults to the
+            client command queue, which the cancel signal also uses.
+            Jobs that run concurrently need their own.
+          prefetch: Optional function to claim the next job. It is called with
+            the job id once the job has run, while its messages are still being sent.
+          client_info: The client info to run the job with. Defaults to self.client_info.
+        Returns:
+          The job claimed by prefetch, None if there isn't one
+        """
         job_info = claimed["job_info"]
         job_id = job_info["job_id"]
         build_key = claimed["build_key"]
+        concurrent = command_q is not None
+        if not concurrent:
+            command_q = self.command_q
+            self.cancel_signal.set_message({"job_id": job_id, "command": "cancel"})
         message_q = Queue()
-        runner = JobRunner(self.client_info, job_info, message_q, self.command_q, build_key,
+        runner = JobRunner(client_info or self.client_info, job_info, message_q, command_q, build_key,
                            pre_step=self._runner_pre_step, post_step=self._runner_post_step)
-        self.cancel_signal.set_message({"job_id": job_id, "command": "cancel"})
 
         control_q = Queue()
-        updater = ServerUpdater(server, self.client_info, message_q, self.command_q, control_q)
+        updater = ServerUpdater(server, self.client_info, message_q, command_q, control_q, self.sessions, self.spool)
         for entry in servers:
             if entry != server:
                 control_q.put({"server": entry, "message": "Running job on another server"})
@@ -238,6 +267,9 @@ class BaseClient(object):
         updater_thread = Thread(target=ServerUpdater.run, args=(updater,))
         updater_thread.start()
         runner.run_job(fail=fail)
+        next_claimed = None
+        if prefetch and self.should_prefetch(runner):
+            next_claimed = prefetch(job_id)
         if not runner.stopped and not runner.canceled:
             logger.info("Joining message_q")
             message_q.join()
@@ -254,23 +286,206 @@ class BaseClient(object):
         if updater_thread.isAlive() if old_is_alive else updater_thread.is_alive():
             logger.warning("Failed to join ServerUpdater thread. Job {}: '{}' not updated correctly".format(
                 job_id, job_info["recipe_name"]))
-        self.command_q.queue.clear()
-        self.runner_error = runner.error
-        self.runner_killed = runner.job_killed
+        command_q.queue.clear()
+        if concurrent:
+            self.runner_error = self.runner_error or runner.error
+            self.runner_killed = self.runner_killed or runner.job_killed
+        else:
+            self.runner_error = runner.error
+            self.runner_killed = runner.job_killed
+        return next_claimed
+
+    def should_prefetch(self, runner):
+        """
+        Whether to claim the next job now that the runner is done.
+        Input:
+          runner: The JobRunner that ran the last job
+        """
+        if runner.stopped or runner.canceled or runner.error:
+            return False
+        if self.cancel_signal.triggered or self.graceful_signal.triggered:
+            return False
+        return not self.client_info["single_shot"]
+
+    def prefetch_job(self, job_id, client_info=None):
+        """
+        Claims the next job while the last one is still finishing.
+        The server only holds it for the client for a while, so it
+        should be run right after.
+        Input:
+          job_id: The id of the job that is finishing
+          client_info: The client info to claim with. Defaults to self.client_info.
+        Returns:
+          The claimed job, as returned by JobGetter. None if no job was claimed.
+        """
+        getter = JobGetter(client_info or self.client_info, self.sessions)
+        return getter.get_job(reserve=True, running=[job_id])
+
+    def send_spooled_messages(self):
+        """
+        Sends the messages in the spool that didn't get sent while their job
+        was running, or before the client was last stopped.
+        """
+        if not self.spool:
+            return
+        remaining = 0
+        for server in self.spool.servers():
+            updater = ServerUpdater(server, self.spool_client_info(server), Queue(), Queue(), Queue(),
+                    self.sessions, self.spool)
+            remaining += updater.send_spooled_messages()
+        if remaining:
+            logger.info("{} message(s) in the spool still need to be sent".format(remaining))
+
+    def spool_client_info(self, server):
+        """
+        Gets the client info for sending spooled messages to a server.
+        Input:
+          server: str: The URL of the server
+        Returns:
+          dict: A copy of the client info with only this server
+        """
+        return dict(self.client_info, server=server, servers=[server])
+
+    def spool_file(self):
+        """
+        Gets the file to keep the message spool in.
+        This is the "spool_file" client info if it is set, otherwise it is
+        next to the log file, or in the log directory if logging to the console.
+        Returns:
+          str: The path of the spool file
+        """
+        if self.client_info.get("spool_file"):
+            return self.client_info["spool_file"]
+        if self.client_info["log_file"]:
+            return "%s.spool" % os.path.splitext(self.client_info["log_file"])[0]
+        log_dir = os.path.abspath(self.client_info.get("log_dir") or ".")
+        return "%s/civet_client_%s.spool" % (log_dir, self.client_info.get("client_name", ""))
+
+    def slot_client_info(self, slot):
+        """
+        Gets the client info for a job running in a slot when running several jobs at once.
+        Each slot gets its own BUILD_ROOT under the BUILD_ROOT of the client
+        so that jobs running at the same time don't share build trees.
+        The directory for the slot is created if the BUILD_ROOT of the client exists.
+        Input:
+          slot: The number of the slot
+        Returns:
+          dict: A copy of the client info
+        """
+        environment = dict(self.client_info.get('environment', {}))
+        build_root = environment.get('BUILD_ROOT', os.environ.get('BUILD_ROOT'))
+        if build_root:
+            environment['BUILD_ROOT'] = os.path.join(build_root, str(slot))
+            if os.path.isdir(build_root):
+                os.makedirs(environment['BUILD_ROOT'], exist_ok=True)
+        return dict(self.client_info, environment=environment)
+
+    def run_concurrent_job(self, server, claimed, command_q, done, slot):
+        """
+        Thread target for running a job when running several jobs at once.
+        Input:
+          server: The URL of the server the job was claimed on
+          claimed: The claimed job, as returned by JobGetter
+          command_q: The queue for commands to the job
+          done: Event to set when the job is finished
+          slot: The number of the slot the job runs in
+        """
+        try:
+            self.run_claimed_job(server, [server], claimed, command_q=command_q,
+                                 client_info=self.slot_client_info(slot))
+        except Exception:
+            logger.warning("Error: %s" % traceback.format_exc())
+        finally:
+            done.set()
+
+    def run_concurrent(self):
+        """
+        Main client loop when running several jobs at once.
+        Whenever there are free slots the server is asked for enough jobs
+        to fill them, and each job is run in its own thread.
+        The client info has:
+          max_jobs: The maximum number of jobs to run at once
+          config_slots: Optional dict of the maximum number of jobs to run at once for a build config
+        """
+        max_jobs = self.get_client_info('max_jobs')
+        config_slots = self.client_info.get('config_slots', {})
+        server = self.get_client_info('server')
+        running = {}
+        done = Event()
+        canceled = False
+        claimed_once = False
+
+        while True:
+            done.clear()
+            for job_id in [job_id for job_id, job in running.items() if not job["thread"].is_alive()]:
+                running[job_id]["thread"].join()
+                del running[job_id]
+
+            if self.cancel_signal.triggered and not canceled:
+                logger.info("Received cancel signal...canceling {} job(s)".format(len(running)))
+                for job_id, job in running.items():
+                    job["command_q"].put({"job_id": job_id, "command": "cancel"})
+                canceled = True
+
+            stopping = (self.cancel_signal.triggered
+                    or self.graceful_signal.triggered
+                    or self.runner_error
+                    or (self.client_info["single_shot"] and claimed_once))
+            if stopping:
+                if not running:
+                    logger.info("Finished running jobs...exiting")
+                    break
+                done.wait(1)
+                continue
+
+            claimed = []
+            if len(running) < max_jobs:
+                try:
+                    self.send_spooled_messages()
+                    used = {}
+                    for job in running.values():
+                        used[job["config"]] = used.get(job["config"], 0) + 1
+                    slots = {config: max(num - used.get(config, 0), 0) for config, num in config_slots.items()}
+                    getter = JobGetter(self.client_info, self.sessions)
+                    claimed = getter.get_jobs(max_jobs - len(running), slots, list(running.keys()))
+                except Exception:
+                    logger.warning("Error: %s" % traceback.format_exc())
+                claimed_once = True
+
+            for job in claimed:
+                command_q = Queue()
+                used_slots = [entry["slot"] for entry in running.values()]
+                slot = min([slot for slot in range(max_jobs) if slot not in used_slots])
+                thread = Thread(target=self.run_concurrent_job, args=(server, job, command_q, done, slot))
+                running[job["job_id"]] = {"thread": thread, "command_q": command_q, "config": job["config"],
+                                          "slot": slot}
+                thread.start()
+
+            if not claimed and not (self.client_info["single_shot"] and not running):
+                # Check again when a job finishes or it is time to poll
+                done.wait(self.get_client_info('poll'))
 
     def run(self):
         """
         Main client loop. Polls the server for jobs and runs them.
         """
+        if self.client_info.get("max_jobs", 1) > 1:
+            return self.run_concurrent()
 
+        prefetch = self.prefetch_job if self.client_info.get("prefetch_job") else None
+        claimed = None
         while True:
             do_poll = True
+            poll_start = time.time()
             try:
-                getter = JobGetter(self.client_info)
-                claimed = getter.get_job()
+                self.send_spooled_messages()
+                if not claimed:
+                    getter = JobGetter(self.client_info, self.sessions)
+                    claimed = getter.get_job()
                 if claimed:
                     server = self.get_client_info('server')
-                    self.run_claimed_job(server, [server], claimed)
+                    job, claimed = claimed, None
+                    claimed = self.run_claimed_job(server, [server], job, prefetch=prefetch)
                     # finished the job, look for a new one immediately
                     do_poll = False
             except Exception:
@@ -288,4 +503,21 @@ class BaseClient(object):
                 break
 
             if do_poll:
-                time.sleep(self.get_client_info('poll'))
+                self.poll_sleep(time.time() - poll_start)
+
+        if claimed:
+            # Don't make the job wait for the reservation to expire
+            logger.info("Not running job {}; giving it back to the server".format(claimed["job_id"]))
+            JobGetter(self.client_info, self.sessions).release_job(claimed)
+
+    def poll_sleep(self, elapsed):
+        """
+        Sleeps until it is time to poll the server again.
+        Time spent waiting on the server for a job (with job_wait)
+        counts toward the poll time.
+        Input:
+          elapsed: Number of seconds since the last poll started
+        """
+        remaining = self.get_client_info('poll') - elapsed
+        if remaining > 0:
+            time.sleep(remaining)
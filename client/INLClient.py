@@ -21,11 +21,17 @@ import platform
 import subprocess
 import time, traceback
 import shutil
+import threading
 from inspect import signature
 from client.JobGetter import JobGetter
 import logging
 logger = logging.getLogger("civet_client")
 
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
 class INLClient(BaseClient.BaseClient):
     """
     The INL version of the build client.
@@ -48,6 +54,151 @@ class INLClient(BaseClient.BaseClient):
         # within the runner and stop polling if so
         self.stage_commands_failed = []
 
+        # (server, claimed job) of the job claimed while the last one was finishing
+        self.prefetched = None
+        # Where to start in settings.SERVERS when looking for a job, so that the servers take turns
+        self.next_server = 0
+
+    def server_client_info(self, server):
+        """
+        The client info for talking to a server.
+        Input:
+          server: tuple: (The URL of the server, build_key, bool: whether to check SSL)
+        Returns:
+          dict: A copy of the client info with the server set
+        """
+        return dict(self.client_info, server=server[0], build_keys=server[1], ssl_verify=server[2])
+
+    def spool_client_info(self, server):
+        """
+        The client info for sending spooled messages to a server.
+        Input:
+          server: str: The URL of the server
+        Returns:
+          dict: A copy of the client info with the server set
+        """
+        for entry in settings.SERVERS:
+            if entry[0] == server:
+                return self.server_client_info(entry)
+        return super(INLClient, self).spool_client_info(server)
+
+    def server_order(self):
+        """
+        Returns:
+          list: The servers in the order to take jobs from them, starting
+            with the one after the server that the last job came from
+        """
+        servers = settings.SERVERS
+        start = self.next_server % len(servers) if servers else 0
+        return servers[start:] + servers[:start]
+
+    def claim_job(self, server, running=None, wait=True):
+        """
+        Asks a server for a job.
+        Input:
+          server: tuple: The server to ask
+          running: list: The ids of the jobs that the client is still finishing.
+            If set then the job is reserved for the client until it starts it.
+          wait: bool: Whether the server can hold the request until a job is available (see job_wait)
+        Returns:
+          dict: The claimed job as returned by JobGetter, None if there wasn't one
+        """
+        client_info = self.server_client_info(server)
+        if not wait:
+            client_info["job_wait"] = 0
+        getter = JobGetter(client_info, self.sessions)
+        if running:
+            return getter.get_job(reserve=True, running=running)
+        return getter.get_job()
+
+    def release_job(self, server, claimed):
+        """
+        Gives a job that the client isn't going to run back to its server.
+        """
+        getter = JobGetter(self.server_client_info(server), self.sessions)
+        getter.release_job(claimed)
+
+    def poll_servers(self, servers, running=None):
+        """
+        Asks all the servers for a job at the same time so that a slow server
+        doesn't hold up the others. Returns as soon as a job is claimed or all
+        the servers have answered. Of the jobs claimed by then, the one from
+        the earliest server in the list is kept. The other jobs, and any that
+        are claimed after returning, are released.
+        When asking several servers, they aren't asked to hold the request
+        while waiting for a job, so that no poll is left waiting on a server
+        for job_wait seconds after a job was found on another one.
+        Input:
+          servers: list: The servers to ask, in order of preference
+          running: list: See claim_job()
+        Returns:
+          (tuple, dict): The server and the job claimed on it. None if no job was claimed.
+        """
+        results = Queue()
+        lock = threading.Lock()
+        state = {"decided": False}
+        wait = len(servers) == 1
+
+        def poll(index, server):
+            claimed = None
+            try:
+                claimed = self.claim_job(server, running, wait)
+            except Exception:
+                # Always answer so that the client doesn't wait forever
+                logger.debug("Error: %s" % traceback.format_exc())
+            with lock:
+                late = state["decided"]
+                if not late:
+                    results.put((index, claimed))
+            if late and claimed:
+                # A job was already chosen
+                self.release_job(server, claimed)
+
+        for index, server in enumerate(servers):
+            thread = threading.Thread(target=poll, args=(index, server))
+            thread.daemon = True
+            thread.start()
+
+        claims = {}
+        answered = 0
+        while answered < len(servers) and not claims:
+            index, claimed = results.get()
+            answered += 1
+            if claimed:
+                claims[index] = claimed
+
+        with lock:
+            state["decided"] = True
+        # Anything that came in at the same time
+        while not results.empty():
+            index, claimed = results.get()
+            if claimed:
+                claims[index] = claimed
+
+        if not claims:
+            return None
+        best = min(claims.keys())
+        for index, claimed in claims.items():
+            if index != best:
+                self.release_job(servers[index], claimed)
+        return servers[best], claims[best]
+
+    def check_servers(self):
+        """
+        Looks for a job on all the servers, and if one is found, runs it.
+        Returns:
+          bool: True if we ran a job, False otherwise
+        """
+        if self.prefetched:
+            found = self.prefetched
+            self.prefetched = None
+        else:
+            found = self.poll_servers(self.server_order())
+        if not found:
+            return False
+        self.run_server_job(*found)
+        return True
+
     def check_server(self, server):
         """
         Checks a single server for a job, and if found, runs it.
@@ -56,34 +207,50 @@ class INLClient(BaseClient.BaseClient):
         Returns:
           bool: True if we ran a job, False otherwise
         """
+        claimed = self.claim_job(server)
+        if not claimed:
+            return False
+        self.run_server_job(server, claimed)
+        return True
+
+    def run_server_job(self, server, claimed):
+        """
+        Runs a job that was claimed on a server.
+        If the client prefetches jobs, the next job is claimed while this one finishes.
+        Input:
+          server: tuple: The server the job was claimed on
+          claimed: dict: The claimed job, as returned by JobGetter
+        """
         self.client_info["server"] = server[0]
         self.client_info["build_keys"] = server[1]
         self.client_info["ssl_verify"] = server[2]
-        getter = JobGetter(self.client_info)
-        claimed = getter.get_job()
-        if claimed:
-            if self.get_client_info('manage_build_root'):
-                self.create_build_root()
+        if server in settings.SERVERS:
+            self.next_server = settings.SERVERS.index(server) + 1
 
-            # Run the pre_job command, if any, and fail the job if it fails
-            fail_job = not self.run_stage_command('pre_job')
+        if self.get_client_info('manage_build_root'):
+            self.create_build_root()
 
-            self.set_environment('CIVET_SERVER', self.client_info['server'])
+        # Run the pre_job command, if any, and fail the job if it fails
+        fail_job = not self.run_stage_command('pre_job')
 
-            self.run_claimed_job(server[0], [ s[0] for s in settings.SERVERS ], claimed, fail=fail_job)
-            self.set_client_info('jobs_ran', self.get_client_info('jobs_ran') + 1)
+        self.set_environment('CIVET_SERVER', self.client_info['server'])
 
-            if self.get_client_info('manage_build_root') and self.build_root_exists():
-                self.remove_build_root()
+        prefetch = None
+        if self.client_info.get('prefetch_job'):
+            prefetch = lambda job_id: self.poll_servers(self.server_order(), running=[job_id])
 
-            # Run the post job cleanup, if any
-            # This will be checked for failure outside of this call
-            post_job_env = copy.deepcopy(os.environ)
-            post_job_env['CIVET_JOB_COMPLETED'] = '0' if self.runner_killed else '1'
-            self.run_stage_command('post_job', env=post_job_env)
+        self.prefetched = self.run_claimed_job(server[0], [ s[0] for s in settings.SERVERS ], claimed,
+                fail=fail_job, prefetch=prefetch)
+        self.set_client_info('jobs_ran', self.get_client_info('jobs_ran') + 1)
 
-            return True
-        return False
+        if self.get_client_info('manage_build_root') and self.build_root_exists():
+            self.remove_build_root()
+
+        # Run the post job cleanup, if any
+        # This will be checked for failure outside of this call
+        post_job_env = copy.deepcopy(os.environ)
+        post_job_env['CIVET_JOB_COMPLETED'] = '0' if self.runner_killed else '1'
+        self.run_stage_command('post_job', env=post_job_env)
 
     def check_settings(self):
         """
@@ -287,16 +454,18 @@ class INLClient(BaseClient.BaseClient):
                 self.remove_build_root()
 
             ran_job = False
-            for server in settings.SERVERS:
-                if self.cancel_signal.triggered or self.graceful_signal.triggered or self.runner_error:
-                    break
+            poll_start = time.time()
+            try:
+                self.send_spooled_messages()
+            except Exception:
+                logger.debug("Error: %s" % traceback.format_exc())
+            if not (self.cancel_signal.triggered or self.graceful_signal.triggered or self.runner_error):
                 try:
-                    if self.check_server(server):
+                    if self.check_servers():
                         ran_job = True
                         self.check_stage_commands()
                 except Exception:
                     logger.debug("Error: %s" % traceback.format_exc())
-                    break
 
             if self.cancel_signal.triggered or self.graceful_signal.triggered:
                 logger.info("Received signal...exiting")
@@ -311,7 +480,14 @@ class INLClient(BaseClient.BaseClient):
                 if should_exit:
                     break
             if not ran_job:
-                time.sleep(self.get_client_info('poll'))
+                self.poll_sleep(time.time() - poll_start)
+
+        if self.prefetched:
+            # Don't make the job wait for the reservation to expire
+            logger.info("Not running job {} from {}; giving it back to the server".format(
+                self.prefetched[1]["job_id"], self.prefetched[0][0]))
+            self.release_job(*self.prefetched)
+            self.prefetched = None
 
         if self.get_client_info('manage_build_root') and self.build_root_exists():
             logger.warning("BUILD_ROOT {} still exists after exiting poll loop; removing"
@@ -23,7 +23,7 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 logger = logging.getLogger("civet_client")
 
 class JobGetter(object):
-    def __init__(self, client_info):
+    def __init__(self, client_info, sessions=None):
         """
         Input:
           client_info: A dictionary containing the following keys
@@ -34,11 +34,17 @@ class JobGetter(object):
             ssl_verify: Whether to use SSL verification when making a request.
             request_timeout: The timeout when making a request
             build_key: The build_key to be used.
+            job_wait: Optional number of seconds to ask the server to wait for
+              a job to become available before responding (long polling).
+          sessions: Optional SessionPool to reuse connections to the server
         """
         super(JobGetter, self).__init__()
         self.client_info = client_info
+        # SessionPool has the same post() as the requests module
+        self._http = sessions if sessions is not None else requests
         self._headers = {b"User-Agent": b"INL-CIVET-Client/1.0 (+https://github.com/idaholab/civet)"}
         self._url = f'{self.client_info["server"]}/client/get_job/'
+        self._jobs_url = f'{self.client_info["server"]}/client/get_jobs/'
 
     def check_response(self, response_json):
         expected_values = {'job_id': [int, type(None)],
@@ -63,21 +69,40 @@ class JobGetter(object):
 
         return True
 
-    def get_job(self):
+    def get_job(self, reserve=False, running=None):
+        """
+        Claims a job.
+        Input:
+          reserve[bool]: Whether the job is claimed before the client is done with the
+            jobs in running. The server puts it back in the queue if it isn't started in time.
+          running[list]: The ids of the jobs that the client is still finishing
+        Returns:
+          dict: The response from the server, None if no job was claimed
+        """
         server = self.client_info["server"]
         logger.info(f'Polling for a job on server {server}')
 
         post_data = { 'client_name': self.client_info["client_name"],
                       'build_keys': self.client_info["build_keys"],
                       'build_configs': self.client_info["build_configs"] }
+        if reserve:
+            post_data['reserve'] = True
+        if running:
+            post_data['running'] = running
+        timeout = 5
+        job_wait = self.client_info.get("job_wait", 0)
+        if job_wait and not running:
+            # The server holds on to the request until a job is available or job_wait expires
+            post_data['wait'] = job_wait
+            timeout += job_wait
         post_json = json.dumps(post_data, separators=(",", ": "))
 
         try:
-            response = requests.post(self._url,
+            response = self._http.post(self._url,
                                     post_json,
                                     headers=self._headers,
                                     verify=self.client_info["ssl_verify"],
-                                    timeout=5)
+                                    timeout=timeout)
             response.raise_for_status()
             response_json = response.json()
         except:
@@ -96,3 +121,85 @@ class JobGetter(object):
 
         logger.info(f'Claimed job {job_id} on server {server}')
         return response_json
+
+    def get_jobs(self, max_jobs, slots=None, running=None):
+        """
+        Claims several jobs at once.
+        Input:
+          max_jobs[int]: The maximum number of jobs to claim
+          slots[dict]: The maximum number of jobs to claim for each build config
+          running[list]: The ids of the jobs that are still running on this client
+        Returns:
+          list: The claimed jobs, each like the return value of get_job()
+        """
+        server = self.client_info["server"]
+        logger.info(f'Polling for up to {max_jobs} job(s) on server {server}')
+
+        post_data = { 'client_name': self.client_info["client_name"],
+                      'build_keys': self.client_info["build_keys"],
+                      'build_configs': self.client_info["build_configs"],
+                      'max_jobs': max_jobs,
+                      'slots': slots or {},
+                      'running': running or [] }
+        timeout = 5
+        job_wait = self.client_info.get("job_wait", 0)
+        if job_wait and not running:
+            # Only wait when idle so that finished jobs get replaced quickly
+            post_data['wait'] = job_wait
+            timeout += job_wait
+        post_json = json.dumps(post_data, separators=(",", ": "))
+
+        try:
+            response = self._http.post(self._jobs_url,
+                                    post_json,
+                                    headers=self._headers,
+                                    verify=self.client_info["ssl_verify"],
+                                    timeout=timeout)
+            response.raise_for_status()
+            response_json = response.json()
+        except:
+            logger.warning('Failed to get jobs', exc_info=True)
+            return []
+
+        if not isinstance(response_json, dict):
+            logger.warning(f'Bad response from {self._jobs_url}')
+            return []
+
+        jobs = response_json.get('jobs')
+        if response_json.get('status') != 'OK' or not isinstance(jobs, list):
+            logger.warning(f'Bad response from {self._jobs_url}')
+            return []
+
+        claimed = []
+        for job in jobs:
+            if not isinstance(job, dict) or not self.check_response(job) or job.get('job_id') is None:
+                logger.warning(f'Bad job in response from {self._jobs_url}')
+                continue
+            logger.info(f'Claimed job {job["job_id"]} on server {server}')
+            claimed.append(job)
+        return claimed
+
+    def release_job(self, claimed):
+        """
+        Gives a claimed job back to the server so that another client can run it.
+        Input:
+          claimed[dict]: The claimed job, as returned by get_job()
+        Returns:
+          bool: Whether the server took the job back
+        """
+        server = self.client_info["server"]
+        job_id = claimed["job_id"]
+        url = f'{server}/client/release_job/{claimed["build_key"]}/{self.client_info["client_name"]}/{job_id}/'
+        try:
+            response = self._http.post(url,
+                                    "{}",
+                                    headers=self._headers,
+                                    verify=self.client_info["ssl_verify"],
+                                    timeout=5)
+            response.raise_for_status()
+        except:
+            logger.warning(f'Failed to release job {job_id} on server {server}', exc_info=True)
+            return False
+
+        logger.info(f'Released job {job_id} on server {server}')
+        return True
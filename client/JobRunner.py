@@ -15,7 +15,9 @@
 
 from __future__ import unicode_literals, absolute_import
 import os, re, time
+import codecs
 import copy
+import selectors
 import tempfile
 import subprocess, platform
 import logging
@@ -48,6 +50,134 @@ def temp_file(*args, **kwargs):
     finally:
         os.unlink(f.name)
 
+class OutputBuffer(object):
+    """
+    Holds the output of a step.
+    The size is kept as the output is added so that checking it doesn't
+    have to go through all the output. The output is kept in memory
+    until it is larger than max_memory, then it is moved to a temporary file.
+    """
+    def __init__(self, max_memory=1024*1024):
+        """
+        Input:
+          max_memory: int: Number of characters to keep in memory
+        """
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_memory, mode="w+", encoding="utf-8", newline="")
+
+    def write(self, output):
+        """
+        Input:
+          output: list: str: Output to add
+        """
+        for line in output:
+            self.file.write(line)
+            self.size += len(line.encode("utf-8", "replace"))
+
+    def getvalue(self):
+        """
+        Return:
+          str: All the output
+        """
+        self.file.seek(0)
+        value = self.file.read()
+        self.file.seek(0, os.SEEK_END)
+        return value
+
+    def close(self):
+        self.file.close()
+
+class ProcessReader(object):
+    """
+    Reads the output of a process in chunks as it becomes available.
+    On Unix the pipe is watched with selectors so that reading can wait
+    for output with a timeout. Selectors don't work on pipes on Windows so
+    there a thread reads the pipe and puts the chunks on a Queue.
+    """
+    CHUNK_SIZE = 64*1024
+    # The most that one call to read() returns
+    MAX_READ = 4*CHUNK_SIZE
+
+    def __init__(self, stream, use_thread=False):
+        """
+        Input:
+          stream: The stdout of a subprocess.Popen
+          use_thread: bool: Whether to read with a thread instead of selectors
+        """
+        self.stream = stream
+        self.eof = False
+        self.selector = None
+        self.queue = None
+        if use_thread:
+            self.queue = Queue()
+            t = Thread(target=self.enqueue_output)
+            t.daemon = True
+            t.start()
+        else:
+            self.fd = stream.fileno()
+            os.set_blocking(self.fd, False)
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.fd, selectors.EVENT_READ)
+
+    def enqueue_output(self):
+        try:
+            for data in iter(lambda: self.stream.read1(self.CHUNK_SIZE), b''):
+                self.queue.put(data)
+        except (ValueError, OSError):
+            # The stream was closed when the job was killed
+            pass
+        finally:
+            self.queue.put(None)
+
+    def read(self, timeout):
+        """
+        Waits for output and returns what is available.
+        Input:
+          timeout: float: The most seconds to wait for output
+        Return:
+          bytes: The output read. Empty if there wasn't any. Check eof to see if there will be more.
+        """
+        if self.eof:
+            return b''
+        if self.queue is not None:
+            return self.read_queue(timeout)
+        if not self.selector.select(timeout):
+            return b''
+        output = []
+        size = 0
+        while size < self.MAX_READ:
+            try:
+                data = os.read(self.fd, self.CHUNK_SIZE)
+            except BlockingIOError:
+                break
+            if not data:
+                self.eof = True
+                break
+            output.append(data)
+            size += len(data)
+        return b''.join(output)
+
+    def read_queue(self, timeout):
+        output = []
+        size = 0
+        try:
+            data = self.queue.get(timeout=timeout)
+            while size < self.MAX_READ:
+                if data is None:
+                    self.eof = True
+                    break
+                output.append(data)
+                size += len(data)
+                data = self.queue.get(block=False)
+        except Empty:
+            pass
+        return b''.join(output)
+
+    def close(self):
+        if self.selector:
+            self.selector.close()
+        self.stream.close()
+
 class JobRunner(object):
     def __init__(self, client_info, job, message_q, command_q, build_key,
                  pre_step: Callable[[dict | None], bool] | None = None,
@@ -77,6 +207,8 @@ class JobRunner(object):
         self.error = False
         self.job_killed = False
         self.max_output_size = client_info.get("max_output_size", 5*1024*1024) # Stop collecting after 5Mb
+        self.output_memory_size = client_info.get("output_memory_size", 1024*1024) # Output past this goes to a temporary file
+        self.read_timeout = 0.05 # Longest time to wait for output before checking for commands
 
         # Entry point for running something before each runner step;
         # would be a function that takes an env (the step env) and returns
@@ -236,38 +368,6 @@ class JobRunner(object):
                 step["stepresult_id"])
         self.add_message(url, chunk_data)
 
-    def get_output_from_queue(self, q, timeout=1):
-        """
-        Grabs all the available output from the queue and returns it.
-        This is used with reading the output of a subprocess so everything on
-        the queue should just be strings.
-
-        On the first run through we block if timeout is non zero. This will slow down the overall
-        read process loop so that we are not constantly busy waiting trying
-        to read the output.
-        Input:
-          q: Queue to read from
-          timeout: int: How long to block while trying to read
-        Return:
-          list: str: Output read.
-        """
-        output = []
-        block = False
-        if timeout:
-            block = True
-
-        try:
-            while True:
-                line = q.get(block=block, timeout=timeout)
-                output.append(line)
-                block = False
-        except Empty:
-            """
-            We always return from here since eventually we will
-            read all the messages on the queue and trigger an Empty exception.
-            """
-            return output
-
     def read_command(self):
         """
         Reads a command from the command queue.
@@ -300,7 +400,26 @@ class JobRunner(object):
         Return:
           dict: An updated step_data
         """
-        out = []
+        out = OutputBuffer(self.output_memory_size)
+        reader = ProcessReader(proc.stdout, use_thread=self.is_windows())
+        try:
+            return self.read_output(proc, reader, out, step, step_data)
+        finally:
+            reader.close()
+            out.close()
+
+    def read_output(self, proc, reader, out, step, step_data):
+        """
+        Does the work for read_process_output()
+        Input:
+          proc: subprocess.Popen instance
+          reader: ProcessReader: Reads the output of proc
+          out: OutputBuffer: Where to store the output
+          step: dict: Holds general step information
+          step_data: dict: Holds result for the step
+        Return:
+          dict: An updated step_data
+        """
         chunk_out = []
         start_time = time.time()
         max_end_time = start_time + int(step["environment"].get("CIVET_MAX_STEP_TIME", self.max_step_time))
@@ -308,23 +427,11 @@ class JobRunner(object):
         step_data["canceled"] = False
         over_max = False
         keep_output = False
+        # Multibyte characters can be split between reads
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
 
-        # This allows non-blocking read on Unix & Windows
-        # See: http://stackoverflow.com/questions/375427/non-blocking-read-on-a-subprocess-pipe-in-python
-        def enqueue_output(out, queue):
-            for line in iter(out.readline, b''):
-                if line:
-                    # Make sure it doesn't have any bad unicode characters
-                    line = line.decode("utf-8", "replace")
-                queue.put(line)
-            out.close()
-
-        q = Queue()
-        t = Thread(target=enqueue_output, args=(proc.stdout, q))
-        t.daemon = True
-        t.start();
-
-        while proc.poll() is None:
+        # Read until the process, and any children still holding on to its output, are done
+        while not reader.eof:
             if self.canceled or self.stopped:
                 logger.info("Killing job\n")
                 self.kill_job(proc)
@@ -332,19 +439,18 @@ class JobRunner(object):
                 step_data['output'] = ""
                 break
 
-            output = self.get_output_from_queue(q)
+            # Only wait a little so that commands are handled quickly
+            output = decoder.decode(reader.read(self.read_timeout), final=reader.eof)
             if output and not over_max:
-                out.extend(output)
-                chunk_out.extend(output)
+                out.write([output])
+                chunk_out.append(output)
 
-            # Don't worry that "out" might contain multibyte characters, we
-            # just want a rough size check
-            if not over_max and len("".join(out)) >= self.max_output_size:
+            if not over_max and out.size >= self.max_output_size:
                 over_max = True
-                out.append("\n\n*****************************************************\n\n")
-                out.append("CIVET: Output size exceeded limit (%s bytes), further output will not be displayed!\n"
-                        % self.max_output_size)
-                out.append("\n*****************************************************\n")
+                out.write(["\n\n*****************************************************\n\n",
+                    "CIVET: Output size exceeded limit (%s bytes), further output will not be displayed!\n"
+                        % self.max_output_size,
+                    "\n*****************************************************\n"])
 
             diff = time.time() - chunk_start_time
             if diff > self.client_info["update_step_time"]: # Report some output every x seconds
@@ -358,18 +464,14 @@ class JobRunner(object):
             if time.time() > max_end_time:
                 self.canceled = True
                 keep_output = True
-                out.append("\n\n*****************************************************\n")
-                out.append("CIVET: Cancelling job due to step taking longer than the max %s seconds\n" % self.max_step_time)
-                out.append("\n*****************************************************\n")
+                out.write(["\n\n*****************************************************\n",
+                    "CIVET: Cancelling job due to step taking longer than the max %s seconds\n" % self.max_step_time,
+                    "\n*****************************************************\n"])
 
             self.read_command() # this will set the internal flags to cancel or stop
 
-        t.join() # make sure the step has no more output
-
-        # we might not have gotten everything
-        out.extend(self.get_output_from_queue(q, timeout=0))
         if not step_data['canceled'] or keep_output:
-            step_data['output'] = ''.join(out)
+            step_data['output'] = out.getvalue()
         step_data['complete'] = True
         step_data['time'] = int(time.time() - start_time) #would be float
         return step_data
@@ -0,0 +1,146 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import unicode_literals, absolute_import
+import json
+import sqlite3
+import threading
+import logging
+logger = logging.getLogger("civet_client")
+
+class MessageSpool(object):
+    """
+    Keeps the messages for the servers in an SQLite database until
+    the server has gotten them, so that they aren't lost if the server
+    is down for a long time or the client is restarted.
+
+    Each message belongs to the ServerUpdater that is sending it. When a
+    ServerUpdater exits, the messages it couldn't send are released. Released
+    messages, and everything left from a previous run of the client, are
+    sent again by the client in the order they were added.
+    """
+    SCHEMA = """CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        owner TEXT,
+        server TEXT,
+        url TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        message TEXT NOT NULL)"""
+
+    def __init__(self, path, max_size=100*1024*1024):
+        """
+        Input:
+          path: str: The SQLite database file
+          max_size: int: The most bytes of messages to keep
+        """
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # Used by the threads of all the ServerUpdaters
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(self.SCHEMA)
+        # Everything here is from a previous run
+        self.conn.execute("UPDATE messages SET owner = NULL")
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM messages").fetchone()[0]
+
+    def add(self, owner, msg):
+        """
+        Adds a message.
+        If there isn't room then the oldest output updates are dropped. The
+        client sends all the output when a step completes so they are the
+        least important.
+        Input:
+          owner: str: The ServerUpdater sending the message
+          msg: dict: The message from the message queue
+        Returns:
+          int: The id of the message, None if there wasn't room for it
+        """
+        data = json.dumps(msg)
+        size = len(data)
+        with self.lock:
+            while self.size + size > self.max_size:
+                row = self.conn.execute("""SELECT id, size FROM messages WHERE url LIKE '%/update_step_result/%'
+                        ORDER BY id LIMIT 1""").fetchone()
+                if row is None:
+                    logger.warning("Message spool {} is full, not saving message to {}".format(self.path, msg["url"]))
+                    return None
+                logger.warning("Message spool {} is full, dropping an output update".format(self.path))
+                self.conn.execute("DELETE FROM messages WHERE id = ?", (row[0],))
+                self.size -= row[1]
+            cursor = self.conn.execute("INSERT INTO messages (owner, server, url, size, message) VALUES (?, ?, ?, ?, ?)",
+                    (owner, msg.get("server"), msg["url"], size, data))
+            self.size += size
+            return cursor.lastrowid
+
+    def remove(self, ids):
+        """
+        Removes messages that the server has gotten.
+        Input:
+          ids: list of int: The ids of the messages
+        """
+        ids = [i for i in ids if i is not None]
+        if not ids:
+            return
+        with self.lock:
+            params = ",".join(["?"] * len(ids))
+            size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM messages WHERE id IN (%s)" % params, ids).fetchone()[0]
+            self.conn.execute("DELETE FROM messages WHERE id IN (%s)" % params, ids)
+            self.size -= size
+
+    def release(self, owner):
+        """
+        Releases the messages of a ServerUpdater so that they can be sent by someone else.
+        """
+        with self.lock:
+            self.conn.execute("UPDATE messages SET owner = NULL WHERE owner = ?", (owner,))
+
+    def servers(self):
+        """
+        Returns:
+          list of str: The servers that released messages are for
+        """
+        with self.lock:
+            rows = self.conn.execute("""SELECT server FROM messages WHERE owner IS NULL
+                    GROUP BY server ORDER BY MIN(id)""").fetchall()
+        return [row[0] for row in rows]
+
+    def claim(self, owner, server):
+        """
+        Takes the released messages for a server.
+        Input:
+          owner: str: Who will send them
+          server: str: The server the messages are for
+        Returns:
+          list of dict: The messages in the order they were added, each with its id in "spool_ids"
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.conn.execute("SELECT id, message FROM messages WHERE owner IS NULL AND server IS ? ORDER BY id",
+                        (server,)).fetchall()
+                self.conn.execute("UPDATE messages SET owner = ? WHERE owner IS NULL AND server IS ?", (owner, server))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        messages = []
+        for row_id, data in rows:
+            msg = json.loads(data)
+            msg["spool_ids"] = [row_id]
+            messages.append(msg)
+        return messages
+
+    def close(self):
+        self.conn.close()
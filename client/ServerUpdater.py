@@ -16,8 +16,9 @@
 from __future__ import unicode_literals, absolute_import
 import sys
 import time
-import json, requests
+import gzip, json, requests
 import traceback
+import uuid
 import logging
 
 try:
@@ -25,6 +26,11 @@ try:
 except ImportError:
     from Queue import Empty
 
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
@@ -34,7 +40,7 @@ class StopException(Exception):
     pass
 
 class ServerUpdater(object):
-    def __init__(self, server, client_info, message_q, command_q, control_q):
+    def __init__(self, server, client_info, message_q, command_q, control_q, sessions=None, spool=None):
         self.message_q = message_q
         self.command_q = command_q
         self.control_q = control_q
@@ -42,6 +48,23 @@ class ServerUpdater(object):
         self.client_info = client_info
         self.servers = {}
         self.main_server = server
+        # Optional SessionPool so that the connections to the servers get reused
+        self._http = sessions if sessions is not None else requests
+        # Optional MessageSpool that keeps the messages until they are sent
+        self.spool = spool
+        self.spool_owner = uuid.uuid4().hex
+
+        # Whether to send several messages in one request
+        self.batch_messages = client_info.get("batch_messages", True)
+        self.max_batch_messages = client_info.get("max_batch_messages", 100)
+        # Updates aren't merged past this many characters of output so that the
+        # request stays under the size the server accepts (2.5MB by default)
+        # even if every character is escaped in the JSON.
+        self.max_coalesced_output = client_info.get("max_coalesced_output", 256*1024)
+        # Bodies at least this big are gzip compressed if the server takes them
+        self.gzip_min_size = client_info.get("gzip_min_size", 4*1024)
+        # The (scheme, host) of the servers that have said they take gzip compressed bodies
+        self.gzip_servers = set()
 
         self.update_servers()
         self.running = True
@@ -80,6 +103,9 @@ class ServerUpdater(object):
         # It might be possible that there are more messages, so try one more time
         updater.read_queue()
         updater.send_messages()
+        if updater.spool:
+            # The client will send whatever is left
+            updater.spool.release(updater.spool_owner)
         sys.exit(0)
 
     def update_server_message(self, server, msg):
@@ -124,33 +150,170 @@ class ServerUpdater(object):
             block = True
             while True:
                 item = self.message_q.get(block=block, timeout=timeout)
+                if self.spool:
+                    item = item.copy()
+                    item["spool_ids"] = [self.spool.add(self.spool_owner, item)]
                 self.messages.append(item)
                 # if we have an item we don't want to block on the next iteration
                 block = False
         except Empty:
             pass
 
+    def coalesce_messages(self):
+        """
+        Merges consecutive updates for the same step result into one message.
+        The output is concatenated and the rest of the payload is from the
+        latest update. This keeps a backlog of updates, like after the
+        server couldn't be reached for a while, from being sent one by one.
+        An update isn't merged if the output would be longer than max_coalesced_output.
+        """
+        messages = []
+        for msg in self.messages:
+            prev = messages[-1] if messages else None
+            if (prev and prev["url"] == msg["url"] and "/update_step_result/" in msg["url"]
+                    and len(prev["payload"].get("output") or "") + len(msg["payload"].get("output") or "")
+                        <= self.max_coalesced_output):
+                payload = msg["payload"].copy()
+                payload["output"] = (prev["payload"].get("output") or "") + (msg["payload"].get("output") or "")
+                merged = msg.copy()
+                merged["payload"] = payload
+                # The number of messages from the queue that this one is for
+                merged["count"] = prev.get("count", 1) + msg.get("count", 1)
+                if "spool_ids" in msg:
+                    merged["spool_ids"] = prev.get("spool_ids", []) + msg["spool_ids"]
+                messages[-1] = merged
+            else:
+                messages.append(msg)
+        self.messages = messages
+
+    def message_done(self, msg):
+        for i in range(msg.get("count", 1)):
+            self.message_q.task_done()
+        if self.spool and msg.get("spool_ids"):
+            self.spool.remove(msg["spool_ids"])
+
     def send_messages(self):
         """
         Just tries to clear the messages that we haven't sent yet.
         """
+        self.coalesce_messages()
+        sent = 0
         try:
-            last_success = 0
-            for idx, msg in enumerate(self.messages):
-                sent = self.post_message(msg)
-                if sent:
-                    last_success = idx+1
-                    self.message_q.task_done()
+            while sent < len(self.messages):
+                if self.batch_messages and len(self.messages) - sent > 1:
+                    count, all_sent = self.post_batch(self.messages[sent:sent+self.max_batch_messages])
                 else:
+                    all_sent = self.post_message(self.messages[sent])
+                    count = 1 if all_sent else 0
+                for msg in self.messages[sent:sent+count]:
+                    self.message_done(msg)
+                sent += count
+                if not all_sent:
                     break
-            #self.messages = self.messages[last_success:]
-            self.messages = self.messages[last_success:]
+            self.messages = self.messages[sent:]
         except StopException:
-            for msg in self.messages[last_success:]:
-                self.message_q.task_done()
+            for msg in self.messages[sent:]:
+                self.message_done(msg)
             self.messages = []
         self.servers[self.main_server]["last_time"] = time.time()
 
+    def send_spooled_messages(self):
+        """
+        Sends the messages in the spool for this server that no other ServerUpdater
+        is sending, like the ones left from a previous run of the client.
+        What can't be sent is released again to be tried later.
+        Returns:
+          int: The number of messages that are still waiting to be sent
+        """
+        self.messages = self.spool.claim(self.spool_owner, self.main_server)
+        if not self.messages:
+            return 0
+        logger.info("Sending {} message(s) from the spool".format(len(self.messages)))
+        for msg in self.messages:
+            # Not from the message queue
+            msg["count"] = 0
+        self.send_messages()
+        remaining = len(self.messages)
+        self.messages = []
+        self.spool.release(self.spool_owner)
+        return remaining
+
+    def post_batch(self, messages):
+        """
+        Sends several messages to the server in one request.
+        If the server doesn't know about batches then this falls back to sending
+        the first message by itself and doesn't try batches again.
+        If the batch is too large then it is split in two and each half is tried.
+        Input:
+          messages: list of messages from the message queue
+        Returns:
+          (int, bool): The number of messages that were sent, from the start of the list,
+            and whether all the messages that were tried were sent
+        """
+        server = messages[0]["server"]
+        batch = []
+        for msg in messages:
+            if msg["server"] != server or not msg["url"].startswith(server):
+                break
+            msg["payload"]["client_name"] = self.client_info["client_name"]
+            batch.append({"path": msg["url"][len(server):], "payload": msg["payload"]})
+        if len(batch) < 2:
+            sent = self.post_message(messages[0])
+            return (1 if sent else 0), sent
+
+        request_url = "{}/client/post_messages/".format(server)
+        logger.info("Posting {} messages to '{}'".format(len(batch), request_url))
+        body, good = self.data_to_json({"messages": batch, "client_name": self.client_info["client_name"]})
+        if not good:
+            # Let the first message handle it by itself
+            sent = self.post_message(messages[0])
+            return (1 if sent else 0), sent
+        try:
+            response = self.send_post(request_url, body, self.client_info['request_timeout'])
+        except Exception:
+            # The server is probably down
+            logger.warning("Failed to POST at {}.\nError: {}".format(request_url, traceback.format_exc()))
+            return 0, False
+
+        if response.status_code in (404, 405):
+            if not self.post_message(messages[0]):
+                return 0, False
+            logger.info("Server {} doesn't take batches of messages, sending them one at a time".format(server))
+            self.batch_messages = False
+            return 1, True
+
+        if response.status_code in (400, 413):
+            # Probably too large for the server (DATA_UPLOAD_MAX_MEMORY_SIZE)
+            half = len(batch) // 2
+            logger.info("Server {} refused a batch of {} messages, splitting it".format(server, len(batch)))
+            count, all_sent = self.post_batch(messages[:half])
+            if count < half:
+                return count, False
+            rest, all_sent = self.post_batch(messages[half:len(batch)])
+            return count + rest, all_sent
+
+        reply = None
+        if response.status_code == 200:
+            try:
+                reply = response.json()
+            except ValueError:
+                pass
+        if not isinstance(reply, dict) or not isinstance(reply.get("replies"), list):
+            # Something went wrong on the server, just send the first one this time
+            logger.warning("Got a {} response while posting to: {}".format(response.status_code, request_url))
+            sent = self.post_message(messages[0])
+            return (1 if sent else 0), sent
+
+        count = 0
+        for msg, msg_reply in zip(messages, reply["replies"]):
+            status_reply = self.status_reply(msg["url"], msg_reply.get("status_code"))
+            if status_reply is None and msg_reply.get("status_code") == 200:
+                status_reply = msg_reply.get("reply")
+            if not self.check_reply(msg, status_reply):
+                break
+            count += 1
+        return count, count == len(batch)
+
     def post_message(self, item):
         """
         Sends a list of updates to the server.
@@ -163,8 +326,17 @@ class ServerUpdater(object):
         Returns:
           True if we could talk to the server, False otherwise
         """
-        reply = self.post_json(item["url"], item["payload"])
+        return self.check_reply(item, self.post_json(item["url"], item["payload"]))
 
+    def check_reply(self, item, reply):
+        """
+        Handles the reply from the server to a message.
+        Input:
+          item: The message from the message queue
+          reply: dict of the JSON reply, None if the message didn't get to the server
+        Returns:
+          True if we could talk to the server, False otherwise
+        """
         if not reply:
             # Since all messages here are on the same server, if there is no
             # reply then there isn't any point in trying with others
@@ -234,6 +406,77 @@ class ServerUpdater(object):
             logger.warning("Failed to convert to json: \n%s\nData:%s" % (traceback.format_exc(), data))
             return {"status": "OK", "command": "stop"}, False
 
+    def status_reply(self, request_url, status_code):
+        """
+        The reply to use for a response that has an error status code.
+        Input:
+          request_url: The URL that was posted to
+          status_code: int: Status code of the response
+        Returns:
+          A dict to use as the reply, None if the status code doesn't have one
+        """
+        if status_code == 400:
+            # This means that we shouldn't retry this request
+            logger.warning("Stopping because we got a 400 response while posting to: %s" % request_url)
+            return {"status": "OK", "command": "stop"}
+        if status_code == 413:
+            # We have too much output, so stop
+            logger.warning("Stopping because we got a 413 reponse (too much data) while posting to: %s" % request_url)
+            return {"status": "OK", "command": "stop"}
+        if status_code == 500:
+            # There could be a couple of things wrong.
+            # 1) We sent some data that the server really doesn't like. This happened
+            #    on mammoth testing where the test output spit out null characters which
+            #    Postgresql didn't like, causing an internal server error.
+            # 2) The server is having issues (can happen when updating the civet source code and DB).
+            #    It is likely that is relatively temporary.
+            # Since (1) is a bug in the civet server, we shouldn't abort the job. It is good to know
+            # though, so log it.
+            logger.warning("Got a 500 response (internal server error) while posting to: %s" % request_url)
+            return {"status": "OK"}
+        return None
+
+    def server_key(self, url):
+        parts = urlsplit(url)
+        return parts.scheme, parts.netloc
+
+    def encode_body(self, request_url, body):
+        """
+        Compresses the body of a request if it is large and the server
+        has said, in the Accept-Encoding header of an earlier response,
+        that it takes gzip compressed bodies.
+        Input:
+          request_url: The URL that will be posted to
+          body: bytes: The JSON to post
+        Returns:
+          (bytes, dict): The body and the headers to post with
+        """
+        if len(body) < self.gzip_min_size or self.server_key(request_url) not in self.gzip_servers:
+            return body, self._headers
+        headers = self._headers.copy()
+        headers[b"Content-Encoding"] = b"gzip"
+        return gzip.compress(body, compresslevel=6), headers
+
+    def send_post(self, request_url, in_json, timeout):
+        """
+        Posts JSON to the url.
+        Input:
+          request_url: The URL to post to.
+          in_json: bytes: The JSON to post
+          timeout: The request timeout
+        Returns:
+          The response
+        """
+        body, headers = self.encode_body(request_url, in_json)
+        response = self._http.post(request_url,
+                body,
+                headers=headers,
+                verify=self.client_info["ssl_verify"],
+                timeout=timeout)
+        if "gzip" in response.headers.get("Accept-Encoding", ""):
+            self.gzip_servers.add(self.server_key(request_url))
+        return response
+
     def post_json(self, request_url, data, timeout=None):
         """
         Post the supplied dict holding JSON data to the url and return a dict
@@ -256,30 +499,10 @@ class ServerUpdater(object):
             in_json, good = self.data_to_json(data)
             if not good:
                 return in_json
-            response = requests.post(request_url,
-                    in_json,
-                    headers=self._headers,
-                    verify=self.client_info["ssl_verify"],
-                    timeout=timeout)
-            if response.status_code == 400:
-                # This means that we shouldn't retry this request
-                logger.warning("Stopping because we got a 400 response while posting to: %s" % request_url)
-                return {"status": "OK", "command": "stop"}
-            if response.status_code == 413:
-                # We have too much output, so stop
-                logger.warning("Stopping because we got a 413 reponse (too much data) while posting to: %s" % request_url)
-                return {"status": "OK", "command": "stop"}
-            if response.status_code == 500:
-                # There could be a couple of things wrong.
-                # 1) We sent some data that the server really doesn't like. This happened
-                #    on mammoth testing where the test output spit out null characters which
-                #    Postgresql didn't like, causing an internal server error.
-                # 2) The server is having issues (can happen when updating the civet source code and DB).
-                #    It is likely that is relatively temporary.
-                # Since (1) is a bug in the civet server, we shouldn't abort the job. It is good to know
-                # though, so log it.
-                logger.warning("Got a 500 response (internal server error) while posting to: %s" % request_url)
-                return {"status": "OK"}
+            response = self.send_post(request_url, in_json, timeout)
+            reply = self.status_reply(request_url, response.status_code)
+            if reply is not None:
+                return reply
             response.raise_for_status()
             reply = response.json()
             return reply
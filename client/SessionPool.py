@@ -0,0 +1,99 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import unicode_literals, absolute_import
+import requests
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from client import settings
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+class SessionPool(object):
+    """
+    Keeps a requests.Session for each server so that the connections
+    to the servers are kept open and reused instead of doing a new
+    TCP and TLS handshake for every request.
+    It has the same post() as the requests module so it can be used in
+    its place. The sessions are shared by the threads of the client.
+    """
+    def __init__(self, pool_size=None, retries=None, retry_backoff=None):
+        """
+        Input:
+          pool_size: int: The most connections kept open to each server.
+            Defaults to settings.HTTP_POOL_SIZE
+          retries: int: How many times to retry a request that couldn't connect.
+            Defaults to settings.HTTP_RETRIES
+          retry_backoff: float: Backoff factor in seconds between retries.
+            Defaults to settings.HTTP_RETRY_BACKOFF
+        """
+        self.pool_size = pool_size if pool_size is not None else getattr(settings, "HTTP_POOL_SIZE", 10)
+        self.retries = retries if retries is not None else getattr(settings, "HTTP_RETRIES", 2)
+        self.retry_backoff = retry_backoff if retry_backoff is not None else getattr(settings, "HTTP_RETRY_BACKOFF", 0.5)
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def create_session(self):
+        session = requests.Session()
+        # Only retry when the request didn't get to the server.
+        # Posts that the server might have handled aren't safe to send again.
+        retry = Retry(total=self.retries,
+                connect=self.retries,
+                read=0,
+                status=0,
+                other=0,
+                redirect=0,
+                allowed_methods=None,
+                backoff_factor=self.retry_backoff,
+                raise_on_redirect=False,
+                raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def get(self, url):
+        """
+        Input:
+          url: str: A URL on the server
+        Returns:
+          requests.Session: The session for the server
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = self.create_session()
+                self.sessions[key] = session
+            return session
+
+    def post(self, url, *args, **kwargs):
+        """
+        Posts with the session for the server. Takes the same arguments as requests.post()
+        """
+        return self.get(url).post(url, *args, **kwargs)
+
+    def close(self):
+        """
+        Closes all the connections
+        """
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
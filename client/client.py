@@ -60,12 +60,35 @@ def commandline_client(args):
             type=int,
             default=30,
             help="Number of seconds to wait before polling for more jobs in continuous mode")
+    parser.add_argument("--job-wait",
+            dest='job_wait',
+            type=int,
+            default=30,
+            help="Number of seconds the server can hold a poll while waiting for a job. 0 disables waiting.")
+    parser.add_argument("--prefetch",
+            dest='prefetch_job',
+            action='store_true',
+            help="Claim the next job while the current one is finishing")
+    parser.add_argument("--max-jobs",
+            dest='max_jobs',
+            type=int,
+            default=1,
+            help="Maximum number of jobs to run at the same time")
+    parser.add_argument("--config-slots",
+            dest='config_slots',
+            nargs=2,
+            action='append',
+            metavar=('CONFIG', 'NUM'),
+            help="Maximum number of jobs of a config to run at the same time when --max-jobs is more than 1")
     parser.add_argument("--daemon", dest='daemon', choices=['start', 'stop', 'restart'], help="Start a UNIX daemon.")
     parser.add_argument("--log-dir",
             dest='log_dir',
             default='.',
             help="Where to write the log file.  The log will be written as ci_PID.log")
     parser.add_argument("--log-file", dest='log_file', help="Filename to append the log to")
+    parser.add_argument("--spool-file",
+            dest='spool_file',
+            help="Where to keep the messages that haven't been sent to the server yet. Defaults to next to the log file")
     parser.add_argument("--insecure", dest='insecure', action='store_false', help="Turns off SSL certificate verification")
     parser.add_argument("--ssl-cert",
             dest='ssl_cert',
@@ -86,15 +109,21 @@ def commandline_client(args):
         "ssl_cert": parsed.ssl_cert,
         "log_file": parsed.log_file,
         "log_dir": parsed.log_dir,
+        "spool_file": parsed.spool_file,
         "build_keys": [parsed.build_key],
         "single_shot": parsed.single_shot,
         "poll": parsed.poll,
+        "job_wait": parsed.job_wait,
+        "prefetch_job": parsed.prefetch_job,
+        "max_jobs": parsed.max_jobs,
+        "config_slots": {config: int(num) for config, num in parsed.config_slots or []},
         "daemon_cmd": parsed.daemon,
         "request_timeout": 30,
         "update_step_time": 20,
         "server_update_interval": 20,
         "server_update_timeout": 5,
-        "max_output_size": 5*1024*1024
+        "max_output_size": 5*1024*1024,
+        "spool": True
         }
 
     c = BaseClient.BaseClient(client_info)
@@ -54,6 +54,18 @@ def commandline_client(args):
             dest='poll_time',
             help='Sets the client polling time in seconds (default: 60s)',
             default=60)
+    parser.add_argument('--job-wait',
+            type=int,
+            dest='job_wait',
+            help='Number of seconds the server can hold a poll while waiting for a job. 0 disables waiting. (default: 60s)',
+            default=60)
+    parser.add_argument('--prefetch',
+            action='store_true',
+            dest='prefetch_job',
+            help='Claim the next job while the current one is finishing and the post job command runs')
+    parser.add_argument('--spool-file',
+            dest='spool_file',
+            help="Where to keep the messages that haven't been sent to the servers yet. Defaults to next to the log file")
     parser.add_argument('--startup-command',
                         type=str,
                         dest='startup_command',
@@ -95,9 +107,12 @@ def commandline_client(args):
         "ssl_cert": "",
         "log_file": "",
         "log_dir": log_dir,
+        "spool_file": parsed.spool_file,
         "build_keys": [],
         "single_shot": False,
         "poll": parsed.poll_time,
+        "job_wait": parsed.job_wait,
+        "prefetch_job": parsed.prefetch_job,
         "daemon_cmd": parsed.daemon,
         "request_timeout": 120,
         "update_step_time": 30,
@@ -106,6 +121,7 @@ def commandline_client(args):
         # the ping message doesn't become the default message
         "server_update_interval": 50,
         "max_output_size": 5*1024*1024,
+        "spool": True,
         "startup_command": parsed.startup_command,
         "pre_job_command": parsed.pre_job_command,
         "pre_step_command": parsed.pre_step_command,
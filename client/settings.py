@@ -22,6 +22,7 @@ REQUIRED:
   SERVERS: a list of servers
 OPTIONAL:
   MANAGE_BUILD_ROOT: True to create/clear BUILD_ROOT for each job
+  HTTP_POOL_SIZE, HTTP_RETRIES, HTTP_RETRY_BACKOFF: Connections to the servers
 """
 
 """
@@ -54,3 +55,13 @@ NUM_CLIENTS = 1
 True to create/clear BUILD_ROOT for each job.
 """
 MANAGE_BUILD_ROOT = False
+
+"""
+Connections to the servers are kept open and reused.
+HTTP_POOL_SIZE: The most connections kept open to each server
+HTTP_RETRIES: How many times to retry a request that couldn't connect to the server
+HTTP_RETRY_BACKOFF: Backoff factor in seconds between retries
+"""
+HTTP_POOL_SIZE = 10
+HTTP_RETRIES = 2
+HTTP_RETRY_BACKOFF = 0.5
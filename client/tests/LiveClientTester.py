@@ -15,14 +15,47 @@
 
 from __future__ import unicode_literals, absolute_import
 from django.contrib.staticfiles.testing import StaticLiveServerTestCase
+from django.core.cache import cache
+from django.db import connection
 from ci.tests import DBTester
 from client.tests import utils
+import os, shutil, sqlite3, tempfile
 
 class LiveClientTester(StaticLiveServerTestCase, DBTester.DBCompare):
     def setUp(self):
         super(LiveClientTester, self).setUp()
+        # The ready job queues are kept in the cache which isn't reset between tests
+        cache.clear()
         self.client_info = utils.default_client_info()
         self.client_info["servers"] = [self.live_server_url]
         self.client_info["server"] = self.live_server_url
         self.client_info["update_step_time"] = 1
         self.client_info["server_update_interval"] = 1
+
+class FileDatabaseLiveClientTester(LiveClientTester):
+    """
+    Runs the tests against a copy of the test database in a file.
+    The live server normally shares the in-memory SQLite test database
+    connection with the tests and requests that use it at the same time
+    fail with "database table is locked". With a file each request gets
+    its own connection and waits for the locks instead.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.db_dir = tempfile.mkdtemp()
+        path = os.path.join(cls.db_dir, 'test.sqlite3')
+        connection.ensure_connection()
+        db_file = sqlite3.connect(path)
+        connection.connection.backup(db_file)
+        db_file.close()
+        cls.memory_db = (connection.settings_dict['NAME'], connection.connection)
+        connection.connection = None
+        connection.settings_dict['NAME'] = path
+        super(FileDatabaseLiveClientTester, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(FileDatabaseLiveClientTester, cls).tearDownClass()
+        connection.close()
+        connection.settings_dict['NAME'], connection.connection = cls.memory_db
+        shutil.rmtree(cls.db_dir)
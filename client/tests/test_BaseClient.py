@@ -17,8 +17,13 @@ from __future__ import unicode_literals, absolute_import
 from django.test import SimpleTestCase
 from django.test import override_settings
 from client import BaseClient
+from client.JobGetter import JobGetter
 from client.tests import utils
 from ci.tests import utils as test_utils
+from mock import patch, call, Mock
+from queue import Queue
+from threading import Barrier, Event
+import os, requests, shutil, tempfile
 
 @override_settings(INSTALLED_GITSERVERS=[test_utils.github_config()])
 class Tests(SimpleTestCase):
@@ -95,3 +100,221 @@ class Tests(SimpleTestCase):
         c.set_environment('FOO', 'bar')
         self.assertEqual('bar', c.get_environment('FOO'))
         self.assertEqual(c.client_info['environment'], c.get_environment())
+
+    def test_slot_client_info(self):
+        c = utils.create_base_client()
+        c.set_environment('FOO', 'bar')
+        with patch.dict(os.environ):
+            os.environ.pop('BUILD_ROOT', None)
+            c.client_info['environment'].pop('BUILD_ROOT', None)
+            client_info = c.slot_client_info(1)
+            self.assertEqual(client_info['environment'], c.get_environment())
+            self.assertNotIn('BUILD_ROOT', client_info['environment'])
+
+            # Only created if the BUILD_ROOT of the client exists
+            missing = os.path.join(tempfile.gettempdir(), 'civet_missing_build_root')
+            c.set_environment('BUILD_ROOT', missing)
+            client_info = c.slot_client_info(1)
+            self.assertEqual(client_info['environment']['BUILD_ROOT'], os.path.join(missing, '1'))
+            self.assertFalse(os.path.exists(missing))
+
+            build_root = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, build_root)
+            c.set_environment('BUILD_ROOT', build_root)
+            client_info0 = c.slot_client_info(0)
+            client_info1 = c.slot_client_info(1)
+            self.assertEqual(client_info0['environment']['BUILD_ROOT'], os.path.join(build_root, '0'))
+            self.assertEqual(client_info1['environment']['BUILD_ROOT'], os.path.join(build_root, '1'))
+            self.assertTrue(os.path.isdir(os.path.join(build_root, '1')))
+            self.assertEqual(client_info1['environment']['FOO'], 'bar')
+            # The client itself is unchanged
+            self.assertEqual(c.get_environment('BUILD_ROOT'), build_root)
+
+            # BUILD_ROOT set in the environment of the client process
+            c = utils.create_base_client()
+            c.client_info['environment'].pop('BUILD_ROOT', None)
+            os.environ['BUILD_ROOT'] = build_root
+            client_info = c.slot_client_info(2)
+            self.assertEqual(client_info['environment']['BUILD_ROOT'], os.path.join(build_root, '2'))
+
+    @patch.object(BaseClient.time, 'sleep')
+    def test_poll_sleep(self, mock_sleep):
+        c = utils.create_base_client()
+        c.client_info["poll"] = 30
+        c.poll_sleep(10)
+        mock_sleep.assert_called_once_with(20)
+
+        # Already waited on the server long enough
+        mock_sleep.reset_mock()
+        c.poll_sleep(30)
+        c.poll_sleep(45)
+        self.assertEqual(mock_sleep.call_count, 0)
+
+    def test_should_prefetch(self):
+        c = utils.create_base_client()
+        c.client_info["single_shot"] = False
+        runner = Mock(stopped=False, canceled=False, error=False)
+        self.assertTrue(c.should_prefetch(runner))
+
+        # Not after a job that didn't finish normally
+        for attr in ["stopped", "canceled", "error"]:
+            setattr(runner, attr, True)
+            self.assertFalse(c.should_prefetch(runner))
+            setattr(runner, attr, False)
+
+        # Nor when the client is about to exit
+        c.graceful_signal.triggered = True
+        self.assertFalse(c.should_prefetch(runner))
+        c.graceful_signal.triggered = False
+        c.cancel_signal.triggered = True
+        self.assertFalse(c.should_prefetch(runner))
+        c.cancel_signal.triggered = False
+        c.client_info["single_shot"] = True
+        self.assertFalse(c.should_prefetch(runner))
+
+    @patch.object(JobGetter, 'release_job')
+    @patch.object(BaseClient.BaseClient, 'run_claimed_job')
+    @patch.object(JobGetter, 'get_job')
+    def test_run_release_prefetched(self, mock_getter, mock_run, mock_release):
+        c = utils.create_base_client()
+        c.client_info["single_shot"] = False
+        c.client_info["prefetch_job"] = True
+        first = {"job_id": 1}
+        second = {"job_id": 2}
+        mock_getter.return_value = first
+        def run_claimed_job(server, servers, claimed, prefetch=None):
+            # Told to stop while the next job was being claimed
+            c.graceful_signal.triggered = True
+            return second
+        mock_run.side_effect = run_claimed_job
+
+        c.run()
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(mock_run.call_args[0][2], first)
+        # Given back instead of waiting for the reservation to expire
+        mock_release.assert_called_once_with(second)
+
+    @patch.object(BaseClient.BaseClient, 'run_claimed_job')
+    @patch.object(JobGetter, 'get_jobs')
+    def test_run_concurrent_cancel(self, mock_getter, mock_run):
+        c = utils.create_base_client()
+        c.client_info["single_shot"] = False
+        c.client_info["max_jobs"] = 2
+        c.client_info["poll"] = 0.01
+        mock_getter.side_effect = [[{"job_id": 1, "config": "config"}, {"job_id": 2, "config": "config"}]]
+        started = Barrier(2)
+        commands = Queue()
+        def run_claimed_job(server, servers, claimed, command_q=None, client_info=None):
+            # Both jobs are running when the signal comes
+            started.wait(5)
+            c.cancel_signal.triggered = True
+            commands.put(command_q.get(timeout=5))
+        mock_run.side_effect = run_claimed_job
+
+        c.run()
+        self.assertEqual(mock_getter.call_count, 1)
+        self.assertEqual(mock_run.call_count, 2)
+        # Each running job was told to cancel, and only once
+        self.assertEqual(sorted([commands.get_nowait()["job_id"] for i in range(2)]), [1, 2])
+        self.assertTrue(commands.empty())
+
+    @patch.object(BaseClient.BaseClient, 'run_claimed_job')
+    @patch.object(JobGetter, 'get_jobs')
+    def test_run_concurrent_errors(self, mock_getter, mock_run):
+        c = utils.create_base_client()
+        c.client_info["single_shot"] = False
+        c.client_info["max_jobs"] = 2
+        c.client_info["config_slots"] = {"config": 1, "other": 1}
+        c.client_info["poll"] = 0.01
+        finish = Event()
+        def get_jobs(max_jobs, slots, running):
+            if mock_getter.call_count == 1:
+                return [{"job_id": 1, "config": "config"}]
+            if mock_getter.call_count == 2:
+                raise Exception("Server is down")
+            c.graceful_signal.triggered = True
+            finish.set()
+            return []
+        mock_getter.side_effect = get_jobs
+        def run_claimed_job(server, servers, claimed, command_q=None, client_info=None):
+            finish.wait(5)
+            raise Exception("Bad job")
+        mock_run.side_effect = run_claimed_job
+
+        # Neither error stops the client
+        c.run()
+        self.assertEqual(mock_getter.call_count, 3)
+        self.assertEqual(mock_run.call_count, 1)
+        # The running job uses up the slot of its build config
+        self.assertEqual(mock_getter.call_args_list[1][0], (1, {"config": 0, "other": 1}, [1]))
+        self.assertEqual(mock_getter.call_args_list[2][0], (1, {"config": 0, "other": 1}, [1]))
+
+    @patch.object(BaseClient, 'Event')
+    @patch.object(JobGetter, 'get_jobs')
+    def test_run_concurrent_idle(self, mock_getter, mock_event):
+        c = utils.create_base_client()
+        c.client_info["single_shot"] = False
+        c.client_info["max_jobs"] = 2
+        c.client_info["poll"] = 5
+        def get_jobs(max_jobs, slots, running):
+            if mock_getter.call_count == 3:
+                c.graceful_signal.triggered = True
+            return []
+        mock_getter.side_effect = get_jobs
+
+        c.run()
+        self.assertEqual(mock_getter.call_count, 3)
+        self.assertEqual(mock_getter.call_args[0], (2, {}, []))
+        # Nothing was claimed so it waits for the poll interval each time
+        self.assertEqual(mock_event.return_value.wait.call_args_list, [call(5)] * 3)
+
+    @patch.object(requests.Session, 'post')
+    def test_send_spooled_messages(self, mock_post):
+        c = utils.create_base_client()
+        self.assertEqual(c.spool, None)
+        # Nothing to do
+        c.send_spooled_messages()
+
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        client_info = utils.default_client_info()
+        client_info["log_file"] = os.path.join(log_dir, "client.log")
+        client_info["spool"] = True
+        client_info["batch_messages"] = False
+        c = BaseClient.BaseClient(client_info)
+        self.addCleanup(c.spool.close)
+        self.assertEqual(c.spool.path, os.path.join(log_dir, "client.spool"))
+        url = "{}/client/start_step_result/1/".format(client_info["servers"][0])
+        c.spool.add(None, {"server": client_info["servers"][0], "job_id": 1, "url": url, "payload": {}})
+
+        mock_post.return_value = test_utils.Response({}, do_raise=True)
+        c.send_spooled_messages()
+        self.assertEqual(mock_post.call_args[0][0], url)
+        self.assertNotEqual(c.spool.size, 0)
+
+        mock_post.return_value = test_utils.Response({"status": "OK"})
+        c.send_spooled_messages()
+        self.assertEqual(c.spool.size, 0)
+
+        # Each message goes back to the server it was for
+        other_url = "https://<other>/client/start_step_result/2/"
+        c.spool.add(None, {"server": "https://<other>", "job_id": 2, "url": other_url, "payload": {}})
+        c.send_spooled_messages()
+        self.assertEqual(mock_post.call_args[0][0], other_url)
+        self.assertEqual(c.spool.size, 0)
+
+    def test_spool_file(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        client_info = utils.default_client_info()
+        client_info["log_file"] = os.path.join(log_dir, "client.log")
+        c = BaseClient.BaseClient(client_info)
+        self.assertEqual(c.spool_file(), os.path.join(log_dir, "client.spool"))
+
+        # Logging to the console
+        c.client_info["log_file"] = None
+        c.client_info["log_dir"] = log_dir
+        self.assertEqual(c.spool_file(), os.path.join(log_dir, "civet_client_%s.spool" % client_info["client_name"]))
+
+        c.client_info["spool_file"] = os.path.join(log_dir, "messages.db")
+        self.assertEqual(c.spool_file(), os.path.join(log_dir, "messages.db"))
@@ -17,7 +17,7 @@ from __future__ import unicode_literals, absolute_import
 from client import JobGetter
 from django.test import override_settings
 from mock import patch
-import os, subprocess
+import os, shutil, subprocess, tempfile
 import threading
 import time
 from ci import views
@@ -188,3 +188,61 @@ class Tests(LiveClientTester.LiveClientTester):
             c.run()
             self.compare_counts(num_clients=1, num_events_completed=1, num_jobs_completed=1, active_branches=1)
             utils.check_complete_job(self, job, c)
+
+@override_settings(INSTALLED_GITSERVERS=[test_utils.github_config()])
+class ConcurrentTests(LiveClientTester.FileDatabaseLiveClientTester):
+    create_client_and_job = Tests.create_client_and_job
+
+    def test_run_concurrent(self):
+        with test_utils.RecipeDir() as recipe_dir:
+            c, job0 = self.create_client_and_job(recipe_dir, "Concurrent0", sleep=2)
+            job1 = utils.create_client_job(recipe_dir, name="Concurrent1", sleep=2)
+            job2 = utils.create_client_job(recipe_dir, name="Concurrent2", sleep=2)
+            c.client_info["max_jobs"] = 3
+            c.client_info["config_slots"] = {job0.config.name: 2}
+            # So that the ServerUpdaters shut down quickly
+            c.client_info["server_update_timeout"] = 1
+            build_root = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, build_root)
+            c.set_environment('BUILD_ROOT', build_root)
+            self.set_counts()
+            start = time.time()
+            c.run()
+            # Each job takes at least 6 seconds
+            self.assertLess(time.time() - start, 12)
+            self.compare_counts(num_clients=1, num_jobs_completed=2, active_branches=1)
+            completed = [job for job in [job0, job1, job2] if job.step_results.count()]
+            self.assertEqual(len(completed), 2)
+            # Each job gets its own BUILD_ROOT
+            slot_roots = [os.path.join(build_root, str(slot)) for slot in range(2)]
+            used_roots = []
+            for job in completed:
+                output = job.step_results.first().get_output()
+                job_root = [root for root in slot_roots if output.startswith(root + "/")][0]
+                used_roots.append(job_root)
+                utils.check_complete_job(self, job, c, build_root=job_root)
+            self.assertEqual(sorted(used_roots), slot_roots)
+            self.assertFalse(c.runner_killed)
+
+    def test_run_prefetch(self):
+        with test_utils.RecipeDir() as recipe_dir:
+            c, job0 = self.create_client_and_job(recipe_dir, "Prefetch0", sleep=2)
+            job1 = utils.create_client_job(recipe_dir, name="Prefetch1", sleep=2)
+            c.client_info["single_shot"] = False
+            c.client_info["prefetch_job"] = True
+            c.client_info["server_update_timeout"] = 1
+            # Stop once there are no more jobs
+            def stop(elapsed):
+                c.graceful_signal.triggered = True
+            c.poll_sleep = stop
+            self.set_counts()
+            with patch.object(c, 'prefetch_job', wraps=c.prefetch_job) as mock_prefetch:
+                c.run()
+            # The second job was claimed while the first one was finishing
+            self.assertEqual(mock_prefetch.call_count, 2)
+            self.compare_counts(num_clients=1, num_events_completed=1, num_jobs_completed=2, active_branches=1)
+            for job in [job0, job1]:
+                utils.check_complete_job(self, job, c)
+                job.refresh_from_db()
+                self.assertIsNone(job.reserved_until)
+            self.assertFalse(c.runner_killed)
@@ -0,0 +1,106 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import unicode_literals, absolute_import
+from django.test import override_settings
+from django.db import OperationalError
+from ci.tests import utils as test_utils
+from ci import models
+from ci.management import Benchmark
+from client import JobRunner
+from client.tests import LiveClientTester
+
+@override_settings(INSTALLED_GITSERVERS=[test_utils.github_config()])
+class Tests(LiveClientTester.LiveClientTester):
+    def test_seed(self):
+        self.set_counts()
+        Benchmark.seed(3, 2, num_steps=3, num_clients=5)
+        self.compare_counts(jobs=6, ready=6, active=6, events=3, recipes=2, num_pr_recipes=2,
+                current=2, num_steps=6, users=1, repos=1, branches=1, commits=4, num_clients=5)
+
+    def test_run_clients(self):
+        with test_utils.RecipeDir():
+            user = Benchmark.seed(3, 2, num_steps=2)
+            # Only one client since the in-memory test database locks whole tables
+            with Benchmark.QueryCounter() as counter:
+                stats, elapsed = Benchmark.run_clients(self.live_server_url, [user.build_key], 1,
+                        num_updates=2, output_size=10)
+
+        self.assertEqual(stats.jobs, 6)
+        self.assertEqual(models.Job.objects.filter(complete=True, status=models.JobStatus.SUCCESS).count(), 6)
+        self.assertEqual(len(stats.latencies['get_job']), 6 + stats.empty_polls)
+        self.assertEqual(len(stats.latencies['start_step_result']), 12)
+        self.assertEqual(len(stats.latencies['update_step_result']), 24)
+        self.assertEqual(len(stats.latencies['complete_step_result']), 12)
+        self.assertEqual(len(stats.latencies['job_finished']), 6)
+        self.assertEqual(stats.failures, {})
+        self.assertEqual(counter.requests['job_finished'], 6)
+        self.assertGreater(counter.queries['get_job'], 0)
+        self.assertEqual(counter.lock_errors, {})
+
+        lines = Benchmark.report(stats, counter, elapsed)
+        self.assertIn("Jobs: 6 in", lines[0])
+        self.assertEqual(len(lines), 2 + len(Benchmark.ENDPOINTS))
+
+        # The execute wrappers get removed
+        with Benchmark.QueryCounter() as counter:
+            models.Job.objects.count()
+        queries = counter.queries.get('other', 0)
+        models.Job.objects.count()
+        self.assertEqual(counter.queries.get('other', 0), queries)
+
+    def test_percentile(self):
+        self.assertEqual(Benchmark.percentile([], 50), 0)
+        values = list(range(1, 101))
+        self.assertEqual(Benchmark.percentile(values, 50), 50)
+        self.assertEqual(Benchmark.percentile(values, 99), 99)
+        self.assertEqual(Benchmark.percentile(values, 100), 100)
+        self.assertEqual(Benchmark.endpoint_name('/client/get_job/'), 'get_job')
+        self.assertEqual(Benchmark.endpoint_name('/client/update_step_result/1/foo/2/'), 'update_step_result')
+        self.assertEqual(Benchmark.endpoint_name('/'), 'other')
+
+    def test_lock_errors(self):
+        self.assertTrue(Benchmark.is_lock_error(OperationalError("database is locked")))
+        self.assertTrue(Benchmark.is_lock_error(OperationalError("canceling statement due to lock timeout")))
+        self.assertTrue(Benchmark.is_lock_error(OperationalError("deadlock detected")))
+        self.assertTrue(Benchmark.is_lock_error(OperationalError("could not serialize access")))
+        self.assertFalse(Benchmark.is_lock_error(OperationalError("no such table: ci_job")))
+
+        counter = Benchmark.QueryCounter()
+        def execute(sql, params, many, context):
+            raise OperationalError("database is locked")
+        with self.assertRaises(OperationalError):
+            counter(execute, "SELECT 1", None, False, {})
+        self.assertEqual(counter.queries, {'other': 1})
+        self.assertEqual(counter.lock_errors, {'other': 1})
+
+        # Failures and locks are in the report, endpoints without requests are left out
+        stats = Benchmark.Stats()
+        stats.add('get_job', 0.1, success=False)
+        lines = Benchmark.report(stats, counter, 1)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[2].split()[0], 'get_job')
+        self.assertEqual(lines[2].split()[-2:], ['1', '0'])
+
+    def test_flood_step(self):
+        stats = Benchmark.flood_step(1000000, line_length=10, max_output_size=50000)
+        self.assertGreater(stats["output_size"], 50000)
+        # Reading stops within one read of the limit
+        self.assertLess(stats["output_size"], 50000 + 2*JobRunner.ProcessReader.MAX_READ)
+        self.assertIsNone(stats["cancel_latency"])
+        self.assertGreaterEqual(stats["cpu_seconds"], 0)
+
+        stats = Benchmark.flood_step(1000, cancel_after=0.2)
+        self.assertLess(stats["cancel_latency"], 0.5)
+        self.assertEqual(stats["output_size"], 0)
@@ -86,6 +86,18 @@ class Tests(SimpleTestCase):
         settings.MANAGE_BUILD_ROOT = self.orig_manage_build_root
         self.create_client(self.default_args)
 
+    def test_spool_client_info(self):
+        c = self.create_client(self.default_args)['client']
+        settings.SERVERS = [("https://<server0>", ["1234"], False), ("https://<server1>", ["5678"], True)]
+        client_info = c.spool_client_info("https://<server1>")
+        self.assertEqual(client_info["server"], "https://<server1>")
+        self.assertEqual(client_info["build_keys"], ["5678"])
+        self.assertEqual(client_info["ssl_verify"], True)
+
+        # No longer in the settings
+        client_info = c.spool_client_info("https://<old>")
+        self.assertEqual(client_info["server"], "https://<old>")
+
     def test_get_build_root(self):
         c = self.create_client(self.default_args)['client']
 
@@ -18,7 +18,7 @@ import os
 from django.test import override_settings
 from mock import patch
 from client.JobGetter import JobGetter
-from client import settings, BaseClient
+from client import settings, BaseClient, INLClient
 import subprocess
 from client.tests import LiveClientTester, utils
 import tempfile
@@ -197,6 +197,161 @@ class Tests(LiveClientTester.LiveClientTester):
             c.check_server(settings.SERVERS[0])
             self.compare_counts(num_clients=1)
 
+    def set_servers(self, responses):
+        """
+        Sets up the servers for a test where JobGetter is mocked.
+        Input:
+          responses: dict: Server URL => list of (seconds to wait, response) for each get_job() call
+        """
+        servers = [(url, [i], False) for i, url in enumerate(responses.keys())]
+        self.addCleanup(setattr, settings, "SERVERS", settings.SERVERS)
+        settings.SERVERS = servers
+        def get_job(getter, reserve=False, running=None):
+            delay, response = responses[getter.client_info["server"]].pop(0)
+            time.sleep(delay)
+            return response
+        return servers, get_job
+
+    def wait_for_calls(self, mock, count):
+        for i in range(50):
+            if mock.call_count >= count:
+                break
+            time.sleep(0.1)
+        self.assertEqual(mock.call_count, count)
+
+    @patch.object(JobGetter, 'release_job', autospec=True)
+    @patch.object(JobGetter, 'get_job', autospec=True)
+    def test_poll_servers(self, mock_getter, mock_release):
+        c = self.create_client("/foo/bar")
+        job0 = {"job_id": 0}
+        job1 = {"job_id": 1}
+        servers, mock_getter.side_effect = self.set_servers({
+            "https://<server0>": [(0, None), (2, None), (0.5, job0)],
+            "https://<server1>": [(0, None), (0, job1), (0, job1)],
+            })
+
+        # No jobs
+        self.assertIsNone(c.poll_servers(servers))
+        self.assertEqual(mock_release.call_count, 0)
+
+        # A slow server doesn't hold up the others
+        start = time.time()
+        self.assertEqual(c.poll_servers(servers), (servers[1], job1))
+        self.assertLess(time.time() - start, 1)
+
+        # A job claimed after one was chosen is given back
+        self.assertEqual(c.poll_servers(servers), (servers[1], job1))
+        self.wait_for_calls(mock_release, 1)
+        getter, claimed = mock_release.call_args[0]
+        self.assertEqual(getter.client_info["server"], servers[0][0])
+        self.assertEqual(claimed, job0)
+
+    @patch.object(JobGetter, 'release_job', autospec=True)
+    @patch.object(JobGetter, 'get_job', autospec=True)
+    def test_poll_servers_all_claim(self, mock_getter, mock_release):
+        c = self.create_client("/foo/bar")
+        c.client_info["job_wait"] = 60
+        job0 = {"job_id": 0}
+        job1 = {"job_id": 1}
+        servers, mock_getter.side_effect = self.set_servers({
+            "https://<server0>": [(0.5, job0)],
+            "https://<server1>": [(0, job1)],
+            })
+
+        # Both servers have a job, only the first one claimed is run
+        self.assertEqual(c.poll_servers(servers), (servers[1], job1))
+        self.wait_for_calls(mock_release, 1)
+        getter, claimed = mock_release.call_args[0]
+        self.assertEqual(getter.client_info["server"], servers[0][0])
+        self.assertEqual(claimed, job0)
+        # Neither server was asked to hold the request
+        self.assertEqual(mock_getter.call_count, 2)
+        for call in mock_getter.call_args_list:
+            self.assertEqual(call[0][0].client_info["job_wait"], 0)
+
+        # A single server can hold it
+        mock_getter.side_effect = [None]
+        self.assertIsNone(c.poll_servers(servers[:1]))
+        self.assertEqual(mock_getter.call_args[0][0].client_info["job_wait"], 60)
+
+    @patch.object(JobGetter, 'release_job', autospec=True)
+    @patch.object(BaseClient.BaseClient, 'run_claimed_job')
+    @patch.object(JobGetter, 'get_job', autospec=True)
+    def test_check_servers_prefetch(self, mock_getter, mock_run, mock_release):
+        c = self.create_client("/foo/bar")
+        c.client_info["prefetch_job"] = True
+        first = {"job_id": 1}
+        second = {"job_id": 2}
+        servers, mock_getter.side_effect = self.set_servers({
+            "https://<server0>": [(0, first), (0, None), (0, None)],
+            "https://<server1>": [(0, None), (0, second), (0, None)],
+            })
+        def run_claimed_job(server, servers, claimed, fail=False, prefetch=None):
+            return prefetch(claimed["job_id"]) if prefetch else None
+        mock_run.side_effect = run_claimed_job
+
+        # The next job is claimed while the first one finishes
+        self.assertTrue(c.check_servers())
+        self.assertEqual(mock_run.call_args[0][2], first)
+        self.assertEqual(mock_getter.call_count, 4)
+        self.assertEqual(mock_getter.call_args[1], {"reserve": True, "running": [1]})
+        self.assertEqual(c.client_info["server"], servers[0][0])
+        self.assertEqual(c.prefetched, (servers[1], second))
+        self.assertEqual(c.next_server, 1)
+
+        # The servers aren't polled until the claimed job is run
+        self.assertTrue(c.check_servers())
+        self.assertEqual(mock_run.call_args[0][2], second)
+        self.assertEqual(c.client_info["server"], servers[1][0])
+        self.assertEqual(mock_getter.call_count, 6)
+        self.assertIsNone(c.prefetched)
+        self.assertEqual(c.next_server, 2)
+        self.assertEqual(c.server_order(), servers)
+
+        # Only when turned on
+        c.client_info["prefetch_job"] = False
+        mock_getter.side_effect = [first]
+        self.assertTrue(c.check_server(servers[0]))
+        self.assertIsNone(mock_run.call_args[1]["prefetch"])
+        self.assertEqual(mock_release.call_count, 0)
+
+    @patch.object(JobGetter, 'release_job', autospec=True)
+    @patch.object(BaseClient.BaseClient, 'run_claimed_job')
+    @patch.object(JobGetter, 'get_job', autospec=True)
+    def test_run_release_prefetched(self, mock_getter, mock_run, mock_release):
+        c = self.create_client("/foo/bar")
+        c.client_info["prefetch_job"] = True
+        first = {"job_id": 1}
+        second = {"job_id": 2}
+        servers, mock_getter.side_effect = self.set_servers({
+            "https://<server0>": [(0, first), (0, second)],
+            })
+        def run_claimed_job(server, servers, claimed, fail=False, prefetch=None):
+            return prefetch(claimed["job_id"])
+        mock_run.side_effect = run_claimed_job
+
+        # Exits with the next job claimed, it is given back instead of waiting for the reservation to expire
+        c.run(exit_if=lambda client: True)
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(mock_release.call_count, 1)
+        getter, claimed = mock_release.call_args[0]
+        self.assertEqual(getter.client_info["server"], servers[0][0])
+        self.assertEqual(claimed, second)
+        self.assertIsNone(c.prefetched)
+
+    @patch.object(INLClient.INLClient, 'poll_sleep')
+    @patch.object(INLClient.INLClient, 'check_servers', return_value=False)
+    @patch.object(INLClient.INLClient, 'send_spooled_messages', side_effect=Exception("Bad spool"))
+    def test_run_poll(self, mock_spool, mock_check, mock_sleep):
+        c = self.create_client("/foo/bar")
+        exits = iter([False, True])
+        c.run(exit_if=lambda client: next(exits))
+        # Not being able to send the spooled messages doesn't stop polling
+        self.assertEqual(mock_spool.call_count, 2)
+        self.assertEqual(mock_check.call_count, 2)
+        # Nothing was run so it waits until it is time to poll again
+        self.assertEqual(mock_sleep.call_count, 1)
+
     @patch.object(JobGetter, 'get_job')
     def test_runner_error(self, mock_getter):
         with test_utils.RecipeDir() as recipe_dir:
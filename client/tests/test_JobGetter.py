@@ -14,7 +14,7 @@
 # limitations under the License.
 
 from __future__ import unicode_literals, absolute_import
-import copy, requests
+import copy, json, requests
 from . import utils
 from django.test import override_settings
 from ci.tests import utils as test_utils
@@ -86,3 +86,88 @@ class Tests(DBTester.DBTester):
         mock_post.return_value = test_utils.Response(response)
         self.assertIsNone(g.get_job())
 
+
+    @patch.object(requests, 'post')
+    def test_get_job_wait(self, mock_post):
+        g = self.create_getter()
+        mock_post.return_value = test_utils.Response(good_response)
+
+        # No waiting by default
+        g.get_job()
+        post_data = json.loads(mock_post.call_args[0][1])
+        self.assertNotIn('wait', post_data)
+        self.assertEqual(mock_post.call_args[1]['timeout'], 5)
+
+        # The request timeout includes the time the server can wait
+        self.client_info['job_wait'] = 30
+        g.get_job()
+        post_data = json.loads(mock_post.call_args[0][1])
+        self.assertEqual(post_data['wait'], 30)
+        self.assertEqual(mock_post.call_args[1]['timeout'], 35)
+
+    @patch.object(requests, 'post')
+    def test_get_job_reserve(self, mock_post):
+        g = self.create_getter()
+        self.client_info['job_wait'] = 30
+        mock_post.return_value = test_utils.Response(good_response)
+
+        g.get_job()
+        post_data = json.loads(mock_post.call_args[0][1])
+        self.assertNotIn('reserve', post_data)
+        self.assertNotIn('running', post_data)
+
+        # Doesn't wait while a job is finishing
+        self.assertEqual(g.get_job(reserve=True, running=[1]), good_response)
+        post_data = json.loads(mock_post.call_args[0][1])
+        self.assertEqual(post_data['reserve'], True)
+        self.assertEqual(post_data['running'], [1])
+        self.assertNotIn('wait', post_data)
+        self.assertEqual(mock_post.call_args[1]['timeout'], 5)
+
+    @patch.object(requests, 'post')
+    def test_get_jobs(self, mock_post):
+        g = self.create_getter()
+        self.client_info['job_wait'] = 30
+        mock_post.return_value = test_utils.Response({'status': 'OK', 'jobs': [good_response, good_response]})
+        jobs = g.get_jobs(3, {'linux-gnu': 1})
+        self.assertEqual(jobs, [good_response, good_response])
+        post_data = json.loads(mock_post.call_args[0][1])
+        self.assertEqual(post_data['max_jobs'], 3)
+        self.assertEqual(post_data['slots'], {'linux-gnu': 1})
+        self.assertEqual(post_data['running'], [])
+        self.assertEqual(post_data['wait'], 30)
+
+        # Doesn't wait while running jobs
+        g.get_jobs(1, running=[1])
+        post_data = json.loads(mock_post.call_args[0][1])
+        self.assertEqual(post_data['running'], [1])
+        self.assertNotIn('wait', post_data)
+
+        # bad jobs are dropped
+        response = copy.deepcopy(good_response)
+        del response['job_id']
+        mock_post.return_value = test_utils.Response({'status': 'OK', 'jobs': [response, good_response]})
+        self.assertEqual(g.get_jobs(2), [good_response])
+
+        # bad response
+        mock_post.return_value = test_utils.Response({'status': 'OK'})
+        self.assertEqual(g.get_jobs(2), [])
+
+        # not a dict
+        mock_post.return_value = test_utils.Response(['status', 'OK'])
+        self.assertEqual(g.get_jobs(2), [])
+
+        # threw on post
+        mock_post.return_value = test_utils.Response({}, do_raise=True)
+        self.assertEqual(g.get_jobs(2), [])
+
+    @patch.object(requests, 'post')
+    def test_release_job(self, mock_post):
+        g = self.create_getter()
+        mock_post.return_value = test_utils.Response({'status': 'OK'})
+        self.assertTrue(g.release_job(good_response))
+        self.assertEqual(mock_post.call_args[0][0],
+                '{}/client/release_job/5678/{}/1234/'.format(self.client_info['server'], self.client_info['client_name']))
+
+        mock_post.return_value = test_utils.Response({}, do_raise=True)
+        self.assertFalse(g.release_job(good_response))
@@ -18,6 +18,7 @@ from client import JobGetter, BaseClient
 from django.test import override_settings
 from ci.tests import utils as test_utils
 from ci import models
+from ci.client import JobQueue
 import json, os
 from client.tests import LiveClientTester
 from mock import patch
@@ -56,6 +57,7 @@ class Tests(LiveClientTester.LiveClientTester):
         self.job.active = True
         self.job.complete = False
         self.job.save()
+        JobQueue.update_job(self.job)
         self.set_counts()
         ret = self.getter.get_job()
         self.compare_counts(active_branches=1)
@@ -68,6 +70,7 @@ class Tests(LiveClientTester.LiveClientTester):
         self.job.same_client = True
         self.job.client = test_utils.create_client(name="another client")
         self.job.save()
+        JobQueue.update_job(self.job)
         self.set_counts()
         ret = self.getter.get_job()
         self.compare_counts()
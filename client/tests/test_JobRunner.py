@@ -19,7 +19,7 @@ from django.test import override_settings
 from ci.tests import utils as test_utils
 from client import JobRunner, BaseClient
 from client.tests import utils
-import os, platform
+import io, os, platform, threading, time
 from distutils import spawn
 from mock import patch
 import subprocess
@@ -135,17 +135,6 @@ class Tests(SimpleTestCase):
             self.assertEqual(msg["job_id"], r.job_data["job_id"])
             self.assertEqual(msg["payload"], chunk_data)
 
-    def test_get_output_from_queue(self):
-        r = self.create_runner()
-        q0 = {"msg": 1}
-        q1 = {"msg": 2}
-        self.message_q.put(q0)
-        self.message_q.put(q1)
-        output = r.get_output_from_queue(self.message_q)
-        self.assertEqual(len(output), 2)
-        self.assertEqual(output[0], q0)
-        self.assertEqual(output[1], q1)
-
     def test_read_command(self):
         r = self.create_runner()
         # test a command to another job
@@ -233,6 +222,103 @@ class Tests(SimpleTestCase):
                 self.assertEqual(r.canceled, True)
                 self.assertTrue(r.job_killed)
 
+    def test_output_buffer(self):
+        out = JobRunner.OutputBuffer(max_memory=10)
+        out.write(["abc\n", "\u00e9\r\n"])
+        self.assertEqual(out.size, 8)
+        self.assertEqual(out.getvalue(), "abc\n\u00e9\r\n")
+        self.assertFalse(out.file._rolled)
+        out.write(["more output\n"])
+        self.assertEqual(out.size, 20)
+        self.assertTrue(out.file._rolled)
+        self.assertEqual(out.getvalue(), "abc\n\u00e9\r\nmore output\n")
+        out.write(["end"])
+        self.assertEqual(out.getvalue(), "abc\n\u00e9\r\nmore output\nend")
+        out.close()
+
+    def test_read_process_output_limit(self):
+        r = self.create_runner()
+        r.client_info["update_step_time"] = 1
+        r.output_memory_size = 100
+        r.max_output_size = 1000
+        with JobRunner.temp_file() as script_file:
+            script_file.write(b"for i in $(seq 500);do echo line $i; done; sleep 2; echo after")
+            script_file.close()
+            with open(os.devnull, "wb") as devnull:
+                proc = r.create_process(script_file.name, {}, devnull)
+                out = r.read_process_output(proc, r.job_data["steps"][0], {})
+                proc.wait()
+                self.assertTrue(out["output"].startswith("line 1\nline 2\n"))
+                self.assertIn("Output size exceeded limit (1000 bytes)", out["output"])
+                self.assertNotIn("after", out["output"])
+                self.assertLess(len(out["output"]), 6000)
+
+    def check_process_reader(self, use_thread):
+        proc = subprocess.Popen(["/bin/bash", "-c", "head -c 300000 /dev/zero; sleep 1; echo done"],
+                stdout=subprocess.PIPE)
+        reader = JobRunner.ProcessReader(proc.stdout, use_thread=use_thread)
+        output = []
+        while not reader.eof:
+            data = reader.read(0.1)
+            self.assertLessEqual(len(data), JobRunner.ProcessReader.MAX_READ + JobRunner.ProcessReader.CHUNK_SIZE)
+            output.append(data)
+        self.assertEqual(b"".join(output), b"\0"*300000 + b"done\n")
+        self.assertEqual(reader.read(0.1), b"")
+        # Reads chunks, not lines
+        self.assertLess(len(output), 100)
+        reader.close()
+        proc.wait()
+
+    def test_process_reader(self):
+        self.check_process_reader(False)
+        self.check_process_reader(True)
+
+        # The thread stops if the stream gets closed when the job is killed
+        stream = io.BytesIO(b"foo")
+        stream.close()
+        reader = JobRunner.ProcessReader(stream, use_thread=True)
+        self.assertEqual(reader.read(5), b"")
+        self.assertTrue(reader.eof)
+
+    def test_read_process_output_cancel(self):
+        r = self.create_runner()
+        r.client_info["update_step_time"] = 1
+        with JobRunner.temp_file() as script_file:
+            script_file.write(b"echo start; sleep 30")
+            script_file.close()
+            with open(os.devnull, "wb") as devnull:
+                proc = r.create_process(script_file.name, {}, devnull)
+                killed = []
+                def kill_job(proc):
+                    killed.append(time.time())
+                    proc.kill()
+                with patch.object(r, "kill_job", side_effect=kill_job):
+                    def cancel():
+                        time.sleep(0.5)
+                        self.cancel_time = time.time()
+                        self.command_q.put({"job_id": r.job_data["job_id"], "command": "cancel"})
+                    t = threading.Thread(target=cancel)
+                    t.start()
+                    out = r.read_process_output(proc, r.job_data["steps"][0], {})
+                    t.join()
+                proc.wait()
+                self.assertTrue(out["canceled"])
+                self.assertEqual(len(killed), 1)
+                self.assertLess(killed[0] - self.cancel_time, 0.5)
+
+    def test_read_process_output_multibyte(self):
+        r = self.create_runner()
+        r.client_info["update_step_time"] = 1
+        with JobRunner.temp_file() as script_file:
+            # The character is split between two writes
+            script_file.write(b"printf 'a\\xc3'; sleep 0.5; printf '\\xa9b\\xff'")
+            script_file.close()
+            with open(os.devnull, "wb") as devnull:
+                proc = r.create_process(script_file.name, {}, devnull)
+                out = r.read_process_output(proc, r.job_data["steps"][0], {})
+                proc.wait()
+                self.assertEqual(out["output"], "a\u00e9b\ufffd")
+
     def test_kill_job(self):
         with JobRunner.temp_file() as script:
             script.write(b"sleep 30")
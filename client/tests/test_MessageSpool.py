@@ -0,0 +1,124 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import unicode_literals, absolute_import
+from django.test import SimpleTestCase
+from client.MessageSpool import MessageSpool
+from mock import Mock
+import os, shutil, sqlite3, tempfile
+
+class Tests(SimpleTestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.spool_dir, "client.spool")
+        self.spool = None
+
+    def tearDown(self):
+        if self.spool:
+            self.spool.close()
+        shutil.rmtree(self.spool_dir)
+
+    def message(self, url, output=""):
+        return {"server": "server", "job_id": 1, "url": url, "payload": {"output": output}}
+
+    def test_add_claim(self):
+        self.spool = MessageSpool(self.path)
+        msg0 = self.message("server/client/start_step_result/1/")
+        msg1 = self.message("server/client/update_step_result/1/", "out")
+        id0 = self.spool.add("owner", msg0)
+        id1 = self.spool.add("owner", msg1)
+        self.assertNotEqual(id0, id1)
+        self.assertGreater(self.spool.size, 0)
+
+        # Still owned
+        self.assertEqual(self.spool.claim("other", "server"), [])
+
+        self.spool.release("owner")
+        messages = self.spool.claim("other", "server")
+        self.assertEqual([m["spool_ids"] for m in messages], [[id0], [id1]])
+        self.assertEqual(messages[1]["payload"], msg1["payload"])
+        # The messages aren't changed
+        self.assertNotIn("spool_ids", msg0)
+        # Already claimed
+        self.assertEqual(self.spool.claim("another", "server"), [])
+
+        self.spool.remove([id0, id1, None])
+        self.assertEqual(self.spool.size, 0)
+        self.spool.release("other")
+        self.assertEqual(self.spool.claim("other", "server"), [])
+        self.spool.remove([None])
+
+    def test_claim_error(self):
+        self.spool = MessageSpool(self.path)
+        self.spool.add(None, self.message("server/client/start_step_result/1/"))
+        conn = self.spool.conn
+        def execute(sql, *args):
+            if sql.startswith("UPDATE"):
+                raise sqlite3.OperationalError("disk I/O error")
+            return conn.execute(sql, *args)
+
+        self.spool.conn = Mock(execute=Mock(side_effect=execute))
+        with self.assertRaises(sqlite3.OperationalError):
+            self.spool.claim("owner", "server")
+        self.spool.conn = conn
+        # Nothing is left claimed or in a transaction
+        self.assertFalse(conn.in_transaction)
+        self.assertEqual(len(self.spool.claim("owner", "server")), 1)
+
+    def test_servers(self):
+        self.spool = MessageSpool(self.path)
+        self.assertEqual(self.spool.servers(), [])
+        other = dict(self.message("other/client/start_step_result/2/"), server="other")
+        other_id = self.spool.add(None, other)
+        server_id = self.spool.add(None, self.message("server/client/start_step_result/1/"))
+        self.spool.add("owner", dict(other, server="owned"))
+        # In the order they were added, only the released ones
+        self.assertEqual(self.spool.servers(), ["other", "server"])
+
+        messages = self.spool.claim("owner", "server")
+        self.assertEqual([m["spool_ids"] for m in messages], [[server_id]])
+        self.assertEqual(self.spool.servers(), ["other"])
+        messages = self.spool.claim("owner", "other")
+        self.assertEqual([m["spool_ids"] for m in messages], [[other_id]])
+        self.assertEqual(self.spool.servers(), [])
+
+    def test_reopen(self):
+        self.spool = MessageSpool(self.path)
+        self.spool.add("owner", self.message("server/client/start_step_result/1/"))
+        self.spool.add("owner", self.message("server/client/update_step_result/1/", "out"))
+        size = self.spool.size
+        self.spool.close()
+
+        # Like the client got restarted
+        self.spool = MessageSpool(self.path)
+        self.assertEqual(self.spool.size, size)
+        messages = self.spool.claim("new_owner", "server")
+        self.assertEqual([m["url"] for m in messages],
+                ["server/client/start_step_result/1/", "server/client/update_step_result/1/"])
+
+    def test_max_size(self):
+        self.spool = MessageSpool(self.path, max_size=1000)
+        start_id = self.spool.add("owner", self.message("server/client/start_step_result/1/", "x" * 300))
+        update_id = self.spool.add("owner", self.message("server/client/update_step_result/1/", "x" * 300))
+        # The output update gets dropped to make room
+        complete_id = self.spool.add("owner", self.message("server/client/complete_step_result/1/", "x" * 300))
+        self.assertNotEqual(complete_id, None)
+        self.assertLessEqual(self.spool.size, 1000)
+        self.spool.release("owner")
+        messages = self.spool.claim("owner", "server")
+        self.assertEqual([m["spool_ids"] for m in messages], [[start_id], [complete_id]])
+        self.assertNotIn([update_id], [m["spool_ids"] for m in messages])
+
+        # Nothing left to drop
+        self.assertEqual(self.spool.add("owner", self.message("server/client/start_step_result/2/", "x" * 500)), None)
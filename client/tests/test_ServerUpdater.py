@@ -17,8 +17,9 @@ from __future__ import unicode_literals, absolute_import
 from django.test import SimpleTestCase
 from django.test import override_settings
 from ci.tests import utils as test_utils
-import requests, time
+import gzip, json, os, requests, shutil, tempfile, time
 from client import ServerUpdater, BaseClient
+from client.MessageSpool import MessageSpool
 from client.tests import utils
 from mock import patch
 from threading import Thread
@@ -304,3 +305,330 @@ class Tests(SimpleTestCase):
         item["payload"]["foo"] = BadObject()
         with self.assertRaises(ServerUpdater.StopException):
             u.post_message(item)
+
+    def step_messages(self, u, stages):
+        items = []
+        for i, (stage, step) in enumerate(stages):
+            url = "{}/client/{}_step_result/1234/client/{}/".format(u.main_server, stage, step)
+            payload = {"output": "out{}\n".format(i), "time": i, "complete": False}
+            items.append({"server": u.main_server, "job_id": 1, "url": url, "payload": payload})
+        return items
+
+    def test_coalesce_messages(self):
+        u = self.create_updater()
+        items = self.step_messages(u, [("start", 1), ("update", 1), ("update", 1), ("update", 1),
+            ("update", 2), ("update", 1), ("complete", 1), ("complete", 1)])
+        u.messages = [item.copy() for item in items]
+        u.coalesce_messages()
+        self.assertEqual([msg["url"] for msg in u.messages],
+                [items[i]["url"] for i in [0, 1, 4, 5, 6, 7]])
+        self.assertEqual(u.messages[1]["payload"], {"output": "out1\nout2\nout3\n", "time": 3, "complete": False})
+        self.assertEqual(u.messages[1]["count"], 3)
+        self.assertEqual(u.messages[0], items[0])
+        self.assertEqual(u.messages[2], items[4])
+        self.assertEqual(u.messages[5], items[7])
+        # The originals aren't changed
+        self.assertEqual(items[1]["payload"]["output"], "out1\n")
+
+        # Merging a merged message
+        u.messages.insert(2, items[1])
+        u.coalesce_messages()
+        self.assertEqual(u.messages[1]["payload"]["output"], "out1\nout2\nout3\nout1\n")
+        self.assertEqual(u.messages[1]["count"], 4)
+
+    def test_coalesce_messages_large(self):
+        u = self.create_updater()
+        u.max_coalesced_output = 1000
+        # A large backlog of updates, like after the server was down for a while
+        items = self.step_messages(u, [("update", 1)] * 30)
+        for item in items:
+            item["payload"]["output"] = "x" * 99 + "\n"
+        u.messages = [item.copy() for item in items]
+        u.coalesce_messages()
+        self.assertEqual([len(msg["payload"]["output"]) for msg in u.messages], [1000, 1000, 1000])
+        self.assertEqual([msg["count"] for msg in u.messages], [10, 10, 10])
+
+        # Output already over the limit is sent on its own
+        items[1]["payload"]["output"] = "y" * 2000
+        u.messages = [item.copy() for item in items[:3]]
+        u.coalesce_messages()
+        self.assertEqual([len(msg["payload"]["output"]) for msg in u.messages], [100, 2000, 100])
+
+        # By default each request stays under what the server takes, 2.5MB
+        u = self.create_updater()
+        items = self.step_messages(u, [("update", 1)] * 50)
+        for item in items:
+            item["payload"]["output"] = "\u00e9" * 100*1024
+        u.messages = items
+        u.coalesce_messages()
+        self.assertEqual(sum(msg["count"] for msg in u.messages), 50)
+        for msg in u.messages:
+            self.assertLess(len(json.dumps(msg["payload"]).encode("utf-8")), 2.5*1024*1024)
+
+    def load_step_messages(self, u, stages):
+        u.messages = []
+        for item in self.step_messages(u, stages):
+            u.message_q.put(item)
+        u.read_queue()
+
+    @patch.object(requests, 'post')
+    def test_send_messages_batch(self, mock_post):
+        u = self.create_updater()
+        self.load_step_messages(u, [("start", 1), ("update", 1), ("update", 1), ("complete", 1)])
+        replies = [{"status_code": 200, "reply": {"status": "OK", "command": None}}] * 3
+        mock_post.return_value = test_utils.Response({"status": "OK", "replies": replies})
+        u.send_messages()
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(mock_post.call_args[0][0], "{}/client/post_messages/".format(u.main_server))
+        data = json.loads(mock_post.call_args[0][1])
+        self.assertEqual([m["path"] for m in data["messages"]], ["/client/start_step_result/1234/client/1/",
+            "/client/update_step_result/1234/client/1/", "/client/complete_step_result/1234/client/1/"])
+        self.assertEqual(data["messages"][1]["payload"]["output"], "out1\nout2\n")
+        self.assertEqual(u.messages, [])
+        # All the messages from the queue are done
+        self.message_q.join()
+        self.assertTrue(u.batch_messages)
+
+        # Only some handled
+        self.load_step_messages(u, [("start", 1), ("update", 1), ("complete", 1)])
+        replies = [{"status_code": 200, "reply": {"status": "OK", "command": "cancel"}},
+                {"status_code": 502, "reply": None}]
+        mock_post.return_value = test_utils.Response({"status": "OK", "replies": replies})
+        u.send_messages()
+        self.assertEqual(len(u.messages), 2)
+        self.assertEqual(self.read_q(self.command_q), [{"server": u.main_server, "job_id": 1, "command": "cancel"}])
+
+        # Stop
+        replies = [{"status_code": 500, "reply": None}, {"status_code": 400, "reply": None}]
+        mock_post.return_value = test_utils.Response({"status": "OK", "replies": replies})
+        u.send_messages()
+        self.assertEqual(u.messages, [])
+        self.message_q.join()
+        self.assertEqual(self.read_q(self.command_q), [{"server": u.main_server, "job_id": 1, "command": "stop"}])
+
+    @patch.object(requests, 'post')
+    def test_send_messages_batch_unsupported(self, mock_post):
+        u = self.create_updater()
+        self.load_step_messages(u, [("start", 1), ("update", 1), ("complete", 1)])
+        # Server is down
+        mock_post.return_value = test_utils.Response({}, do_raise=True)
+        u.send_messages()
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(len(u.messages), 3)
+        self.assertTrue(u.batch_messages)
+
+        # An error on the server only sends the first one by itself this time
+        error_response = test_utils.Response({}, status_code=502)
+        good_response = test_utils.Response({"status": "OK"})
+        mock_post.return_value = None
+        mock_post.side_effect = [error_response, good_response, error_response, good_response, good_response]
+        u.send_messages()
+        self.assertEqual(mock_post.call_count, 7)
+        self.assertEqual(u.messages, [])
+        self.assertTrue(u.batch_messages)
+        self.message_q.join()
+
+        # The server doesn't know about batches
+        self.load_step_messages(u, [("start", 1), ("update", 1), ("complete", 1)])
+        bad_response = test_utils.Response({}, status_code=404)
+        mock_post.side_effect = [bad_response, good_response, good_response, good_response]
+        u.send_messages()
+        self.assertEqual(mock_post.call_count, 11)
+        self.assertEqual(u.messages, [])
+        self.assertFalse(u.batch_messages)
+        self.message_q.join()
+
+    @patch.object(requests, 'post')
+    def test_send_messages_batch_errors(self, mock_post):
+        u = self.create_updater()
+        self.load_step_messages(u, [("start", 1), ("update", 1), ("complete", 1)])
+        # Can't connect
+        mock_post.side_effect = requests.ConnectionError("Connection refused")
+        u.send_messages()
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(len(u.messages), 3)
+        self.assertTrue(u.batch_messages)
+
+        # The server doesn't know about batches and the first one doesn't get there either
+        mock_post.side_effect = [test_utils.Response({}, status_code=404), requests.ConnectionError("Connection refused")]
+        u.send_messages()
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(len(u.messages), 3)
+        self.assertTrue(u.batch_messages)
+
+        # Not JSON, the first one goes by itself
+        bad_json = test_utils.Response({})
+        bad_json.json = lambda: json.loads("<html>")
+        mock_post.side_effect = [bad_json, test_utils.Response({"status": "OK"}), requests.ConnectionError("Connection refused")]
+        u.send_messages()
+        self.assertEqual(mock_post.call_count, 6)
+        self.assertEqual(len(u.messages), 2)
+        self.assertTrue(u.batch_messages)
+
+        # Can't be converted to JSON so the first one stops the job
+        class BadObject(object):
+            pass
+
+        u.messages[0]["payload"]["foo"] = BadObject()
+        mock_post.side_effect = None
+        u.send_messages()
+        self.assertEqual(mock_post.call_count, 6)
+        self.assertEqual(u.messages, [])
+        self.message_q.join()
+
+    @patch.object(requests, 'post')
+    def test_send_messages_batch_too_large(self, mock_post):
+        u = self.create_updater()
+        self.load_step_messages(u, [("start", 1), ("update", 1), ("complete", 1), ("start", 2), ("update", 2)])
+        ok_reply = {"status_code": 200, "reply": {"status": "OK", "command": None}}
+        too_large = test_utils.Response({}, status_code=400)
+        # Split into 2 + 3, then the 3 into 1 + 2
+        mock_post.side_effect = [too_large,
+                test_utils.Response({"status": "OK", "replies": [ok_reply] * 2}),
+                test_utils.Response({}, status_code=413),
+                test_utils.Response({"status": "OK"}),
+                test_utils.Response({"status": "OK", "replies": [ok_reply] * 2}),
+                ]
+        u.send_messages()
+        self.assertEqual(mock_post.call_count, 5)
+        sizes = [len(json.loads(args[0][1]).get("messages", [None])) for args in mock_post.call_args_list]
+        self.assertEqual(sizes, [5, 2, 3, 1, 2])
+        self.assertEqual(u.messages, [])
+        self.assertTrue(u.batch_messages)
+        self.message_q.join()
+
+        # Stops at the first half that didn't get sent
+        self.load_step_messages(u, [("start", 1), ("update", 1), ("complete", 1), ("start", 2)])
+        mock_post.side_effect = [too_large, test_utils.Response({}, do_raise=True, status_code=503)]
+        mock_post.reset_mock()
+        u.send_messages()
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(len(u.messages), 4)
+        self.assertTrue(u.batch_messages)
+
+    @patch.object(requests, 'post')
+    def test_post_json_gzip(self, mock_post):
+        u = self.create_updater()
+        u.gzip_min_size = 100
+        url = "{}/client/update_step_result/1/client/2/".format(u.main_server)
+        data = {"output": "x" * 200}
+        mock_post.return_value = test_utils.Response({"status": "OK"}, headers={"Accept-Encoding": "gzip"})
+        # Not compressed until the server says it takes it
+        self.assertEqual(u.post_json(url, data.copy()), {"status": "OK"})
+        self.assertNotIn(b"Content-Encoding", mock_post.call_args[1]["headers"])
+        self.assertEqual(u.gzip_servers, set([("https", "<server0>")]))
+
+        u.post_json(url, data.copy())
+        self.assertEqual(mock_post.call_args[1]["headers"][b"Content-Encoding"], b"gzip")
+        body = gzip.decompress(mock_post.call_args[0][1])
+        self.assertEqual(json.loads(body)["output"], "x" * 200)
+        # The default headers aren't changed
+        self.assertNotIn(b"Content-Encoding", u._headers)
+
+        # Small bodies aren't compressed
+        u.post_json(url, {"output": ""})
+        self.assertNotIn(b"Content-Encoding", mock_post.call_args[1]["headers"])
+        json.loads(mock_post.call_args[0][1])
+
+        # Only for the servers that take it
+        u.post_json("https://<server1>/client/ping/", data.copy())
+        self.assertNotIn(b"Content-Encoding", mock_post.call_args[1]["headers"])
+
+    def create_spool(self):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        spool = MessageSpool(os.path.join(spool_dir, "client.spool"))
+        self.addCleanup(spool.close)
+        return spool
+
+    @patch.object(requests, 'post')
+    def test_spool(self, mock_post):
+        u = self.create_updater()
+        u.spool = self.create_spool()
+        u.batch_messages = False
+        items = self.load_messages(u)
+        self.assertEqual([m["spool_ids"] for m in u.messages], [[1], [2], [3]])
+        # The messages in the queue aren't changed
+        self.assertNotIn("spool_ids", items[0])
+
+        # Server is down, everything is kept
+        mock_post.return_value = test_utils.Response({}, do_raise=True)
+        u.send_messages()
+        self.assertEqual(len(u.messages), 3)
+        u.spool.release(u.spool_owner)
+        self.assertEqual(len(u.spool.claim("other", u.main_server)), 3)
+        u.spool.release("other")
+
+        # Sent ones are removed
+        mock_post.return_value = None
+        mock_post.side_effect = [test_utils.Response({"status": "OK"}), test_utils.Response({}, do_raise=True)]
+        u.send_messages()
+        self.assertEqual(len(u.messages), 2)
+        self.assertEqual([m["spool_ids"] for m in u.spool.claim("other", u.main_server)], [[2], [3]])
+
+    @patch.object(requests, 'post')
+    def test_run_spool(self, mock_post):
+        u = self.create_updater()
+        u.spool = self.create_spool()
+        mock_post.return_value = test_utils.Response({}, do_raise=True)
+        self.message_q.put({"server": u.main_server, "job_id": 0, "url": "url", "payload": {"message": "message"}})
+        self.control_q.put("Quit")
+        with self.assertRaises(SystemExit):
+            ServerUpdater.ServerUpdater.run(u)
+        # The client sends what is left
+        self.assertEqual(len(u.spool.claim("other", u.main_server)), 1)
+
+    @patch.object(requests, 'post')
+    def test_spool_coalesce(self, mock_post):
+        u = self.create_updater()
+        u.spool = self.create_spool()
+        self.load_step_messages(u, [("start", 1), ("update", 1), ("update", 1), ("complete", 1)])
+        u.coalesce_messages()
+        self.assertEqual([m["spool_ids"] for m in u.messages], [[1], [2, 3], [4]])
+        replies = [{"status_code": 200, "reply": {"status": "OK", "command": None}}] * 3
+        mock_post.return_value = test_utils.Response({"status": "OK", "replies": replies})
+        u.send_messages()
+        self.assertEqual(u.messages, [])
+        data = json.loads(mock_post.call_args[0][1])
+        self.assertNotIn("spool_ids", data["messages"][0])
+        self.assertEqual(u.spool.size, 0)
+        self.message_q.join()
+
+    @patch.object(requests, 'post')
+    def test_send_spooled_messages(self, mock_post):
+        u = self.create_updater()
+        u.spool = self.create_spool()
+        u.batch_messages = False
+        self.load_messages(u)
+        # Another updater is still sending these
+        self.assertEqual(u.send_spooled_messages(), 0)
+        self.assertEqual(mock_post.call_count, 0)
+        u.spool.release(u.spool_owner)
+
+        other = self.create_updater()
+        other.spool = u.spool
+        other.batch_messages = False
+        mock_post.side_effect = [test_utils.Response({"status": "OK"}), test_utils.Response({}, do_raise=True)]
+        self.assertEqual(other.send_spooled_messages(), 2)
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(other.messages, [])
+
+        # The rest gets sent the next time
+        mock_post.side_effect = None
+        mock_post.return_value = test_utils.Response({"status": "OK"})
+        self.assertEqual(other.send_spooled_messages(), 0)
+        self.assertEqual(mock_post.call_count, 4)
+        self.assertEqual(u.spool.size, 0)
+        # Not from this updater's queue
+        self.assertEqual(other.message_q.unfinished_tasks, 3)
+
+    @patch.object(requests, 'post')
+    def test_send_spooled_messages_other_server(self, mock_post):
+        u = self.create_updater()
+        u.spool = self.create_spool()
+        u.batch_messages = False
+        u.spool.add(None, {"server": "https://<other>", "job_id": 1, "url": "https://<other>/client/ping/", "payload": {}})
+        # Left for an updater of the other server
+        self.assertEqual(u.send_spooled_messages(), 0)
+        self.assertEqual(mock_post.call_count, 0)
+        self.assertEqual(u.spool.servers(), ["https://<other>"])
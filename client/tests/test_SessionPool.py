@@ -0,0 +1,76 @@
+# Copyright 2016 Battelle Energy Alliance, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import unicode_literals, absolute_import
+from django.test import SimpleTestCase
+from ci.tests import utils as test_utils
+from client import SessionPool, JobGetter, ServerUpdater, settings
+from client.tests import utils
+from mock import patch
+import requests
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+class Tests(SimpleTestCase):
+    def test_get(self):
+        pool = SessionPool.SessionPool()
+        self.assertEqual(pool.pool_size, settings.HTTP_POOL_SIZE)
+        self.assertEqual(pool.retries, settings.HTTP_RETRIES)
+        self.assertEqual(pool.retry_backoff, settings.HTTP_RETRY_BACKOFF)
+
+        session = pool.get("https://server0/client/get_job/")
+        self.assertIsInstance(session, requests.Session)
+        self.assertIs(pool.get("https://server0/client/ping/foo/"), session)
+        self.assertIsNot(pool.get("https://server1/client/get_job/"), session)
+        self.assertIsNot(pool.get("http://server0/client/get_job/"), session)
+        self.assertEqual(len(pool.sessions), 3)
+
+        with patch.object(requests.Session, "close") as mock_close:
+            pool.close()
+            self.assertEqual(mock_close.call_count, 3)
+        self.assertEqual(pool.sessions, {})
+
+    def test_retries(self):
+        pool = SessionPool.SessionPool(pool_size=3, retries=4, retry_backoff=0)
+        adapter = pool.get("https://server0").get_adapter("https://server0/")
+        self.assertEqual(adapter._pool_maxsize, 3)
+        retry = adapter.max_retries
+        self.assertEqual(retry.connect, 4)
+        # Posts that might have been handled aren't sent again
+        self.assertEqual(retry.read, 0)
+        self.assertEqual(retry.status, 0)
+        self.assertFalse(retry.is_retry("POST", 503))
+
+        # Nothing listening
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            pool.post("http://127.0.0.1:1/", "data", timeout=1)
+
+    @patch.object(requests.Session, "post")
+    def test_post(self, mock_post):
+        pool = SessionPool.SessionPool()
+        mock_post.return_value = test_utils.Response({"status": "OK"})
+        client_info = utils.default_client_info()
+        client_info["server"] = client_info["servers"][0]
+
+        getter = JobGetter.JobGetter(client_info, pool)
+        getter.get_job()
+        updater = ServerUpdater.ServerUpdater(client_info["server"], client_info, Queue(), Queue(), Queue(), pool)
+        self.assertTrue(updater.ping_server(client_info["servers"][0], "msg"))
+        self.assertTrue(updater.ping_server(client_info["servers"][1], "msg"))
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(mock_post.call_args_list[0][0][0], "{}/client/get_job/".format(client_info["server"]))
+        self.assertEqual(len(pool.sessions), 2)
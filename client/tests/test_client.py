@@ -19,12 +19,21 @@ from django.test import override_settings
 from ci.tests import utils as test_utils
 from client import client, BaseClient
 from client.tests import utils
-import os
+import os, shutil, tempfile
 from mock import patch
 
 
 @override_settings(INSTALLED_GITSERVERS=[test_utils.github_config()])
 class CommandlineClientTests(SimpleTestCase):
+    def setUp(self):
+        # The default log dir is the current directory
+        self.orig_cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir)
+
+    def tearDown(self):
+        os.chdir(self.orig_cwd)
+        shutil.rmtree(self.work_dir)
 
     def test_commandline_client(self):
         args = []
@@ -60,10 +69,12 @@ class CommandlineClientTests(SimpleTestCase):
             '--log-dir',
             '/tmp',
             '--insecure',
+            '--prefetch',
             ])
 
         c, cmd = client.commandline_client(args)
         self.assertEqual(c.client_info["single_shot"], True)
+        self.assertEqual(c.client_info["prefetch_job"], True)
         self.assertEqual(c.client_info["ssl_verify"], False)
         self.assertEqual(c.client_info["poll"], 1)
         self.assertEqual('/tmp', os.path.dirname(c.client_info["log_file"]))
@@ -86,6 +86,11 @@ class CommandlineINLClientTests(SimpleTestCase):
             args.extend(['--env', 'FOO', 'bar'])
             c, cmd = inl_client.commandline_client(args)
             self.assertEqual('bar', c.get_environment('FOO'))
+            self.assertFalse(c.get_client_info('prefetch_job'))
+
+            args.extend(['--prefetch'])
+            c, cmd = inl_client.commandline_client(args)
+            self.assertTrue(c.get_client_info('prefetch_job'))
 
             # Should add the current user to the client name
             user = pwd.getpwuid(os.getuid())[0]
@@ -202,17 +202,19 @@ def create_job_with_nested_bash(recipe_dir, name="TestJob", sleep=10):
     os.chmod(sub_sub_script_filename, st.st_mode | stat.S_IEXEC)
     return test_job
 
-def check_complete_step(self, job, client, result, extra_step_msg=''):
-    global_var = "%s/global" % client.get_environment('BUILD_ROOT')
-    step_var = "%s/%s" % (client.get_environment('BUILD_ROOT'), result.name)
+def check_complete_step(self, job, client, result, extra_step_msg='', build_root=None):
+    if build_root is None:
+        build_root = client.get_environment('BUILD_ROOT')
+    global_var = "%s/global" % build_root
+    step_var = "%s/%s" % (build_root, result.name)
     output = "{0} {1} {2}\nstart {1}:{3}\nend {1}:{3}\n{4}".format(global_var, job.recipe.name, step_var, result.name, extra_step_msg)
-    self.assertEqual(result.output, output)
+    self.assertEqual(result.get_output(), output)
 
-def check_complete_job(self, job, client, n_steps=3, extra_step_msg=''):
+def check_complete_job(self, job, client, n_steps=3, extra_step_msg='', build_root=None):
     job.refresh_from_db()
     self.assertEqual(job.step_results.count(), n_steps)
     for result in job.step_results.order_by("position"):
-        check_complete_step(self, job, client, result, extra_step_msg)
+        check_complete_step(self, job, client, result, extra_step_msg, build_root)
         self.assertEqual(job.complete, True)
         self.assertEqual(job.status, models.JobStatus.SUCCESS)
         self.assertGreater(job.seconds.total_seconds(), 1)
@@ -223,7 +225,7 @@ def check_canceled_job(self, job, client):
     found_cancel = False
     for result in job.step_results.order_by("position"):
         if result.status == models.JobStatus.CANCELED:
-            self.assertEqual(result.output, "")
+            self.assertEqual(result.get_output(), "")
             self.assertGreater(job.seconds.total_seconds(), 1)
             found_cancel = True
         elif result.status == models.JobStatus.SUCCESS: